@@ -1,5 +1,8 @@
-import sys
 import os, platform
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats as stats
@@ -96,15 +99,177 @@ class CylindersListGenerator():
 
         return parameters
 
-    def generate_cylinders_lists(self, n):
+    def _write_repetition_config_file(self, path_repetition):
+        """
+        Copy of the MCDC config file which writes its output to path_repetition.
+        """
+
+        with open(self.path_config_file, 'r') as file:
+            lines = file.readlines()
+
+        lines = [f'out_traj_file_index {path_repetition}/\n' if line.startswith('out_traj_file_index ') else line for line in lines]
+
+        path_config_file_repetition = os.path.join(path_repetition, os.path.basename(self.path_config_file))
+        path_config_file_repetition = path_config_file_repetition.replace('\\', '/')
+
+        with open(path_config_file_repetition, 'w') as file:
+            file.writelines(lines)
+
+        return path_config_file_repetition
+
+    def _collect_repetition_output(self, path_repetition, idx):
+        """
+        Move the output of one repetition into path_substrates, tagged as rep_{idx}.
+        """
+
+        name_config_file = os.path.basename(self.path_config_file)
+
+        for name in os.listdir(path_repetition):
+
+            if name == name_config_file:
+                continue
+
+            if re.search(r'rep_\d+', name):
+                name_new = re.sub(r'rep_\d+', f'rep_{idx:02d}', name, count=1)
+            else:
+                name_new = f'rep_{idx:02d}_{name}'
+
+            os.replace(os.path.join(path_repetition, name), os.path.join(self.path_substrates, name_new))
+
+        shutil.rmtree(path_repetition)
+
+    def _run_repetition(self, idx):
+
+        path_repetition = self._get_path_repetition(idx)
+        os.makedirs(path_repetition, exist_ok=True)
+
+        path_config_file_repetition = self._write_repetition_config_file(path_repetition)
+
+        if platform.system() == 'Windows':
+            command = ['wsl', 'MC-DC_Simulator', path_config_file_repetition]
+        else:
+            command = ['MC-DC_Simulator', path_config_file_repetition]
+
+        try:
+            process = subprocess.run(command, capture_output=True, text=True)
+        except OSError as e:
+            # e.g. MC-DC_Simulator is not on the PATH
+            process = subprocess.CompletedProcess(command, -1, stdout='', stderr=f'{e}\n')
+
+        if process.returncode == 0:
+            self._collect_repetition_output(path_repetition, idx)
+
+        return process
+
+    def _get_path_repetition(self, idx):
+
+        return os.path.join(self.path_substrates, f'repetition_{idx:02d}').replace('\\', '/')
+
+    def _has_cylinders_list(self, idx):
+        """
+        Whether repetition idx left a cylinder list, collected into
+        path_substrates or still in its own directory.
+        """
+
+        path_repetition = self._get_path_repetition(idx)
+
+        if os.path.exists(path_repetition) and any(['cylinder_list' in name for name in os.listdir(path_repetition)]):
+            return True
+
+        return any([('cylinder_list' in name) and (f'rep_{idx:02d}' in name) for name in os.listdir(self.path_substrates)])
+
+    def _generate_cylinders_lists_with_scheduler(self, n, scheduler):
+        """
+        Queues the n repetitions in scheduler (an mcdc_scheduler.MCDCScheduler)
+        and runs its queue. Repetitions that are done in the queue already are
+        not run again, unless their cylinder list has been removed since.
+        """
+
+        paths_config_file = []
+
+        for idx in range(n):
+            path_repetition = self._get_path_repetition(idx)
+            os.makedirs(path_repetition, exist_ok=True)
+            paths_config_file.append(self._write_repetition_config_file(path_repetition))
 
         print("Generating CylindersLists...")
-        for _ in tqdm(range(n)):
-            if platform.system() == 'Windows':
-                os.system(f'wsl MC-DC_Simulator {self.path_config_file}')
+        scheduler.add(paths_config_file)
+
+        # e.g. removed by config_utils.clean_up after an earlier call
+        paths_config_file_stale = [path_config_file for idx, path_config_file in enumerate(paths_config_file)
+                                   if (scheduler.jobs[os.path.abspath(path_config_file)]['status'] == 'done') and (not self._has_cylinders_list(idx))]
+        scheduler.reset(paths_config_file_stale)
+
+        scheduler.run()
+
+        returncodes = [None] * n
+
+        for idx, path_config_file in enumerate(paths_config_file):
+
+            job = scheduler.jobs[os.path.abspath(path_config_file)]
+
+            if job['status'] == 'done':
+                returncodes[idx] = 0
+                self._collect_repetition_output(self._get_path_repetition(idx), idx)
+                if not self._has_cylinders_list(idx):
+                    raise RuntimeError(f'Repetition {idx} is done in the queue of the scheduler but wrote no cylinder list, see {job["path_stdout"]}')
             else:
-                os.system(f'MC-DC_Simulator {self.path_config_file}')
-        print(n, " cylinder_list generated")
+                returncodes[idx] = job['returncode']
+                print(f'[OBS] Repetition {idx} is {job["status"]}, see {job["path_stderr"]}')
+
+        return returncodes
+
+    def generate_cylinders_lists(self, n, n_jobs=1, scheduler=None):
+        """
+        Runs MC-DC_Simulator n times, n_jobs at a time (None = one per CPU).
+
+        Every repetition gets its own copy of the config file and its own output
+        directory, so that concurrent runs do not overwrite each other. The output
+        of repetition idx is moved to path_substrates and tagged rep_{idx}.
+        Each repetition is a separate MC-DC process; the pool only waits on them.
+
+        With a scheduler (src.mcdc_scheduler.MCDCScheduler), the repetitions are
+        queued in it instead and run within its core budget; n_jobs is ignored.
+
+        Returns the return codes of the repetitions (None if a repetition has
+        not run).
+        """
+
+        if scheduler != None:
+            returncodes = self._generate_cylinders_lists_with_scheduler(n, scheduler)
+        else:
+            returncodes = self._generate_cylinders_lists_with_pool(n, n_jobs)
+
+        n_failed = sum([returncode != 0 for returncode in returncodes])
+        print(n - n_failed, " cylinder_list generated")
+        if n_failed > 0:
+            print(f'[OBS] {n_failed} of {n} repetitions failed. Their output is kept in {self.path_substrates}/repetition_*')
+
+        return returncodes
+
+    def _generate_cylinders_lists_with_pool(self, n, n_jobs):
+
+        if n_jobs == None:
+            n_jobs = os.cpu_count()
+
+        returncodes = [None] * n
+
+        print("Generating CylindersLists...")
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+
+            futures = {executor.submit(self._run_repetition, idx): idx for idx in range(n)}
+
+            for future in tqdm(as_completed(futures), total=n):
+
+                idx = futures[future]
+                process = future.result()
+                returncodes[idx] = process.returncode
+
+                if process.returncode != 0:
+                    print(f'[OBS] Repetition {idx} failed with return code {process.returncode}:')
+                    print(process.stderr.strip() or process.stdout.strip())
+
+        return returncodes
 
     #### Loading
 
@@ -1,6 +1,14 @@
 import os
 import math
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+sys.path.append('../')
+from src import ply_utils
 
 class GenerateMCDCConfigFile():
     """
@@ -38,7 +46,8 @@ class GenerateMCDCConfigFile():
 
     def __init__(self, path_file, allow_overwrite=False, **kwargs):
         """
-
+        The document is built in memory and written to path_file in one go by
+        write_file. An existing path_file is only replaced if allow_overwrite.
         """
 
         self.parameters_simple = kwargs['parameters_simple']
@@ -48,23 +57,16 @@ class GenerateMCDCConfigFile():
         self.names_parameters_complex = []
 
         self.path_file = path_file
+        self.allow_overwrite = allow_overwrite
+
+        self.lines = []
 
-        #### create file
-        if not os.path.exists(self.path_file):
-            # os.makedirs(os.path.dirname(self.path_file), exist_ok=False)
-            with open(self.path_file, 'w'):
-                pass
-        elif os.path.exists(self.path_file) and allow_overwrite == True:
-            os.makedirs(os.path.dirname(self.path_file), exist_ok=True)
-            with open(self.path_file, 'w'):
-                pass
-        else:
+        if os.path.exists(self.path_file) and allow_overwrite == False:
             print(f'{self.path_file} already exists and allow_overwrite = {allow_overwrite}...')
 
     def _write_content_to_file(self, content):
 
-        with open(self.path_file, 'a') as f:
-            f.write(content+'\n')
+        self.lines.append(content)
 
     def _write_complex(self, key, value):
 
@@ -81,7 +83,9 @@ class GenerateMCDCConfigFile():
                 self._write_content_to_file(content)
         self._write_content_to_file(f'</{key}>')
 
-    def write_file(self):
+    def get_content(self):
+
+        self.lines = []
 
         #### write simple parameters
         for key, value in self.parameters_simple.items():
@@ -97,6 +101,298 @@ class GenerateMCDCConfigFile():
 
         self._write_content_to_file('<END>')
 
+        return '\n'.join(self.lines) + '\n'
+
+    def write_file(self):
+        """
+        Writes the whole document to a temporary file next to path_file and
+        renames it, so that path_file is never left half written.
+        Returns whether the file was written.
+        """
+
+        if os.path.exists(self.path_file) and self.allow_overwrite == False:
+            return False
+
+        content = self.get_content()
+
+        path_dir = os.path.dirname(self.path_file)
+        if path_dir != '':
+            os.makedirs(path_dir, exist_ok=True)
+
+        path_tmp = f'{self.path_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        with open(path_tmp, 'w') as f:
+            f.write(content)
+
+        os.replace(path_tmp, self.path_file)
+
+        return True
+
+
+def write_files(paths_files, parameters_list, allow_overwrite=False, n_workers=1):
+    """
+    Writes many MC-DC config files in one call: paths_files[i] gets
+    parameters_list[i] (a dict with 'parameters_simple' and 'parameters_complex').
+    n_workers files are written at a time (None = one per CPU).
+
+    Returns whether each file was written.
+    """
+
+    def write(path_file, parameters):
+        return GenerateMCDCConfigFile(path_file, allow_overwrite=allow_overwrite, **parameters).write_file()
+
+    if n_workers == 1:
+        return [write(path_file, parameters) for path_file, parameters in zip(paths_files, parameters_list)]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(write, paths_files, parameters_list))
+
+
+def get_path_config_file(path_mesh, path_pattern_out):
+
+    """
+    .../{substrate}/{folder}/{tag}.ply -> {path_pattern_out}/{substrate}/{tag}.conf
+    """
+
+    name_substrate_master = path_mesh.split('/')[-3]
+    tag_phantom = path_mesh.split('/')[-1].replace('.ply', '')
+
+    return os.path.join(path_pattern_out, name_substrate_master, tag_phantom) + '.conf'
+
+
+def get_compartment(path_mesh):
+
+    """
+    Where the particles of a mesh are initialised: 'intra' for axons and inner
+    tubes, 'extra' for outer tubes, None for other meshes (e.g. myelin).
+    """
+
+    if ('axon' in path_mesh.lower()) or ('-inner.ply' in path_mesh):
+        return 'intra'
+    elif '-outer.ply' in path_mesh:
+        return 'extra'
+
+    return None
+
+
+def close_mesh(vertices, faces):
+
+    """
+    Closes the open ends of a triangle mesh (e.g. the ends of WMG axons, which
+    are left open) by a fan from the centroid of each boundary loop, which is
+    exact for planar ends. Returns the vertices and faces of the closed mesh.
+    """
+
+    #### boundary edges: directed edges whose reverse is in no face
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    n_vertices = len(vertices)
+    keys = edges[:, 0] * n_vertices + edges[:, 1]
+    keys_reversed = edges[:, 1] * n_vertices + edges[:, 0]
+    edges_boundary = edges[~np.isin(keys, keys_reversed)]
+
+    if len(edges_boundary) == 0:
+        return vertices, faces
+
+    # one loop per connected component of the boundary edges
+    graph = coo_matrix((np.ones(len(edges_boundary)), (edges_boundary[:, 0], edges_boundary[:, 1])), shape=(n_vertices, n_vertices))
+    n_loops, labels = connected_components(graph, directed=False)
+
+    idxs_vertices = np.unique(edges_boundary)
+    counts = np.bincount(labels[idxs_vertices], minlength=n_loops)
+    centroids = np.stack([np.bincount(labels[idxs_vertices], weights=vertices[idxs_vertices, i], minlength=n_loops) for i in range(3)], axis=-1)
+    centroids /= np.maximum(counts, 1)[:, None]
+
+    # the caps have the opposite orientation of the boundary edges
+    faces_caps = np.stack([n_vertices + labels[edges_boundary[:, 0]], edges_boundary[:, 1], edges_boundary[:, 0]], axis=-1)
+
+    return np.concatenate([vertices, centroids]), np.concatenate([faces, faces_caps])
+
+
+def get_volume_of_mesh(vertices, faces):
+
+    """
+    Enclosed volume of a triangle mesh as the sum of the signed volumes of the
+    tetrahedra spanned by the origin and each face. Open ends are closed first,
+    see close_mesh.
+    """
+
+    if len(faces) == 0:
+        return 0.0
+
+    vertices, faces = close_mesh(vertices, faces)
+
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+
+    return abs(np.sum(np.einsum('ij,ij->i', v0, np.cross(v1, v2)))) / 6
+
+
+def clip_polygon(polygon, axis, value, sign):
+
+    """
+    Part of a planar polygon (Sutherland-Hodgman) with sign * (p[axis] - value) >= 0.
+    """
+
+    clipped = []
+
+    for i in range(len(polygon)):
+
+        p, q = polygon[i], polygon[(i+1) % len(polygon)]
+        d_p, d_q = sign * (p[axis] - value), sign * (q[axis] - value)
+
+        if d_p >= 0:
+            clipped.append(p)
+        if (d_p >= 0) != (d_q >= 0):
+            clipped.append(p + (q - p) * (d_p / (d_p - d_q)))
+
+    return clipped
+
+
+def get_flux_above(triangles, lims_xy, z_min):
+
+    """
+    Volume enclosed by the closed mesh of triangles (n, 3, 3) within the
+    column lims_xy = [xmin, xmax, ymin, ymax] above z_min, by the divergence
+    theorem with the field (0, 0, z - z_min): it has no flux through the sides
+    of the column nor through its bottom, so only the triangles clipped to the
+    column are summed, without its caps. Signed by the orientation of the mesh.
+    """
+
+    # (axis, value, sign) of the half-spaces of the column
+    planes = [(0, lims_xy[0], 1), (0, lims_xy[1], -1), (1, lims_xy[2], 1), (1, lims_xy[3], -1), (2, z_min, 1)]
+
+    distances = np.stack([sign * (triangles[:, :, axis] - value) for axis, value, sign in planes], axis=-1)
+
+    inside = np.all(distances >= 0, axis=(1, 2))
+    outside = np.any(np.all(distances < 0, axis=1), axis=-1)
+
+    def get_flux(p0, p1, p2):
+        areas_xy = 0.5 * ((p1[..., 0] - p0[..., 0]) * (p2[..., 1] - p0[..., 1]) - (p1[..., 1] - p0[..., 1]) * (p2[..., 0] - p0[..., 0]))
+        return np.sum(((p0[..., 2] + p1[..., 2] + p2[..., 2]) / 3 - z_min) * areas_xy)
+
+    flux = get_flux(triangles[inside, 0], triangles[inside, 1], triangles[inside, 2])
+
+    # the few triangles crossing the column are clipped one by one
+    for triangle in triangles[~inside & ~outside]:
+
+        polygon = list(triangle)
+
+        for axis, value, sign in planes:
+            polygon = clip_polygon(polygon, axis, value, sign)
+            if len(polygon) < 3:
+                break
+
+        if len(polygon) >= 3:
+            polygon = np.array(polygon)
+            flux += get_flux(polygon[0], polygon[1:-1], polygon[2:])
+
+    return flux
+
+
+def get_volume_of_mesh_in_voxel(vertices, faces, voxel_lims):
+
+    """
+    Volume of the mesh clipped to the voxel [xmin, xmax, ymin, ymax, zmin, zmax],
+    for any orientation or shape of the mesh. Open ends are closed first, see
+    close_mesh.
+    """
+
+    if len(faces) == 0:
+        return 0.0
+
+    vertices, faces = close_mesh(vertices, faces)
+    triangles = vertices[faces]
+
+    volume = get_flux_above(triangles, voxel_lims[:4], voxel_lims[4]) - get_flux_above(triangles, voxel_lims[:4], voxel_lims[5])
+
+    return abs(volume)
+
+
+def write_config_file_of_measured_mesh(path_mesh, path_pattern_out, density_particles, T,
+                                       duration, diffusivity, num_process, path_scheme_file,
+                                       buffer_sampling_area, scale=1e-3, voxel_lims=None):
+
+    """
+    write_config_file, but with the number of particles computed from the
+    volume of the mesh itself rather than from the parameters in its filename:
+
+        intra   N = density_particles * volume of the mesh inside the voxel
+        extra   N = density_particles * (voxel volume - volume of the mesh inside the voxel)
+
+    Both use the share of the mesh inside the voxel, so that the particle
+    densities of the two compartments match for meshes that stick out of it.
+
+    The .ply-header is read once, up to end_header.
+
+    Returns the path of the config file and the number of particles, or None if
+    the config file already exists or the mesh has no compartment.
+    """
+
+    path_config_file = get_path_config_file(path_mesh, path_pattern_out)
+    compartment = get_compartment(path_mesh)
+
+    if os.path.exists(path_config_file) or (compartment == None):
+        return None
+
+    header = ply_utils.read_header(path_mesh)
+
+    if voxel_lims == None:
+        voxel_lims = ply_utils.get_voxel_lims(header)
+        if voxel_lims == None:
+            raise ValueError(f'{path_mesh} has no voxel_* comments and no voxel_lims were given')
+
+    vertices, faces = ply_utils.load_ply(path_mesh, header=header)
+    volume_in_voxel = get_volume_of_mesh_in_voxel(vertices, faces, voxel_lims)
+
+    if compartment == 'intra':
+        N_particles = int(np.ceil(volume_in_voxel * density_particles))
+    else:
+        voxel_volume = np.prod(np.array(voxel_lims[1::2]) - np.array(voxel_lims[0::2]))
+        N_particles = int(np.ceil(max(voxel_volume - volume_in_voxel, 0.0) * density_particles))
+
+    path_config_file = write_config_file(path_mesh, path_pattern_out, density_particles, T,
+                                         duration, diffusivity, num_process, path_scheme_file,
+                                         buffer_sampling_area, scale=scale, voxel_lims=voxel_lims,
+                                         N_particles=N_particles)
+
+    return path_config_file, N_particles
+
+
+def write_config_files_of_directory(path_meshes, path_pattern_out, density_particles, T,
+                                    duration, diffusivity, num_process, path_scheme_file,
+                                    buffer_sampling_area, scale=1e-3, voxel_lims=None,
+                                    n_workers=None):
+
+    """
+    Writes the MC-DC config files of every intra/extra .ply in path_meshes
+    (see write_config_file_of_measured_mesh) on a pool of n_workers processes
+    (None = one per CPU). Existing config files are skipped.
+
+    Returns {path_mesh: (path_config_file, N_particles)} of the written files.
+    """
+
+    paths_mesh = sorted([os.path.join(path_meshes, n).replace('\\', '/') for n in os.listdir(path_meshes)
+                         if n.endswith('.ply') and (get_compartment(n) != None)])
+
+    arguments = [path_pattern_out, density_particles, T, duration, diffusivity, num_process,
+                 path_scheme_file, buffer_sampling_area, scale, voxel_lims]
+
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {path_mesh: executor.submit(write_config_file_of_measured_mesh, path_mesh, *arguments)
+                   for path_mesh in paths_mesh}
+
+        for path_mesh, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'[OBS] Failed to write the config file of {path_mesh}: {e}')
+                continue
+            if result != None:
+                results[path_mesh] = result
+
+    return results
+
 
 def write_config_file(path_mesh, path_pattern_out, density_particles, T,
                       duration, diffusivity, num_process, path_scheme_file,
@@ -106,18 +402,12 @@ def write_config_file(path_mesh, path_pattern_out, density_particles, T,
     if type(buffer_sampling_area) != list:
         buffer_sampling_area = [buffer_sampling_area, buffer_sampling_area, buffer_sampling_area]
 
-    name_substrate_master = path_mesh.split('/')[-3]
+    path_config_file = get_path_config_file(path_mesh, path_pattern_out)
+    path_pattern_out_oi = os.path.dirname(path_config_file)
+    tag_phantom = os.path.basename(path_config_file).replace('.conf', '')
 
-    # path_pattern_out_oi = path_pattern_out + name_substrate_master + '/'
-    path_pattern_out_oi = os.path.join(path_pattern_out, name_substrate_master)
-    # if not os.path.exists(path_pattern_out_oi):
-    #     os.system(f'mkdir -p {path_pattern_out_oi}')
     if not os.path.exists(path_pattern_out_oi):
-        os.makedirs(path_pattern_out_oi)
-
-    tag_phantom = path_mesh.split('/')[-1].replace('.ply', '')
-
-    path_config_file = os.path.join(path_pattern_out_oi, tag_phantom)+'.conf'#f'{path_pattern_out_oi}{ply_tag}.conf'
+        os.makedirs(path_pattern_out_oi, exist_ok=True)
 
     if os.path.exists(path_config_file):
         print(f'{path_config_file} already exists and will therefore be skipped...')
@@ -125,23 +415,9 @@ def write_config_file(path_mesh, path_pattern_out, density_particles, T,
 
     if voxel_lims == None:
         #### get voxel specs from .ply-header
-        with open(path_mesh, 'r') as file:
-            for line in file:
-                if 'voxel_xmin' in line:
-                    voxel_xmin = float(line.strip().split('voxel_xmin=')[-1])
-                if 'voxel_ymin' in line:
-                    voxel_ymin = float(line.strip().split('voxel_ymin=')[-1])
-                if 'voxel_zmin' in line:
-                    voxel_zmin = float(line.strip().split('voxel_zmin=')[-1])
-                if 'voxel_xmax' in line:
-                    voxel_xmax = float(line.strip().split('voxel_xmax=')[-1])
-                if 'voxel_ymax' in line:
-                    voxel_ymax = float(line.strip().split('voxel_ymax=')[-1])
-                if 'voxel_zmax' in line:
-                    voxel_zmax = float(line.strip().split('voxel_zmax=')[-1])
-    else:
-        voxel_xmin, voxel_xmax, voxel_ymin, voxel_ymax, voxel_zmin, voxel_zmax = voxel_lims
+        voxel_lims = ply_utils.get_voxel_lims(ply_utils.read_header(path_mesh))
 
+    voxel_xmin, voxel_xmax, voxel_ymin, voxel_ymax, voxel_zmin, voxel_zmax = voxel_lims
 
     # compute volume of unit cell
     voxel_length_x = voxel_xmax - voxel_xmin
@@ -149,22 +425,19 @@ def write_config_file(path_mesh, path_pattern_out, density_particles, T,
     voxel_length_z = voxel_zmax - voxel_zmin
     voxel_volume = voxel_length_x * voxel_length_y * voxel_length_z
 
-    if 'axon' in path_mesh.lower():
-        compartment = 'intra'
-        N_particles = N_particles
-    else:
+    compartment = get_compartment(path_mesh)
+
+    if (N_particles == None) and ('axon' not in path_mesh.lower()):
         #icvf = float(path_mesh.split('icvf=')[-1].split('-')[0])
         ecvf = float(path_mesh.split('ecvf=')[-1].split('-')[0])
         icvf = 1 - ecvf
         g_ratio = float(path_mesh.split('g_ratio=')[-1].split('-')[0])
         r_tube_outer = float(path_mesh.split('r_tube_outer=')[-1].split('/')[0])
 
-        if '-outer.ply' in path_mesh:
-            compartment = 'extra'
+        if compartment == 'extra':
             # print('extra volume', voxel_volume * (1.0 - icvf))
             N_particles = int(np.ceil(voxel_volume * (1.0 - icvf) * density_particles))
-        elif '-inner.ply' in path_mesh:
-            compartment = 'intra'
+        elif compartment == 'intra':
             icvf_corrected = math.pi * (r_tube_outer * g_ratio)**2 * 2 * voxel_length_z / voxel_volume # because icvf in path is actually also myelin compartment. FIX THAT!
             # mvf = (math.pi * (r_tube_outer)**2 - math.pi * (r_tube_outer * g_ratio)**2) * 2 * voxel_length_z # for checking
             # print('intra volume', voxel_volume * icvf_corrected)
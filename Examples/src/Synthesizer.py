@@ -0,0 +1,906 @@
+"""
+NumPy port of the optimisation in the core of the white-matter-generator
+(core/src/synthesizer.ts, axon.ts and ellipsoid.ts), so that phantoms can be
+optimised in-process instead of through the CLI:
+
+    synthesizer = Synthesizer(config)   # a SynthesizerJSON, e.g. a config_output_*.json
+    for i in range(100):
+        avf, cvf = synthesizer.update(growSpeed, contractSpeed, minimumDistance, 0.0001, border)
+    config = synthesizer.get_config()
+
+The ellipsoids of all axons are kept in flat arrays; the ellipsoids of axon i
+are positions[offsets[i]:offsets[i+1]] (as in src.config_arrays_utils).
+shapes are the matrices S of the core (an ellipsoid is pos + S y, |y| <= 1),
+so the "shape" lists of the JSON are the column-major elements of S, i.e.
+reshaped to (3, 3) and transposed, like the ellipsoid_shapes of
+src.config_arrays_utils.
+
+The steps are the ones of the core, with two differences:
+    - collisions are resolved for all candidate pairs at once, in rounds of
+      pairs that share no ellipsoid, rather than one pair at a time in the
+      order of the collision trees
+    - random numbers come from numpy, so a run is not identical to a CLI-run
+      with the same randomSeed
+"""
+
+import sys
+import numpy as np
+
+sys.path.append('../')
+from src.broad_phase import UniformGrid, get_boxes
+
+
+
+#### MAPPINGS ####
+
+class Mapping():
+
+    """
+    Piecewise linear map of mapping.ts, e.g. mapFromMaxDiameterToMinDiameter.
+    Outside the given points, the first/last segment is extrapolated.
+    """
+
+    def __init__(self, mapping):
+
+        self.x = np.array(mapping['from'], dtype=np.float64)
+        self.y = np.array(mapping['to'], dtype=np.float64)
+
+    def map(self, x):
+
+        x = np.asarray(x, dtype=np.float64)
+
+        if len(self.x) == 1:
+            return np.full(x.shape, self.y[0])
+
+        idxs = np.clip(np.searchsorted(self.x, x, side='right') - 1, 0, len(self.x) - 2)
+        x0, x1, y0, y1 = self.x[idxs], self.x[idxs+1], self.y[idxs], self.y[idxs+1]
+
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+    def to_json(self):
+
+        return {'from' : self.x.tolist(), 'to' : self.y.tolist()}
+
+
+
+#### GEOMETRY ####
+
+def normalize(vectors):
+
+    """
+    Vector3.normalize of three.js: zero vectors stay zero.
+    """
+
+    lengths = np.sqrt(np.einsum('...i,...i->...', vectors, vectors))[..., None]
+
+    return vectors / np.where(lengths > 0, lengths, 1)
+
+
+
+def get_supports(shapes, axes):
+
+    """
+    extremum(shape, axis).dot(axis) of helperFunctions.ts, i.e. how far the
+    ellipsoids reach along the unit axes.
+    """
+
+    a = np.einsum('...ji,...j->...i', shapes, axes)
+    lengths = np.sqrt(np.einsum('...i,...i->...', a, a))
+
+    return np.where(lengths > 0.00001, lengths, lengths**2)
+
+
+
+def get_axis_overlaps(params, d, shapes_a, shapes_b):
+
+    """
+    axisOverlap of collisionAxis: overlap of the ellipsoids a and b (d = pos_a - pos_b)
+    along the (not yet normalised) axes params.
+    """
+
+    axes = normalize(params)
+
+    return np.einsum('ij,ij->i', d, axes) + get_supports(shapes_a, axes) + get_supports(shapes_b, axes)
+
+
+
+def nelder_mead(f, x0, max_iterations=None, non_zero_delta=1.05, zero_delta=0.001,
+                min_error_delta=1e-6, min_tolerance=1e-5, rho=1, chi=2, psi=-0.5, sigma=0.5):
+
+    """
+    Nelder-Mead of the fmin package that the core uses, for many problems at
+    once. f(x, idxs) evaluates the points x of the problems idxs, x0 holds
+    the start of each problem. Problems that have converged are dropped from
+    the iterations.
+
+    Returns the minimum and the value there of each problem.
+    """
+
+    n_problems, N = x0.shape
+    if max_iterations == None:
+        max_iterations = 200 * N
+
+    idxs_all = np.arange(n_problems)
+
+    simplex = np.repeat(x0[:, None, :], N + 1, axis=1).astype(np.float64)
+    for i in range(N):
+        simplex[:, i+1, i] = np.where(simplex[:, i+1, i] != 0, simplex[:, i+1, i] * non_zero_delta, zero_delta)
+
+    fx = np.stack([f(simplex[:, i], idxs_all) for i in range(N + 1)], axis=1)
+
+    active = idxs_all
+
+    for iteration in range(max_iterations):
+
+        S, F = simplex[active], fx[active]
+
+        order = np.argsort(F, axis=1, kind='stable')
+        S = np.take_along_axis(S, order[:, :, None], axis=1)
+        F = np.take_along_axis(F, order, axis=1)
+
+        simplex[active], fx[active] = S, F
+
+        max_diff = np.max(np.abs(S[:, 0] - S[:, 1]), axis=-1)
+        converged = (np.abs(F[:, 0] - F[:, N]) < min_error_delta) & (max_diff < min_tolerance)
+
+        active, S, F = active[~converged], S[~converged], F[~converged]
+
+        if len(active) == 0:
+            break
+
+        centroid = np.mean(S[:, :N], axis=1)
+        worst, f_worst = S[:, N], F[:, N]
+
+        reflected = (1 + rho) * centroid - rho * worst
+        f_reflected = f(reflected, active)
+
+        new, f_new = reflected.copy(), f_reflected.copy()
+        reduce = np.zeros(len(active), dtype=bool)
+
+        # the reflected point is the best so far: possibly expand
+        expand = f_reflected < F[:, 0]
+        if np.any(expand):
+            expanded = (1 + chi) * centroid[expand] - chi * worst[expand]
+            f_expanded = f(expanded, active[expand])
+            better = f_expanded < f_reflected[expand]
+            new[expand] = np.where(better[:, None], expanded, reflected[expand])
+            f_new[expand] = np.where(better, f_expanded, f_reflected[expand])
+
+        # the reflected point is worse than the second worst: contract
+        contract = (~expand) & (f_reflected >= F[:, N-1])
+        if np.any(contract):
+            inside = f_reflected[contract] > f_worst[contract]
+            c, w = centroid[contract], worst[contract]
+            contracted = np.where(inside[:, None], (1 + psi) * c - psi * w, (1 - psi * rho) * c + psi * rho * w)
+            f_contracted = f(contracted, active[contract])
+            accept = np.where(inside, f_contracted < f_worst[contract], f_contracted < f_reflected[contract])
+            new[contract] = contracted
+            f_new[contract] = f_contracted
+            reduce[np.flatnonzero(contract)[~accept]] = True
+
+        S[:, N] = np.where(reduce[:, None], S[:, N], new)
+        F[:, N] = np.where(reduce, F[:, N], f_new)
+
+        if np.any(reduce) and (sigma < 1):
+            S_reduce = S[reduce]
+            for i in range(1, N + 1):
+                S_reduce[:, i] = (1 - sigma) * S_reduce[:, 0] + sigma * S_reduce[:, i]
+            S[reduce] = S_reduce
+            F_reduce = F[reduce]
+            for i in range(1, N + 1):
+                F_reduce[:, i] = f(S_reduce[:, i], active[reduce])
+            F[reduce] = F_reduce
+
+        simplex[active], fx[active] = S, F
+
+    idxs_best = np.argmin(fx, axis=1)
+
+    return simplex[idxs_all, idxs_best], fx[idxs_all, idxs_best]
+
+
+
+def get_collision_axes(d, shapes_a, shapes_b, axes_init, max_overlap, max_iterations=None):
+
+    """
+    collisionAxis of helperFunctions.ts for many pairs (d = pos_a - pos_b).
+    Pairs with a cached axis (rows of axes_init that are not NaN) whose overlap
+    is below max_overlap keep it; all others search the axis of largest
+    separation (smallest overlap), starting from the cached axis or from the
+    axis between the centres. max_iterations caps the search (None = that of
+    fmin); a capped search may overestimate the overlap, never underestimate it.
+
+    Returns the overlap and the unit axis of each pair.
+    """
+
+    axes = normalize(-d)
+    overlaps = np.full(len(d), np.nan)
+
+    has_init = ~np.any(np.isnan(axes_init), axis=-1)
+    if np.any(has_init):
+        overlaps[has_init] = get_axis_overlaps(axes_init[has_init], d[has_init], shapes_a[has_init], shapes_b[has_init])
+        axes[has_init] = axes_init[has_init]
+
+    search = ~(has_init & (overlaps < max_overlap))
+
+    if np.any(search):
+        d_s, shapes_a_s, shapes_b_s = d[search], shapes_a[search], shapes_b[search]
+        f = lambda x, idxs: get_axis_overlaps(x, d_s[idxs], shapes_a_s[idxs], shapes_b_s[idxs])
+        x, fx = nelder_mead(f, axes[search], max_iterations=max_iterations)
+        axes[search] = normalize(x)
+        overlaps[search] = fx
+
+    return overlaps, axes
+
+
+
+def project_onto_cube(positions, directions, size):
+
+    """
+    projectOntoCube of helperFunctions.ts: where the lines from positions along
+    directions leave the voxel.
+    """
+
+    signs = np.where(directions > 0, 1.0, -1.0)
+    small = np.abs(directions) < 0.00001
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scalars = np.where(small, 1e10, (signs * size / 2 - positions) / np.where(small, 1, directions))
+
+    points = positions[:, None, :] + directions[:, None, :] * scalars[:, :, None]
+    dists = np.einsum('nkj,nj->nk', points - positions[:, None, :], directions)
+
+    idxs = np.where((dists[:, 0] < dists[:, 1]) & (dists[:, 0] < dists[:, 2]), 0,
+                    np.where(dists[:, 1] < dists[:, 2], 1, 2))
+
+    return points[np.arange(len(points)), idxs]
+
+
+
+#### SYNTHESIZER ####
+
+class Synthesizer():
+
+    def __init__(self, config, seed=None):
+        """
+        config is a SynthesizerJSON (the input or output config of the CLI).
+        Axons are seeded as in createAxon and, if the config holds ellipsoids,
+        take over their positions and shapes as in createSynthesizer.
+        """
+
+        self.config = config
+        self.rng = np.random.default_rng(seed if seed != None else config.get('randomSeed', None))
+
+        voxelSize = config['voxelSize']
+        self.voxel_size = np.array([voxelSize]*3 if np.isscalar(voxelSize) else voxelSize, dtype=np.float64)
+
+        self.deformation = Mapping(config['mapFromDiameterToDeformationFactor'])
+        self.min_diameter = Mapping(config['mapFromMaxDiameterToMinDiameter'])
+        self.ellipsoid_separation = Mapping(config['mapFromMaxDiameterToEllipsoidSeparation'])
+
+        self._init_axons(config.get('axons', []))
+        self._init_cells(config.get('cells', []))
+
+        self._cache_keys = np.zeros(0, dtype=np.int64)
+        self._cache_axes = np.zeros((0, 3))
+        self._grid = None
+
+    def _init_axons(self, axons):
+
+        n_axons = len(axons)
+
+        positions = np.array([axon['position'] for axon in axons], dtype=np.float64).reshape((-1, 3))
+        directions = np.array([axon['direction'] for axon in axons], dtype=np.float64).reshape((-1, 3))
+        radii = np.array([axon['maxDiameter'] / 2 for axon in axons], dtype=np.float64)
+
+        self.g_ratios = np.array([axon.get('gRatio', 1) or 1 for axon in axons], dtype=np.float64)
+        self.colors = [axon.get('color', None) or self._get_random_color() for axon in axons]
+
+        self.starts = project_onto_cube(positions, directions, self.voxel_size)
+        self.ends = project_onto_cube(positions, -directions, self.voxel_size)
+        self.densities = 1 / self.ellipsoid_separation.map(radii * 2)
+        self.radii = radii / self.g_ratios
+
+        #### a straight chain of two ellipsoids per axon, redistributed
+        self.offsets = np.arange(n_axons + 1, dtype=np.int64) * 2
+        self.positions = np.stack([self.starts, self.ends], axis=1).reshape((-1, 3))
+        radii_ellipsoids = np.repeat(self.radii, 2)
+        self.shapes = np.eye(3)[None, :, :] * (self.min_diameter.map(radii_ellipsoids * 2) / 2)[:, None, None]
+
+        self.redistribute()
+
+        #### continue from the ellipsoids of the config
+        counts_config = np.array([len(axon.get('ellipsoids', []) or []) for axon in axons], dtype=np.int64)
+        has_ellipsoids = counts_config >= 2
+
+        if not np.any(has_ellipsoids):
+            return
+
+        offsets_config = np.zeros(n_axons + 1, dtype=np.int64)
+        offsets_config[1:] = np.cumsum(counts_config)
+
+        positions_config = np.array([e['position'] for axon in axons for e in (axon.get('ellipsoids', []) or [])], dtype=np.float64).reshape((-1, 3))
+        shapes_config = np.array([e['shape'] for axon in axons for e in (axon.get('ellipsoids', []) or [])], dtype=np.float64).reshape((-1, 3, 3)).transpose((0, 2, 1))
+
+        counts = np.diff(self.offsets)
+        idxs_axons = np.repeat(np.arange(n_axons), counts)
+        idxs_local = np.arange(len(self.positions)) - self.offsets[idxs_axons]
+
+        mask = has_ellipsoids[idxs_axons]
+        m = counts_config[idxs_axons][mask]
+        t = (m - 1) * (idxs_local[mask] / (counts[idxs_axons][mask] - 1))
+        idxs = np.minimum(np.floor(t).astype(np.int64), m - 2)
+        w = t - idxs
+        idxs += offsets_config[idxs_axons][mask]
+
+        self.positions[mask] = positions_config[idxs] * (1 - w)[:, None] + positions_config[idxs+1] * w[:, None]
+        self.shapes[mask] = shapes_config[idxs] * (1 - w)[:, None, None] + shapes_config[idxs+1] * w[:, None, None]
+
+    def _init_cells(self, cells):
+
+        self.cell_positions = np.array([cell['position'] for cell in cells], dtype=np.float64).reshape((-1, 3))
+        self.cell_shapes = np.array([cell['shape'] for cell in cells], dtype=np.float64).reshape((-1, 3, 3)).transpose((0, 2, 1))
+        self.cell_radii = np.cbrt(np.linalg.det(self.cell_shapes)) if len(cells) > 0 else np.zeros(0)
+        self.cell_colors = [cell.get('color', None) or self._get_random_color() for cell in cells]
+
+    def _get_random_color(self):
+
+        return '#' + '%06x' % self.rng.integers(0, 16**6)
+
+    def get_axon_idxs(self):
+
+        """
+        Index of the axon of each ellipsoid.
+        """
+
+        return np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+    #### Axons
+
+    def redistribute(self):
+        """
+        axon.redistribute for all axons: places 1 + max(ceil(length * density), 1)
+        ellipsoids at equal distances along each chain, with positions and shapes
+        interpolated linearly between the old ellipsoids.
+        """
+
+        n_axons = len(self.offsets) - 1
+
+        if n_axons == 0:
+            return
+
+        idxs_axons = self.get_axon_idxs()
+        counts = np.diff(self.offsets)
+
+        # segment k of axon i joins the ellipsoids k and k+1
+        is_segment = np.ones(len(self.positions), dtype=bool)
+        is_segment[self.offsets[1:] - 1] = False
+        idxs_segments = np.flatnonzero(is_segment)
+        lengths_segments = np.linalg.norm(self.positions[idxs_segments + 1] - self.positions[idxs_segments], axis=-1)
+
+        lengths = np.bincount(idxs_axons[idxs_segments], weights=lengths_segments, minlength=n_axons)
+        counts_new = 1 + np.maximum(np.ceil(lengths * self.densities).astype(np.int64), 1)
+        d_lengths = lengths / (counts_new - 1)
+
+        offsets_new = np.zeros(n_axons + 1, dtype=np.int64)
+        offsets_new[1:] = np.cumsum(counts_new)
+        idxs_axons_new = np.repeat(np.arange(n_axons), counts_new)
+        idxs_local_new = np.arange(offsets_new[-1]) - offsets_new[idxs_axons_new]
+
+        # distance along the axon of every old and new ellipsoid, with the axons
+        # put one after another (and 1 apart) on a single line
+        bases = np.zeros(n_axons)
+        bases[1:] = np.cumsum(lengths + 1)[:-1]
+        dists_old = np.zeros(len(self.positions))
+        dists_old[idxs_segments + 1] = lengths_segments
+        dists_old = np.cumsum(dists_old)
+        dists_old -= dists_old[self.offsets[:-1]][idxs_axons]
+        dists_new = idxs_local_new * d_lengths[idxs_axons_new]
+
+        # the old segment every new ellipsoid falls into (the last one at most)
+        is_inner = np.ones(len(self.positions), dtype=bool)
+        is_inner[self.offsets[:-1]] = False
+        is_inner[self.offsets[1:] - 1] = False
+        idxs_inner = np.flatnonzero(is_inner)
+        n_inner_before = np.zeros(n_axons + 1, dtype=np.int64)
+        n_inner_before[1:] = np.cumsum(np.maximum(counts - 2, 0))
+
+        idxs = np.searchsorted(dists_old[idxs_inner] + bases[idxs_axons[idxs_inner]], dists_new + bases[idxs_axons_new], side='right')
+        idxs = self.offsets[:-1][idxs_axons_new] + idxs - n_inner_before[idxs_axons_new]
+
+        lengths_segment = np.linalg.norm(self.positions[idxs + 1] - self.positions[idxs], axis=-1)
+        w = (dists_new - dists_old[idxs]) / np.where(lengths_segment > 0, lengths_segment, 1)
+
+        self.positions = self.positions[idxs] * (1 - w)[:, None] + self.positions[idxs + 1] * w[:, None]
+        self.shapes = self.shapes[idxs] * (1 - w)[:, None, None] + self.shapes[idxs + 1] * w[:, None, None]
+        self.offsets = offsets_new
+
+        # the ellipsoids are new, so are their collision axes
+        self._cache_keys = np.zeros(0, dtype=np.int64)
+        self._cache_axes = np.zeros((0, 3))
+
+    def grow(self, amount):
+        """
+        ellipsoid.grow for all axon ellipsoids: towards the sphere of the outer
+        radius of the axon, or (amount < 0) towards that of its min diameter.
+        """
+
+        radii = self.radii[self.get_axon_idxs()]
+
+        if amount >= 0:
+            targets = radii
+        else:
+            targets = self.min_diameter.map(radii * 2) / 2
+
+        self.shapes = self.shapes * (1 - abs(amount)) + np.eye(3)[None, :, :] * (abs(amount) * targets)[:, None, None]
+
+    def contract(self, amount):
+        """
+        axon.contract for all axons: moves every inner ellipsoid towards the line
+        between its neighbours (one ellipsoid after the other, as in the core),
+        then redistributes.
+        """
+
+        counts = np.diff(self.offsets)
+
+        for i in range(1, np.max(counts, initial=0) - 1):
+
+            idxs = self.offsets[:-1][counts > i + 1] + i
+
+            p_prev, p, p_next = self.positions[idxs - 1], self.positions[idxs], self.positions[idxs + 1]
+
+            c = (p_next + p_prev) / 2 - p
+            d = normalize(p_next - p_prev)
+            c -= d * np.einsum('ij,ij->i', c, d)[:, None]
+
+            self.positions[idxs] = p + c * amount
+
+        self.redistribute()
+
+    def keep_in_voxel(self):
+        """
+        axon.keepInVoxel for all axons: inner ellipsoids are clamped to the voxel,
+        the ends are put onto the face of the voxel they are closest to.
+        """
+
+        half = self.voxel_size / 2
+
+        is_end = np.zeros(len(self.positions), dtype=bool)
+        is_end[self.offsets[:-1]] = True
+        is_end[self.offsets[1:] - 1] = True
+
+        self.positions[~is_end] = np.clip(self.positions[~is_end], -half, half)
+
+        p = self.positions[is_end]
+        dists = half - np.abs(p)
+        closest = dists == np.min(dists, axis=-1, keepdims=True)
+        self.positions[is_end] = np.where(closest, np.sign(p) * half, p)
+
+    #### Collisions
+
+    def _get_all_ellipsoids(self):
+
+        """
+        Axon ellipsoids followed by cells: positions, shapes, radii, movements
+        and group (axon index, -1 for cells).
+        """
+
+        positions = np.concatenate([self.positions, self.cell_positions])
+        shapes = np.concatenate([self.shapes, self.cell_shapes])
+        radii = np.concatenate([self.radii[self.get_axon_idxs()], self.cell_radii])
+        movements = np.concatenate([np.ones(len(self.positions)), np.zeros(len(self.cell_positions))])
+        groups = np.concatenate([self.get_axon_idxs(), np.full(len(self.cell_positions), -1)])
+
+        return positions, shapes, radii, movements, groups
+
+    def get_candidate_pairs(self, positions, shapes, groups, min_dist):
+        """
+        Pairs of ellipsoids of different axons, or of an axon and a cell, whose
+        bounding boxes (ellipsoid.boundingBox(minDist)) intersect.
+
+        The grid of src.broad_phase is kept between calls and only updated as
+        long as the ellipsoids stay the same; it is rebuilt after a
+        redistribution.
+        """
+
+        lo, hi = get_boxes(positions, shapes, min_dist)
+
+        if (self._grid == None) or (self._grid.n_boxes != len(groups)) or np.any(self._grid.groups != groups):
+            self._grid = UniformGrid()
+            return self._grid.build(lo, hi, groups)
+
+        return self._grid.update(lo, hi)
+
+    def _get_cached_axes(self, idxs_a, idxs_b):
+
+        """
+        The collision axis each pair got last time (oriented from a to b), or NaN.
+        """
+
+        axes = np.full((len(idxs_a), 3), np.nan)
+
+        if len(self._cache_keys) == 0:
+            return axes
+
+        n = len(self.positions) + len(self.cell_positions)
+        keys = np.minimum(idxs_a, idxs_b) * n + np.maximum(idxs_a, idxs_b)
+
+        idxs = np.clip(np.searchsorted(self._cache_keys, keys), 0, len(self._cache_keys) - 1)
+        found = self._cache_keys[idxs] == keys
+        axes[found] = self._cache_axes[idxs[found]]
+
+        # the cache holds the axes oriented from the lower to the higher index
+        flip = found & (idxs_a > idxs_b)
+        axes[flip] *= -1
+
+        return axes
+
+    def _set_cached_axes(self, idxs_a, idxs_b, axes):
+
+        n = len(self.positions) + len(self.cell_positions)
+        keys = np.minimum(idxs_a, idxs_b) * n + np.maximum(idxs_a, idxs_b)
+        axes = np.where((idxs_a > idxs_b)[:, None], -axes, axes)
+
+        keys = np.concatenate([keys, self._cache_keys])
+        axes = np.concatenate([axes, self._cache_axes])
+
+        # keep the newest axis of each pair
+        self._cache_keys, idxs = np.unique(keys, return_index=True)
+        self._cache_axes = axes[idxs]
+
+    def _resolve_collisions(self, positions, shapes, radii, movements, groups, idxs_a, idxs_b, overlaps, axes, min_dist):
+
+        """
+        ellipsoid.collision for pairs that share no moving ellipsoid, given their
+        overlaps and collision axes: deforms both ellipsoids along the axis and
+        pushes them apart.
+        """
+
+        p, q = positions[idxs_a], positions[idxs_b]
+        A, B = shapes[idxs_a], shapes[idxs_b]
+
+        #### (almost) coinciding centres are moved apart in a random direction
+        d = q - p
+        coincide = np.einsum('ij,ij->i', d, d) < 0.00001
+
+        if np.any(coincide):
+            r = normalize(self.rng.uniform(-1, 1, (np.sum(coincide), 3))) * 0.0001
+            positions[idxs_a[coincide]] -= r
+            positions[idxs_b[coincide]] += r
+
+        idxs_a, idxs_b = idxs_a[~coincide], idxs_b[~coincide]
+        A, B, overlaps, axes = A[~coincide], B[~coincide], overlaps[~coincide], axes[~coincide]
+
+        lengths = overlaps + min_dist
+        collide = lengths >= 0
+
+        idxs_a, idxs_b, A, B, axes, lengths = idxs_a[collide], idxs_b[collide], A[collide], B[collide], axes[collide], lengths[collide]
+
+        if len(idxs_a) == 0:
+            return
+
+        is_cell_a, is_cell_b = groups[idxs_a] == -1, groups[idxs_b] == -1
+        r1, r2 = radii[idxs_a], radii[idxs_b]
+        ratios = r2 / r1
+
+        #### update shapes
+        c1, c2 = get_supports(A, axes), get_supports(B, axes)
+
+        delta1 = np.where(is_cell_a, 0, self.deformation.map(c1 * 2) / (c1 * 2)) * np.minimum(ratios, 1)
+        delta2 = np.where(is_cell_b, 0, self.deformation.map(c2 * 2) / (c2 * 2)) * np.minimum(1 / ratios, 1)
+        mu1 = np.where(is_cell_a, 0, self.min_diameter.map(r1 * 2)) / (c1 * 2)
+        mu2 = np.where(is_cell_b, 0, self.min_diameter.map(r2 * 2)) / (c2 * 2)
+        s1 = np.maximum(-lengths * delta1, mu1 - 1)
+        s2 = np.maximum(-lengths * delta2, mu2 - 1)
+
+        outer = np.einsum('ni,nj->nij', axes, axes)
+        shapes[idxs_a] = A @ (np.eye(3)[None, :, :] + s1[:, None, None] * outer)
+        shapes[idxs_b] = B @ (np.eye(3)[None, :, :] + s2[:, None, None] * outer)
+
+        lengths = lengths + s1 * c1 + s2 * c2
+
+        #### update positions
+        m1 = movements[idxs_a] * ratios
+        m2 = movements[idxs_b]
+        w = lengths / (m1 + m2)
+
+        positions[idxs_a] -= axes * (m1 * w)[:, None]
+        positions[idxs_b] += axes * (m2 * w)[:, None]
+
+    def collision(self, min_dist, max_overlap, max_iterations_refine=20):
+        """
+        synthesizer.collision: resolves the collisions between the ellipsoids of
+        different axons and between axons and cells.
+
+        The collision axes of all candidate pairs are found first, in one
+        batch. The pairs that collide are then visited in random order and in
+        random orientation. Each round resolves, at once, the first pair of
+        every ellipsoid that is not part of an earlier pair of that round, so
+        every ellipsoid sees the result of its previous collision. Pairs keep
+        the axis of the batch unless an earlier round moved one of their
+        ellipsoids; then the axis is searched again, starting from the old one,
+        for at most max_iterations_refine iterations. Pairs that only start to
+        collide during the rounds are left to the next call.
+        """
+
+        positions, shapes, radii, movements, groups = self._get_all_ellipsoids()
+
+        idxs_a, idxs_b = self.get_candidate_pairs(positions, shapes, groups, min_dist)
+
+        overlaps, axes = get_collision_axes(positions[idxs_a] - positions[idxs_b], shapes[idxs_a], shapes[idxs_b],
+                                            self._get_cached_axes(idxs_a, idxs_b), max_overlap)
+        self._set_cached_axes(idxs_a, idxs_b, axes)
+
+        collide = overlaps + min_dist >= 0
+        idxs_a, idxs_b, overlaps, axes = idxs_a[collide], idxs_b[collide], overlaps[collide], axes[collide]
+
+        # cells are static and always the second of a pair
+        flip = ((self.rng.random(len(idxs_a)) < 0.5) & (groups[idxs_b] != -1)) | (groups[idxs_a] == -1)
+        idxs_a, idxs_b = np.where(flip, idxs_b, idxs_a), np.where(flip, idxs_a, idxs_b)
+        axes = np.where(flip[:, None], -axes, axes)
+
+        order = self.rng.permutation(len(idxs_a))
+        idxs_a, idxs_b, overlaps, axes = idxs_a[order], idxs_b[order], overlaps[order], axes[order]
+
+        is_static = groups == -1
+        moved = np.zeros(len(positions), dtype=bool)
+        pending = np.arange(len(idxs_a))
+
+        while len(pending) > 0:
+
+            ka, kb = idxs_a[pending], idxs_b[pending]
+
+            ks = np.arange(len(pending))
+            first = np.full(len(positions), len(pending))
+            np.minimum.at(first, ka, ks)
+            moving_b = ~is_static[kb]
+            np.minimum.at(first, kb[moving_b], ks[moving_b])
+
+            selected = (first[ka] == ks) & (is_static[kb] | (first[kb] == ks))
+            ks = pending[selected]
+
+            refine = ks[moved[idxs_a[ks]] | moved[idxs_b[ks]]]
+
+            if len(refine) > 0:
+                overlaps[refine], axes[refine] = get_collision_axes(
+                    positions[idxs_a[refine]] - positions[idxs_b[refine]], shapes[idxs_a[refine]], shapes[idxs_b[refine]],
+                    axes[refine], max_overlap, max_iterations=max_iterations_refine)
+
+            self._resolve_collisions(positions, shapes, radii, movements, groups,
+                                     idxs_a[ks], idxs_b[ks], overlaps[ks], axes[ks], min_dist)
+
+            moved[idxs_a[ks]] = True
+            moved[idxs_b[ks]] = ~is_static[idxs_b[ks]]
+
+            pending = pending[~selected]
+
+        self._set_cached_axes(idxs_a, idxs_b, axes)
+
+        n = len(self.positions)
+        self.positions, self.shapes = positions[:n], shapes[:n]
+        self.cell_positions, self.cell_shapes = positions[n:], shapes[n:]
+
+    def get_overlap(self, min_dist, max_overlap):
+        """
+        synthesizer.getOverlap: the largest overlap (plus min_dist) between the
+        ellipsoids of different axons, and at least max_overlap.
+        """
+
+        positions, shapes, _, _, groups = self._get_all_ellipsoids()
+
+        idxs_a, idxs_b = self.get_candidate_pairs(positions, shapes, groups, min_dist)
+
+        is_axon = groups[idxs_b] != -1
+        idxs_a, idxs_b = idxs_a[is_axon], idxs_b[is_axon]
+
+        if len(idxs_a) == 0:
+            return max_overlap
+
+        overlaps, axes = get_collision_axes(self.positions[idxs_a] - self.positions[idxs_b],
+                                            self.shapes[idxs_a], self.shapes[idxs_b],
+                                            self._get_cached_axes(idxs_a, idxs_b), max_overlap)
+        self._set_cached_axes(idxs_a, idxs_b, axes)
+
+        return max(max_overlap, np.max(np.maximum(overlaps + min_dist, 0)))
+
+    #### Volume fractions
+
+    def _get_inside(self, positions, shapes, n, border):
+
+        """
+        Which of the n^3 sample points of volumeFraction lie inside one of the
+        ellipsoids.
+        """
+
+        inside = np.zeros(n**3, dtype=bool)
+
+        if len(positions) == 0:
+            return inside
+
+        size = self.voxel_size - 2 * border
+        coords = ((np.arange(n) + 0.5) / n - 0.5)[None, :] * size[:, None]
+
+        # the range of sample points within the bounding box of each ellipsoid
+        lo, hi = get_boxes(positions, shapes, 0)
+        lo = np.clip(np.ceil((lo / size + 0.5) * n - 0.5), 0, n).astype(np.int64)
+        hi = np.clip(np.floor((hi / size + 0.5) * n - 0.5) + 1, 0, n).astype(np.int64)
+        lengths = np.maximum(hi - lo, 0)
+        counts = np.prod(lengths, axis=-1)
+
+        inverses = np.linalg.inv(shapes)
+
+        for idxs_chunk in np.array_split(np.arange(len(positions)), max(1, int(np.sum(counts) // 1000000) + 1)):
+
+            idxs = np.repeat(idxs_chunk, counts[idxs_chunk])
+            starts = np.zeros(len(idxs_chunk) + 1, dtype=np.int64)
+            starts[1:] = np.cumsum(counts[idxs_chunk])
+            k = np.arange(len(idxs)) - np.repeat(starts[:-1], counts[idxs_chunk])
+
+            lengths_i = lengths[idxs]
+            i = lo[idxs, 0] + k // (lengths_i[:, 1] * lengths_i[:, 2])
+            j = lo[idxs, 1] + (k // lengths_i[:, 2]) % lengths_i[:, 1]
+            l = lo[idxs, 2] + k % lengths_i[:, 2]
+
+            points = np.stack([coords[0, i], coords[1, j], coords[2, l]], axis=-1)
+            y = np.einsum('nij,nj->ni', inverses[idxs], points - positions[idxs])
+
+            is_inside = np.einsum('ij,ij->i', y, y) < 1
+            inside[(i * n + j)[is_inside] * n + l[is_inside]] = True
+
+        return inside
+
+    def volume_fraction(self, n, border):
+        """
+        synthesizer.volumeFraction: the fractions of n^3 points on a grid in the
+        voxel (minus border) inside an axon ellipsoid and inside a cell.
+        """
+
+        avf = np.mean(self._get_inside(self.positions, self.shapes, n, border))
+        cvf = np.mean(self._get_inside(self.cell_positions, self.cell_shapes, n, border))
+
+        return float(avf), float(cvf)
+
+    #### Update
+
+    def update(self, grow_speed, contract_speed, min_dist, max_overlap=0.0001, border=0.0):
+        """
+        One iteration of the CLI (synthesizer.update from "ready" to "ready"):
+        grow, contract, then keepInVoxel/collision until the overlap is below
+        max_overlap (100 times at most).
+
+        Returns the axon and cell volume fractions.
+        """
+
+        self.grow(grow_speed)
+
+        i = 0
+        while i < contract_speed:
+            self.contract(min(contract_speed - i, 1))
+            i += 1
+
+        for _ in range(100):
+            self.keep_in_voxel()
+            self.collision(min_dist, max_overlap)
+            if self.get_overlap(min_dist, max_overlap * 0.999) < max_overlap:
+                break
+
+        return self.volume_fraction(20, border)
+
+    def run(self, iterations, volume_fraction_target, max_iterations_without_improvement=None,
+            grow_speed=None, contract_speed=None, min_dist=None, border=None, verbose=True):
+        """
+        The optimisation loop of the CLI: runs until the target volume fraction,
+        the max number of iterations or max_iterations_without_improvement is
+        reached. The speeds, min_dist and border default to those of the config.
+
+        Returns the axon and cell volume fraction of every iteration.
+        """
+
+        grow_speed = grow_speed if grow_speed != None else self.config['growSpeed']
+        contract_speed = contract_speed if contract_speed != None else self.config['contractSpeed']
+        min_dist = min_dist if min_dist != None else self.config['minimumDistance']
+        border = border if border != None else self.config.get('border', 0.0)
+        if max_iterations_without_improvement == None:
+            max_iterations_without_improvement = iterations
+
+        volume_fractions = [0]
+        history = []
+
+        for i in range(1, iterations + 1):
+
+            avf, cvf = self.update(grow_speed, contract_speed, min_dist, 0.0001, border)
+            vf = avf + cvf
+            history.append((avf, cvf))
+
+            if verbose:
+                print(f'{i} / {iterations}: AVF = {avf:.2f}, CVF = {cvf:.2f}, TVF = {vf:.2f} / {volume_fraction_target}')
+
+            volume_fractions.append(vf)
+
+            if vf >= volume_fraction_target:
+                message = 'Target volume fraction reached'
+            elif vf <= volume_fractions[max(i - max_iterations_without_improvement, 0)]:
+                message = 'Number of max iterations without improvement reached'
+            elif i == iterations:
+                message = 'Number of max iterations reached'
+            else:
+                continue
+
+            if verbose:
+                print(message)
+            break
+
+        return np.array(history).reshape((-1, 2))
+
+    #### JSON
+
+    def get_cross_section_diameters(self):
+
+        """
+        crossSectionDiameter of every axon ellipsoid, perpendicular to the
+        direction between its neighbours.
+        """
+
+        idxs_axons = self.get_axon_idxs()
+        idxs = np.arange(len(self.positions))
+
+        idxs_next = np.minimum(idxs + 1, self.offsets[1:][idxs_axons] - 1)
+        idxs_prev = np.maximum(idxs - 1, self.offsets[:-1][idxs_axons])
+
+        axes = normalize(self.positions[idxs_next] - self.positions[idxs_prev])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 2 * np.sqrt(np.linalg.det(self.shapes) / get_supports(self.shapes, axes))
+
+    def to_json(self):
+        """
+        The SynthesizerJSON of synthesizer.toJSON.
+        """
+
+        myelin_diameters = self.get_cross_section_diameters()
+        shapes = self.shapes.transpose((0, 2, 1)).reshape((-1, 9))
+
+        axons = []
+
+        for i in range(len(self.offsets) - 1):
+
+            idxs = slice(self.offsets[i], self.offsets[i+1])
+
+            axons.append({
+                'position' : self.starts[i].tolist(),
+                'direction' : (self.ends[i] - self.starts[i]).tolist(),
+                'maxDiameter' : float(self.radii[i] * self.g_ratios[i] * 2),
+                'color' : self.colors[i],
+                'gRatio' : float(self.g_ratios[i]),
+                'ellipsoids' : [{
+                    'position' : position,
+                    'shape' : shape,
+                    'axonDiameter' : myelin_diameter * self.g_ratios[i],
+                    'myelinDiameter' : myelin_diameter,
+                } for position, shape, myelin_diameter in zip(self.positions[idxs].tolist(), shapes[idxs].tolist(), myelin_diameters[idxs].tolist())],
+            })
+
+        cells = [{
+            'position' : position,
+            'shape' : shape,
+            'color' : color,
+        } for position, shape, color in zip(self.cell_positions.tolist(), self.cell_shapes.transpose((0, 2, 1)).reshape((-1, 9)).tolist(), self.cell_colors)]
+
+        return {
+            'voxelSize' : self.voxel_size.tolist(),
+            'mapFromDiameterToDeformationFactor' : self.deformation.to_json(),
+            'mapFromMaxDiameterToMinDiameter' : self.min_diameter.to_json(),
+            'mapFromMaxDiameterToEllipsoidSeparation' : self.ellipsoid_separation.to_json(),
+            'axons' : axons,
+            'cells' : cells,
+        }
+
+    def get_config(self):
+        """
+        The config_output_*.json the CLI would write: the run parameters of the
+        input config followed by the SynthesizerJSON.
+        """
+
+        config = {key : self.config[key] for key in ['randomSeed', 'growSpeed', 'contractSpeed', 'minimumDistance', 'border'] if key in self.config}
+        config.update(self.to_json())
+
+        return config
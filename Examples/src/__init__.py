@@ -1 +0,0 @@
-from . import config_utils
@@ -0,0 +1,301 @@
+"""
+Benchmarks of the hot paths of the Examples pipeline on synthetic phantoms of
+increasing size, without MC-DC or the white-matter-generator:
+
+    python -m src.benchmark --n_axons 100 1000 10000 --path_output benchmark.json
+
+For each size a gamma-distributed cylinder list is generated and written in
+the format of the output of MC-DC, and the stages
+
+    get_axons_list                              cylinder list -> axons
+    generate_config_files                       one grid point, packed with src.cylinder_packing
+    add_cells_to_config                         cells_per_axon * n_axons cells
+    get_morphological_metrics_from_WMG_config   straight ellipsoid chains (src.Synthesizer)
+    simplify_mesh_file                          a tube mesh of one axon per n_axons (needs pygel3d)
+
+are timed, with the peak of the memory allocated meanwhile (tracemalloc, so
+what Python and NumPy allocate, not the heap of pygel3d). The results are
+written as JSON, one record per stage and size.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.append('../')
+from src import config_utils
+from src import morphology_analysis_utils
+from src.Synthesizer import Synthesizer
+
+
+
+FIBERS = {'fiber_0' : {'frac' : 1.0, 'orientation' : [0, 0, 1], 'epsilon' : 0.1}}
+
+PARAMETERS = {
+    'growSpeed' : 0.02,
+    'contractSpeed' : 0.1,
+    'minimumDistance' : 0.01,
+    'mapFromDiameterToDeformationFactor' : {'from' : [0, 1], 'to' : [0, 1]},
+    'mapFromMaxDiameterToMinDiameter' : {'from' : [0, 1], 'to' : [0, 1]},
+}
+
+
+
+#### SYNTHETIC SUBSTRATES ####
+
+def write_cylinder_list(path_output, alpha, beta, targetFVF, num_cylinders, idx_rep=0, seed=None):
+
+    """
+    Stand-in for a repetition of MC-DC: num_cylinders parallel cylinders with
+    gamma-distributed radii [um], at random in a square of side length chosen
+    so that they fill targetFVF of it (overlaps are not resolved). Writes the
+    rep_{idx_rep}_gamma_distributed_cylinder_list.txt and
+    rep_{idx_rep}_simulation_info.txt that MC-DC would write.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    radii = rng.gamma(alpha, beta, num_cylinders)
+    length = np.sqrt(np.sum(np.pi * radii**2) / targetFVF)
+
+    cylinders = np.zeros((num_cylinders, 7))
+    cylinders[:, :2] = rng.uniform(0, length, (num_cylinders, 2))
+    cylinders[:, 5] = length
+    cylinders[:, 6] = radii
+
+    os.makedirs(path_output, exist_ok=True)
+
+    with open(os.path.join(path_output, f'rep_{idx_rep:02d}_gamma_distributed_cylinder_list.txt'), 'w') as file:
+        file.write('0.001\n')
+        np.savetxt(file, cylinders, fmt='%.9g', delimiter=' ')
+
+    # the voxel corners [mm] are the last two lines
+    with open(os.path.join(path_output, f'rep_{idx_rep:02d}_simulation_info.txt'), 'w') as file:
+        file.write('Synthetic substrate\n')
+        file.write('( 0 0 0 )\n')
+        file.write(f'( {length * 1e-3:.9g} {length * 1e-3:.9g} {length * 1e-3:.9g} )\n')
+
+
+
+def write_tube_ply(path_ply, n_rings, n_segments=16, radius=1.0, length=100.0):
+
+    """
+    ASCII .ply of an open tube of n_rings rings along z, like an axon mesh of
+    the white-matter-generator.
+    """
+
+    angles = 2 * np.pi * np.arange(n_segments) / n_segments
+    zs = np.linspace(-length / 2, length / 2, n_rings)
+
+    vertices = np.zeros((n_rings, n_segments, 3))
+    vertices[:, :, 0] = radius * np.cos(angles)[None, :]
+    vertices[:, :, 1] = radius * np.sin(angles)[None, :]
+    vertices[:, :, 2] = zs[:, None]
+
+    i, j = np.meshgrid(np.arange(n_rings - 1), np.arange(n_segments), indexing='ij')
+    a = i * n_segments + j
+    b = i * n_segments + (j + 1) % n_segments
+    faces = np.concatenate([np.stack([a, b, a + n_segments], axis=-1).reshape((-1, 3)),
+                            np.stack([b, b + n_segments, a + n_segments], axis=-1).reshape((-1, 3))])
+
+    header = ['ply', 'format ascii 1.0',
+              f'comment voxel_xmin={-length / 2}', f'comment voxel_xmax={length / 2}',
+              f'comment voxel_ymin={-length / 2}', f'comment voxel_ymax={length / 2}',
+              f'comment voxel_zmin={-length / 2}', f'comment voxel_zmax={length / 2}',
+              f'element vertex {n_rings * n_segments}',
+              'property float x', 'property float y', 'property float z',
+              f'element face {len(faces)}',
+              'property list uchar int vertex_indices',
+              'end_header']
+
+    with open(path_ply, 'w') as file:
+        file.write('\n'.join(header) + '\n')
+        np.savetxt(file, vertices.reshape((-1, 3)), fmt='%.9g')
+        np.savetxt(file, np.hstack([np.full((len(faces), 1), 3), faces]), fmt='%d')
+
+
+
+#### TIMING ####
+
+def measure(f, *args, **kwargs):
+
+    """
+    Runs f and returns its result, the time [s] and the peak of the memory
+    [bytes] allocated while it ran.
+    """
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    time0 = time.perf_counter()
+
+    try:
+        result = f(*args, **kwargs)
+    finally:
+        t = time.perf_counter() - time0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, t, peak
+
+
+
+def benchmark_size(path_tmp, n_axons, cells_per_axon=0.1, ellipsoidDensityScaler=0.5, alpha=4.0, beta=0.25,
+                   targetFVF=0.7, include_meshes=True):
+
+    """
+    Times every stage for a phantom of n_axons axons. Returns one record per
+    stage.
+    """
+
+    path_substrate = os.path.join(path_tmp, f'n_axons={n_axons}')
+    records = []
+
+    def add(stage, t, peak, **counts):
+        record = {'stage' : stage, 'n_axons' : n_axons, 'time' : t, 'peak_memory' : peak}
+        record.update(counts)
+        records.append(record)
+        print(f'[LOG] {n_axons:7d} axons, {stage}: {t:.3f} s, {peak / 2**20:.1f} MiB')
+
+    #### get_axons_list
+    path_cylinders = os.path.join(path_substrate, 'cylinders')
+    write_cylinder_list(path_cylinders, alpha, beta, targetFVF, n_axons)
+    path_cylinder_list = os.path.join(path_cylinders, 'rep_00_gamma_distributed_cylinder_list.txt')
+    path_simulation_info = os.path.join(path_cylinders, 'rep_00_simulation_info.txt')
+
+    length_voxel = config_utils.get_length_voxel_isotropic(path_cylinder_list, path_simulation_info)
+
+    axons, t, peak = measure(config_utils.get_axons_list, path_cylinder_list, path_simulation_info, FIBERS,
+                             0.25, length_voxel, 0.1, g_ratio=0.7, color_mode='diameter', mode_fiber='sheets')
+    add('get_axons_list', t, peak)
+
+    #### generate_config_files
+    paths_config, t, peak = measure(
+        config_utils.generate_config_files,
+        os.path.join(path_substrate, 'configs'), [alpha], [beta], [targetFVF], [n_axons], 1, FIBERS,
+        ellipsoidDensityScaler, mode_fiber='sheets', seed=0, packer='native', **PARAMETERS)
+    add('generate_config_files', t, peak)
+
+    path_config = paths_config[0]
+
+    #### add_cells_to_config
+    n_cells = int(round(cells_per_axon * n_axons))
+
+    if n_cells > 0:
+
+        with open(path_config, 'r') as file:
+            config = json.load(file)
+
+        # CVF of n_cells spheres of diameter l1_mean
+        l_mean = 2.0
+        voxel_volume = np.prod(np.array(config['voxelSize']) - 2 * config['border'])
+        CVF = n_cells * (np.pi / 6 * l_mean**3) / voxel_volume
+
+        _, t, peak = measure(config_utils.add_cells_to_config, path_config, CVF, l_mean, 0.0, l_mean, 0.0, 0.0,
+                             max_consecutive_rejections=1000)
+        add('add_cells_to_config', t, peak, n_cells=n_cells)
+
+    #### get_morphological_metrics_from_WMG_config
+    with open(path_config, 'r') as file:
+        config = json.load(file)
+
+    config_output = Synthesizer(config, seed=0).get_config()
+    n_ellipsoids = sum([len(axon['ellipsoids']) for axon in config_output['axons']])
+
+    path_config_output = path_config.replace('.json', '_output.json')
+    with open(path_config_output, 'w') as file:
+        json.dump(config_output, file)
+
+    _, t, peak = measure(morphology_analysis_utils.get_morphological_metrics_from_WMG_config, path_config_output)
+    add('get_morphological_metrics_from_WMG_config', t, peak, n_ellipsoids=n_ellipsoids)
+
+    #### simplify_mesh_file
+    if include_meshes:
+
+        try:
+            from src import mesh_utils
+        except ImportError as e:
+            print(f'[OBS] Skipping the mesh simplification: {e}')
+            return records
+
+        n_rings = max(n_ellipsoids // max(n_axons, 1), 2) * n_axons
+        path_ply = os.path.join(path_substrate, 'tube.ply')
+        write_tube_ply(path_ply, n_rings)
+
+        _, t, peak = measure(mesh_utils.simplify_mesh_file, path_ply, path_ply.replace('.ply', '_simplified.ply'),
+                             mesh_utils.get_tolerance(PARAMETERS['minimumDistance']))
+        add('simplify_mesh_file', t, peak, n_vertices=n_rings * 16)
+
+    return records
+
+
+
+def benchmark(n_axons_list=(100, 1000, 10000), path_tmp=None, **kwargs):
+
+    """
+    benchmark_size for every number of axons, in a temporary folder that is
+    removed afterwards (unless path_tmp is given). Returns the results with
+    the versions and machine they were measured on.
+    """
+
+    remove = path_tmp == None
+    if remove:
+        path_tmp = tempfile.mkdtemp(prefix='wmg_benchmark_')
+
+    try:
+        records = []
+        for n_axons in n_axons_list:
+            records += benchmark_size(path_tmp, n_axons, **kwargs)
+    finally:
+        if remove:
+            shutil.rmtree(path_tmp, ignore_errors=True)
+
+    return {
+        'date' : datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform' : platform.platform(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'cpu_count' : os.cpu_count(),
+        'parameters' : kwargs,
+        'records' : records,
+    }
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_axons', type=int, nargs='+', default=[100, 1000, 10000], help='sizes of the phantoms')
+    parser.add_argument('--cells_per_axon', type=float, default=0.1, help='number of cells per axon')
+    parser.add_argument('--ellipsoid_density_scaler', type=float, default=0.5, help='ellipsoidDensityScaler of the configs')
+    parser.add_argument('--skip_meshes', action='store_true', help='do not benchmark the mesh simplification')
+    parser.add_argument('--path_tmp', default=None, help='folder to keep the synthetic phantoms in (default: a temporary one)')
+    parser.add_argument('--path_output', default='benchmark.json', help='.json file to write the results to')
+
+    args = parser.parse_args(argv)
+
+    results = benchmark(
+        args.n_axons,
+        path_tmp=args.path_tmp,
+        cells_per_axon=args.cells_per_axon,
+        ellipsoidDensityScaler=args.ellipsoid_density_scaler,
+        include_meshes=not args.skip_meshes,
+    )
+
+    with open(args.path_output, 'w') as file:
+        json.dump(results, file, indent=4)
+
+    print(f'[LOG] Results written to {args.path_output}')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+"""
+Broad phase of the collision detection of the white-matter-generator: which
+ellipsoids are close enough to need the separation test at all.
+
+Every ellipsoid is represented by its bounding box, ellipsoid.boundingBox(minDist)
+of the core, i.e. pos +- (row norms of the shape + minDist / 2). Boxes of the
+same group (the same axon, or two cells with group -1) are never paired.
+
+    grid = UniformGrid()
+    idxs_a, idxs_b = grid.build(lo, hi, groups)   # pairs with intersecting boxes
+    ...                                           # move some ellipsoids
+    idxs_a, idxs_b = grid.update(lo, hi)          # only moved boxes are re-binned
+
+The pairs are the same as those of get_pairs_all_boxes, which tests every box
+against every other box. To see how many pairs the grid saves:
+
+    python -m src.broad_phase --n_axons 50 100 200 400 --path_output broad_phase.json
+"""
+
+import json
+import time
+import argparse
+import numpy as np
+
+
+
+# cell coordinates are packed into one int64 key, 21 bits per axis
+N_BITS = 21
+OFFSET = 2**(N_BITS - 1)
+
+
+
+def get_boxes(positions, shapes, min_dist):
+
+    """
+    Lower and upper corners of ellipsoid.boundingBox(minDist) of every ellipsoid
+    (shapes are the matrices S of the core, an ellipsoid is pos + S y, |y| <= 1).
+    """
+
+    half_extents = np.linalg.norm(shapes, axis=-1) + min_dist / 2
+
+    return positions - half_extents, positions + half_extents
+
+
+
+def get_pairs_all_boxes(lo, hi, groups, size_chunk=256):
+
+    """
+    Pairs (i < j) of intersecting boxes [lo, hi] whose groups differ, found by
+    testing all pairs (in chunks of size_chunk rows).
+    """
+
+    idxs_i, idxs_j = [], []
+
+    for start in range(0, len(lo), size_chunk):
+
+        stop = min(start + size_chunk, len(lo))
+
+        mask = np.all((lo[start:stop, None, :] <= hi[None, start:, :]) & (lo[None, start:, :] <= hi[start:stop, None, :]), axis=-1)
+        mask &= groups[start:stop, None] != groups[None, start:]
+        mask &= np.arange(start, stop)[:, None] < np.arange(start, len(lo))[None, :]
+
+        i, j = np.nonzero(mask)
+        idxs_i.append(i + start)
+        idxs_j.append(j + start)
+
+    if len(idxs_i) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(idxs_i), np.concatenate(idxs_j)
+
+
+
+def count_pairs_all(groups):
+
+    """
+    Number of pairs of different groups, i.e. the number of separation tests
+    without any broad phase.
+    """
+
+    n = len(groups)
+    _, counts = np.unique(groups, return_counts=True)
+    counts_same = np.sum(counts * (counts - 1) // 2)
+
+    return int(n * (n - 1) // 2 - counts_same)
+
+
+
+def sort_pairs(idxs_a, idxs_b):
+
+    order = np.lexsort((idxs_b, idxs_a))
+
+    return idxs_a[order], idxs_b[order]
+
+
+
+class UniformGrid():
+
+    """
+    Uniform grid over the bounding boxes. Every box is entered into every grid
+    cell it touches; two boxes are candidates if they share a cell, and each
+    pair is only reported by the lowest cell the two have in common.
+
+    The entries are kept sorted by cell, so update only has to remove and
+    insert the entries of boxes that moved into other cells.
+    """
+
+    def __init__(self, cell_size=None):
+        """
+        cell_size is the side length of the grid cells. By default it is the
+        median of the longest side of the boxes given to build.
+        """
+
+        self.cell_size = cell_size
+        self.n_boxes = 0
+
+    def _get_cell_ranges(self, lo, hi):
+
+        return (np.floor((lo - self.origin) / self.cell_size).astype(np.int64),
+                np.floor((hi - self.origin) / self.cell_size).astype(np.int64))
+
+    def _get_entries(self, idxs_boxes):
+
+        """
+        (key, cell, box) of every cell touched by the boxes idxs_boxes.
+        """
+
+        c_lo, c_hi = self.c_lo[idxs_boxes], self.c_hi[idxs_boxes]
+        lengths = c_hi - c_lo + 1
+        counts = np.prod(lengths, axis=-1)
+
+        boxes = np.repeat(idxs_boxes, counts)
+        starts = np.zeros(len(idxs_boxes) + 1, dtype=np.int64)
+        starts[1:] = np.cumsum(counts)
+        k = np.arange(starts[-1]) - np.repeat(starts[:-1], counts)
+
+        lengths = np.repeat(lengths, counts, axis=0)
+        cells = np.repeat(c_lo, counts, axis=0)
+        cells[:, 0] += k // (lengths[:, 1] * lengths[:, 2])
+        cells[:, 1] += (k // lengths[:, 2]) % lengths[:, 1]
+        cells[:, 2] += k % lengths[:, 2]
+
+        return self._get_keys(cells), cells, boxes
+
+    def _get_keys(self, cells):
+
+        c = cells + OFFSET
+
+        return (c[:, 0] << (2 * N_BITS)) | (c[:, 1] << N_BITS) | c[:, 2]
+
+    def build(self, lo, hi, groups):
+        """
+        Enters all boxes into the grid. Returns the candidate pairs.
+        """
+
+        lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+
+        self.n_boxes = len(lo)
+        self.groups = np.asarray(groups)
+        self.lo, self.hi = lo.copy(), hi.copy()
+
+        if self.cell_size == None:
+            self.cell_size = float(np.median(np.max(hi - lo, axis=-1))) if len(lo) > 0 else 1.0
+        self.origin = np.min(lo, axis=0) if len(lo) > 0 else np.zeros(3)
+
+        self.c_lo, self.c_hi = self._get_cell_ranges(lo, hi)
+
+        keys, cells, boxes = self._get_entries(np.arange(self.n_boxes))
+        order = np.argsort(keys, kind='stable')
+        self.keys, self.cells, self.boxes = keys[order], cells[order], boxes[order]
+
+        return self.get_pairs()
+
+    def update(self, lo, hi, idxs=None):
+        """
+        Moves the boxes idxs (all by default) to [lo, hi] (given for those boxes
+        only if idxs is given). Only boxes that now touch other cells are
+        re-entered. Returns the candidate pairs.
+        """
+
+        lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+
+        if idxs is None:
+            idxs = np.arange(self.n_boxes)
+
+        self.lo[idxs], self.hi[idxs] = lo, hi
+
+        c_lo, c_hi = self._get_cell_ranges(lo, hi)
+        moved = np.any((c_lo != self.c_lo[idxs]) | (c_hi != self.c_hi[idxs]), axis=-1)
+        idxs_moved = np.asarray(idxs)[moved]
+
+        if len(idxs_moved) > 0:
+
+            self.c_lo[idxs_moved], self.c_hi[idxs_moved] = c_lo[moved], c_hi[moved]
+
+            is_moved = np.zeros(self.n_boxes, dtype=bool)
+            is_moved[idxs_moved] = True
+            keep = ~is_moved[self.boxes]
+
+            keys, cells, boxes = self._get_entries(idxs_moved)
+            order = np.argsort(keys, kind='stable')
+            keys, cells, boxes = keys[order], cells[order], boxes[order]
+
+            keys_kept = self.keys[keep]
+            positions = np.searchsorted(keys_kept, keys, side='right')
+
+            self.keys = np.insert(keys_kept, positions, keys)
+            self.cells = np.insert(self.cells[keep], positions, cells, axis=0)
+            self.boxes = np.insert(self.boxes[keep], positions, boxes)
+
+        return self.get_pairs()
+
+    def get_pairs(self):
+        """
+        Pairs (i < j, sorted) of intersecting boxes of different groups.
+        """
+
+        # entries of the same cell are neighbours in the sorted entries: every
+        # entry is paired with the entries after it in its run of equal keys
+        is_start = np.ones(len(self.keys), dtype=bool)
+        is_start[1:] = self.keys[1:] != self.keys[:-1]
+        starts_runs = np.flatnonzero(is_start)
+        lengths_runs = np.diff(np.append(starts_runs, len(self.keys)))
+
+        idxs = np.arange(len(self.keys))
+        counts = np.repeat(starts_runs + lengths_runs, lengths_runs) - idxs - 1
+
+        if np.sum(counts) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        firsts = np.repeat(idxs, counts)
+        starts = np.cumsum(counts) - counts
+        seconds = firsts + 1 + np.arange(len(firsts)) - np.repeat(starts, counts)
+
+        idxs_a, idxs_b = self.boxes[firsts], self.boxes[seconds]
+
+        # most entries of a cell are neighbours on the same axon
+        mask = self.groups[idxs_a] != self.groups[idxs_b]
+        firsts, idxs_a, idxs_b = firsts[mask], idxs_a[mask], idxs_b[mask]
+
+        # (np.take of rows is several times faster than fancy indexing)
+        lo_a, hi_a = np.take(self.lo, idxs_a, axis=0), np.take(self.hi, idxs_a, axis=0)
+        lo_b, hi_b = np.take(self.lo, idxs_b, axis=0), np.take(self.hi, idxs_b, axis=0)
+        mask = np.all((lo_a <= hi_b) & (lo_b <= hi_a), axis=-1)
+        firsts, idxs_a, idxs_b = firsts[mask], idxs_a[mask], idxs_b[mask]
+
+        # a pair is only reported by the lowest cell the two boxes have in common
+        cells = np.maximum(np.take(self.c_lo, idxs_a, axis=0), np.take(self.c_lo, idxs_b, axis=0))
+        mask = self.keys[firsts] == self._get_keys(cells)
+
+        idxs_a, idxs_b = idxs_a[mask], idxs_b[mask]
+
+        return sort_pairs(np.minimum(idxs_a, idxs_b), np.maximum(idxs_a, idxs_b))
+
+
+
+#### BENCHMARK ####
+
+def get_random_chains(n_axons, voxel_size=50.0, n_cells=0, diameter_range=(1.0, 3.0), separation=1.0, seed=0):
+
+    """
+    Straight axons in random directions through a voxel, each a chain of
+    spheres spaced separation * diameter apart, plus n_cells spheres of 3 times
+    the largest diameter. Returns positions, shapes and groups (axon index,
+    -1 for cells).
+    """
+
+    rng = np.random.default_rng(seed)
+
+    positions, shapes, groups = [], [], []
+
+    for i in range(n_axons):
+
+        d = rng.uniform(*diameter_range)
+        direction = rng.normal(size=3)
+        direction /= np.linalg.norm(direction)
+        center = rng.uniform(-voxel_size / 2, voxel_size / 2, 3)
+
+        n = int(np.ceil(voxel_size / (separation * d)))
+        ts = (np.arange(n) - (n - 1) / 2) * separation * d
+
+        positions.append(center + ts[:, None] * direction)
+        shapes.append(np.repeat(np.eye(3)[None] * d / 2, n, axis=0))
+        groups.append(np.full(n, i))
+
+    for _ in range(n_cells):
+
+        positions.append(rng.uniform(-voxel_size / 2, voxel_size / 2, (1, 3)))
+        shapes.append(np.eye(3)[None] * 3 * diameter_range[1] / 2)
+        groups.append(np.full(1, -1))
+
+    return np.concatenate(positions), np.concatenate(shapes), np.concatenate(groups)
+
+
+
+def benchmark(n_axons_list=(50, 100, 200, 400), n_cells=0, min_dist=0.01, step=0.05, seed=0):
+
+    """
+    Number of candidate pairs and run time of the broad phase for random
+    phantoms with n_axons_list axons: all pairs of different groups (the
+    separation tests without a broad phase), the pairs found by
+    get_pairs_all_boxes and by UniformGrid, and the time of an update of the
+    grid after all ellipsoids moved by up to step.
+    """
+
+    results = []
+
+    for n_axons in n_axons_list:
+
+        positions, shapes, groups = get_random_chains(n_axons, n_cells=n_cells, seed=seed)
+        lo, hi = get_boxes(positions, shapes, min_dist)
+
+        t = time.perf_counter()
+        pairs_all = get_pairs_all_boxes(lo, hi, groups)
+        time_all = time.perf_counter() - t
+
+        grid = UniformGrid()
+        t = time.perf_counter()
+        pairs_grid = grid.build(lo, hi, groups)
+        time_build = time.perf_counter() - t
+
+        assert np.array_equal(pairs_grid[0], pairs_all[0]) and np.array_equal(pairs_grid[1], pairs_all[1])
+
+        positions += np.random.default_rng(seed + 1).uniform(-step, step, positions.shape)
+        lo, hi = get_boxes(positions, shapes, min_dist)
+
+        t = time.perf_counter()
+        grid.update(lo, hi)
+        time_update = time.perf_counter() - t
+
+        n_pairs = count_pairs_all(groups)
+
+        results.append({
+            'n_axons' : n_axons,
+            'n_cells' : n_cells,
+            'n_ellipsoids' : len(positions),
+            'n_pairs_all' : n_pairs,
+            'n_pairs_candidates' : len(pairs_grid[0]),
+            'reduction' : n_pairs / max(len(pairs_grid[0]), 1),
+            'time_all_boxes' : time_all,
+            'time_grid_build' : time_build,
+            'time_grid_update' : time_update,
+        })
+
+    return results
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark of the broad phase against testing all pairs.')
+    parser.add_argument('--n_axons', type=int, nargs='+', default=[50, 100, 200, 400], help='numbers of axons')
+    parser.add_argument('--n_cells', type=int, default=0, help='number of cells')
+    parser.add_argument('--min_dist', type=float, default=0.01, help='minimumDistance')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random phantoms')
+    parser.add_argument('--path_output', default=None, help='.json file to write the results to')
+
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.n_axons, n_cells=args.n_cells, min_dist=args.min_dist, seed=args.seed)
+
+    for r in results:
+        print(f"{r['n_axons']:6d} axons, {r['n_ellipsoids']:7d} ellipsoids: "
+              f"{r['n_pairs_all']:11d} pairs -> {r['n_pairs_candidates']:8d} candidates ({r['reduction']:.0f}x), "
+              f"all boxes {r['time_all_boxes']:.3f} s, grid {r['time_grid_build']:.3f} s, update {r['time_grid_update']:.3f} s")
+
+    if args.path_output != None:
+        with open(args.path_output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+"""
+Columnar representation of WMG configs (config_output_*.json).
+
+All ellipsoids of all axons are stacked into flat arrays. The ellipsoids of
+axon i are ellipsoid_positions[axon_offsets[i]:axon_offsets[i+1]] (CSR style).
+
+    voxelSize               (3,)
+    border                  ()
+    minimumDistance         ()
+    axon_offsets            (n_axons+1,)
+    axon_positions          (n_axons, 3)
+    axon_directions         (n_axons, 3)
+    axon_maxDiameters       (n_axons,)
+    axon_gRatios            (n_axons,)
+    axon_colors             (n_axons,)     str, as long as the longest color
+    ellipsoid_positions     (n_ellipsoids, 3)
+    ellipsoid_shapes        (n_ellipsoids, 3, 3)
+    ellipsoid_axonDiameters   (n_ellipsoids,)
+    ellipsoid_myelinDiameters (n_ellipsoids,)
+    cell_positions          (n_cells, 3)
+    cell_shapes             (n_cells, 3, 3)
+
+The shapes are the matrices S of the core (an ellipsoid is pos + S y,
+|y| <= 1), as in src.Synthesizer. The "shape" lists of the JSON are the
+elements of the three.js Matrix3 in column-major order, so they are reshaped
+to (3, 3) and transposed. (np.reshape(shape, (3, 3)) alone, as in
+config_utils, gives S^T.)
+
+load_WMG_config_arrays parses the JSON one axon at a time, so a config never
+has to be in memory as Python objects in full.
+"""
+
+import os
+import json
+import zipfile
+import numpy as np
+
+
+
+# stored in the cached .npz, which is rebuilt when it does not match
+FORMAT_VERSION = 2
+
+
+
+def get_shapes(shapes):
+
+    """
+    The matrices S (n, 3, 3) from the column-major "shape" lists (n, 9) of a config.
+    """
+
+    return np.asarray(shapes, dtype=np.float64).reshape((-1, 3, 3)).transpose((0, 2, 1))
+
+
+
+def axons_to_arrays(axons):
+
+    """
+    The axon_* and ellipsoid_* arrays from an iterable of the axon dicts of a
+    config. Each axon is converted as it comes, so axons can be a generator.
+    """
+
+    positions, directions, maxDiameters, gRatios, colors = [], [], [], [], []
+    n_ellipsoids_per_axon = []
+    ellipsoid_positions, ellipsoid_shapes, ellipsoid_axonDiameters, ellipsoid_myelinDiameters = [], [], [], []
+
+    for axon in axons:
+
+        positions.append(axon['position'])
+        directions.append(axon['direction'])
+        maxDiameters.append(axon['maxDiameter'])
+        gRatios.append(axon.get('gRatio', np.nan))
+        colors.append(axon.get('color', ''))
+
+        ellipsoids = axon.pop('ellipsoids', None) or []
+        n_ellipsoids_per_axon.append(len(ellipsoids))
+
+        if len(ellipsoids) == 0:
+            continue
+
+        ellipsoid_positions.append(np.array([ellipsoid['position'] for ellipsoid in ellipsoids], dtype=np.float64))
+        ellipsoid_shapes.append(get_shapes([ellipsoid['shape'] for ellipsoid in ellipsoids]))
+
+        if 'axonDiameter' in ellipsoids[0]:
+            ellipsoid_axonDiameters.append(np.array([ellipsoid['axonDiameter'] for ellipsoid in ellipsoids], dtype=np.float64))
+            ellipsoid_myelinDiameters.append(np.array([ellipsoid['myelinDiameter'] for ellipsoid in ellipsoids], dtype=np.float64))
+        else:
+            ellipsoid_axonDiameters.append(np.full(len(ellipsoids), np.nan))
+            ellipsoid_myelinDiameters.append(np.full(len(ellipsoids), np.nan))
+
+        del ellipsoids
+
+    axon_offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+    axon_offsets[1:] = np.cumsum(n_ellipsoids_per_axon)
+
+    def concatenate(arrays, shape):
+        return np.concatenate(arrays) if len(arrays) > 0 else np.zeros(shape)
+
+    return {
+        'axon_offsets' : axon_offsets,
+        'axon_positions' : np.array(positions, dtype=np.float64).reshape((-1, 3)),
+        'axon_directions' : np.array(directions, dtype=np.float64).reshape((-1, 3)),
+        'axon_maxDiameters' : np.array(maxDiameters, dtype=np.float64),
+        'axon_gRatios' : np.array(gRatios, dtype=np.float64),
+        'axon_colors' : np.array(colors, dtype=str),
+        'ellipsoid_positions' : concatenate(ellipsoid_positions, (0, 3)),
+        'ellipsoid_shapes' : concatenate(ellipsoid_shapes, (0, 3, 3)),
+        'ellipsoid_axonDiameters' : concatenate(ellipsoid_axonDiameters, (0,)),
+        'ellipsoid_myelinDiameters' : concatenate(ellipsoid_myelinDiameters, (0,)),
+    }
+
+
+
+def values_to_arrays(values):
+
+    """
+    The arrays of everything in a config but its axons.
+    """
+
+    cells = values.get('cells', [])
+
+    return {
+        'format_version' : np.array(FORMAT_VERSION),
+        'voxelSize' : np.array(values['voxelSize'], dtype=np.float64).reshape(-1),
+        'border' : np.array(values.get('border', 0.0), dtype=np.float64),
+        'minimumDistance' : np.array(values.get('minimumDistance', 0.0), dtype=np.float64),
+        'cell_positions' : np.array([cell['position'] for cell in cells], dtype=np.float64).reshape((-1, 3)),
+        'cell_shapes' : get_shapes([cell['shape'] for cell in cells]),
+    }
+
+
+
+def config_to_arrays(config):
+
+    """
+    Converts a loaded WMG config into the columnar arrays. The ellipsoid dicts
+    of each axon are popped from config as soon as the axon has been converted,
+    so that they can be garbage collected.
+    """
+
+    arrays = values_to_arrays(config)
+    arrays.update(axons_to_arrays(config.get('axons', [])))
+
+    return arrays
+
+
+
+#### STREAMING ####
+
+class _JSONStream():
+
+    """
+    Reads JSON values from a file one at a time, size_chunk characters at a
+    time, with json.JSONDecoder.raw_decode.
+    """
+
+    def __init__(self, file, size_chunk=2**20):
+
+        self.file = file
+        self.size_chunk = size_chunk
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size):
+
+        chunk = self.file.read(size)
+        if chunk == '':
+            self.eof = True
+
+        # drop what was consumed
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """
+        The next character that is not whitespace (consumed if it is one of
+        the structural characters, see expect), or '' at the end of the file.
+        """
+
+        while True:
+            while (self.pos < len(self.buffer)) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if (self.pos < len(self.buffer)) or self.eof:
+                return self.buffer[self.pos:self.pos+1]
+            self._read(self.size_chunk)
+
+    def expect(self, characters):
+
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(f'expected one of {characters!r} in the JSON, got {character!r}')
+
+        self.pos += 1
+
+        return character
+
+    def decode(self):
+        """
+        The next value. It is decoded again with more of the file as long as
+        it is incomplete, or might be: in valid JSON every value is followed by
+        whitespace or one of ,:]}, so a number cut off by the end of the
+        buffer (e.g. '0.' of '0.1') is not taken as complete.
+        """
+
+        self.peek()
+        size = self.size_chunk
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if ((end < len(self.buffer)) and (self.buffer[end] in ',:]} \t\r\n')) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read(size)
+            size *= 2
+
+    def iterate_array(self):
+        """
+        Yields the values of the array that starts next.
+        """
+
+        self.expect('[')
+
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.decode()
+            if self.expect(',]') == ']':
+                return
+
+
+
+def load_config_arrays_streaming(path_config, size_chunk=2**20):
+
+    """
+    config_to_arrays of a config file, parsed one axon at a time: only one
+    axon is ever held as Python objects, plus the arrays of the ones before.
+    """
+
+    values = {}
+    arrays = axons_to_arrays([])
+
+    with open(path_config, 'r') as file:
+
+        stream = _JSONStream(file, size_chunk)
+        stream.expect('{')
+
+        while stream.peek() != '}':
+
+            key = stream.decode()
+            stream.expect(':')
+
+            # the axons are converted as they are read, everything else
+            # (e.g. the cells) is small and kept as it is
+            if key == 'axons':
+                arrays = axons_to_arrays(stream.iterate_array())
+            else:
+                values[key] = stream.decode()
+
+            if stream.expect(',}') == '}':
+                break
+
+    arrays.update(values_to_arrays(values))
+
+    return arrays
+
+
+
+def get_path_cache(path_config):
+
+    return os.path.splitext(path_config)[0] + '.npz'
+
+
+
+def save_arrays(path_npz, arrays):
+
+    """
+    Uncompressed, so that the arrays can be memory-mapped by load_arrays.
+    Written to a temporary file first, so that a crash never leaves half a cache.
+    """
+
+    path_tmp = path_npz + '.tmp'
+
+    with open(path_tmp, 'wb') as file:
+        np.savez(file, **arrays)
+
+    os.replace(path_tmp, path_npz)
+
+
+
+def _memmap_npz(path_npz):
+
+    """
+    Memory-maps every (uncompressed) array of an .npz file in place.
+    """
+
+    arrays = {}
+
+    with zipfile.ZipFile(path_npz) as zf, open(path_npz, 'rb') as file:
+
+        for info in zf.infolist():
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'{path_npz} is compressed and cannot be memory-mapped')
+
+            # skip the local file header: 30 bytes + file name + extra field
+            file.seek(info.header_offset + 26)
+            len_name = int.from_bytes(file.read(2), 'little')
+            len_extra = int.from_bytes(file.read(2), 'little')
+            file.seek(info.header_offset + 30 + len_name + len_extra)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            name = info.filename.replace('.npy', '')
+
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path_npz, dtype=dtype, mode='r', offset=file.tell(),
+                                         shape=shape, order='F' if fortran_order else 'C')
+
+    return arrays
+
+
+
+def load_arrays(path_npz, mmap=True):
+
+    if mmap:
+        return _memmap_npz(path_npz)
+
+    with np.load(path_npz) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+
+def load_WMG_config_arrays(path_config, cache=True, mmap=True):
+
+    """
+    The columnar arrays of a WMG config.
+
+    With cache = True, the arrays are stored next to the config as an .npz file
+    the first time, and reopened from there as long as the .npz is newer than
+    the config. With mmap = True, the cached arrays are memory-mapped instead of
+    read into memory.
+
+    The config is parsed one axon at a time (load_config_arrays_streaming), so
+    the peak memory of a cold load is about that of the arrays, not of the
+    whole config as Python objects.
+    """
+
+    path_cache = get_path_cache(path_config)
+
+    if cache and os.path.exists(path_cache) and (os.path.getmtime(path_cache) >= os.path.getmtime(path_config)):
+        arrays = load_arrays(path_cache, mmap=mmap)
+        if ('format_version' in arrays) and (int(arrays['format_version']) == FORMAT_VERSION):
+            return arrays
+
+    arrays = load_config_arrays_streaming(path_config)
+
+    if cache:
+        save_arrays(path_cache, arrays)
+
+        if mmap:
+            return load_arrays(path_cache, mmap=True)
+
+    return arrays
+
+
+
+def get_axon_slice(arrays, idx_axon):
+
+    """
+    Slice of the ellipsoid arrays belonging to axon idx_axon.
+    """
+
+    return slice(int(arrays['axon_offsets'][idx_axon]), int(arrays['axon_offsets'][idx_axon+1]))
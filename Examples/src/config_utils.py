@@ -2,18 +2,85 @@ import os
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.colors as mc
 import json
-from tqdm.auto import tqdm
-import datetime
-from datetime import datetime
-from datetime import timedelta as timedelta
-import copy
+import itertools
+import calendar
+import time
+from concurrent.futures import ProcessPoolExecutor
 from scipy.spatial.transform import Rotation
 
 sys.path.append('../')
 from src.GenerateMCDCConfigFile import GenerateMCDCConfigFile
 from src.CylindersListGenerator import CylindersListGenerator
+from src.cylinder_packing import pack_cylinders
+from src.substrate_cache import SubstrateCache, get_key
+
+
+
+#### RANDOM NUMBERS ####
+
+def get_seed_sequence(seed=None):
+    """
+    A numpy.random.SeedSequence from seed, which can be an int, a SeedSequence
+    or a Generator (which draws the entropy of the new sequence). With None the
+    entropy is drawn from the global np.random state, so that np.random.seed
+    still makes a run reproducible.
+    """
+
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(0, 2**63, size=4).tolist())
+    if seed is None:
+        return np.random.SeedSequence(np.random.randint(0, 2**31, size=4).tolist())
+
+    return np.random.SeedSequence(seed)
+
+
+
+def get_rng(seed=None):
+    """
+    A numpy.random.Generator from seed (see get_seed_sequence). A Generator is
+    returned as it is, so its stream is continued.
+    """
+
+    if isinstance(seed, np.random.Generator):
+        return seed
+
+    return np.random.default_rng(get_seed_sequence(seed))
+
+
+
+def spawn_seeds(seed, n):
+    """
+    n independent SeedSequences derived from seed, e.g. one per grid point,
+    repetition or worker. The same seed always gives the same n streams, no
+    matter in which process they are used.
+    """
+
+    return get_seed_sequence(seed).spawn(n)
+
+
+
+def get_child_seed(seed, idx):
+    """
+    Child idx of the SeedSequence seed, the same as its idx-th spawn but
+    without depending on how many children were spawned from it before.
+    """
+
+    seed = get_seed_sequence(seed)
+
+    return np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + (idx,), pool_size=seed.pool_size)
+
+
+
+def get_random_seed_of_config(seed):
+    """
+    The randomSeed of a white-matter-generator config (the seed of its
+    seedrandom stream) drawn from seed, as an int in [0, 2**31).
+    """
+
+    return int(get_child_seed(seed, 1).generate_state(1, np.uint32)[0] >> 1)
 
 
 
@@ -24,19 +91,35 @@ def generate_cylinder_list(
         num_cylinders, 
         N_reps,
         path_output,
+        n_jobs=1,
+        num_process=None,
+        scheduler=None,
     ):
 
     """
-    Uses MCDC to generate cylinder_lists.
-
+    Uses MCDC to generate cylinder_lists. Raises a RuntimeError if any of the
+    N_reps repetitions failed.
+
+    n_jobs: number of MCDC repetitions to run at once (None = one per CPU).
+    num_process: number of threads of each MCDC repetition (None = the CPUs
+        shared among the repetitions running at once).
+    scheduler: MCDCScheduler to queue the repetitions in instead, so that they
+        share its core budget with the other simulations (see
+        CylindersListGenerator.generate_cylinders_lists).
     """
 
+    n_cpus = scheduler.n_cores if scheduler != None else (os.cpu_count() or 1)
+
+    if num_process == None:
+        n_concurrent = min(n_jobs if n_jobs != None else n_cpus, max(N_reps, 1))
+        num_process = max(1, n_cpus // n_concurrent)
+
     #### paths
 
     # input paths
     path_MCDC_config = os.path.join(path_output, 'MCDC.conf')
     path_MCDC_config = path_MCDC_config.replace('\\', '/')
-    path_MCDC_scheme = f'../resources/dummy.scheme'
+    path_MCDC_scheme = '../resources/dummy.scheme'
 
     #### initialize
     CLG = CylindersListGenerator(
@@ -53,7 +136,7 @@ def generate_cylinder_list(
         path_output,
         alpha, beta, targetFVF,
         num_cylinders,
-        num_process=12
+        num_process=num_process
     )
 
     MCDC_config_file_generator = GenerateMCDCConfigFile(
@@ -65,7 +148,11 @@ def generate_cylinder_list(
     MCDC_config_file_generator.write_file()
 
     #### generate cylinders_lists
-    CLG.generate_cylinders_lists(N_reps)
+    returncodes = CLG.generate_cylinders_lists(N_reps, n_jobs=n_jobs, scheduler=scheduler)
+
+    idxs_failed = [idx for idx, returncode in enumerate(returncodes) if returncode != 0]
+    if len(idxs_failed) > 0:
+        raise RuntimeError(f'MCDC failed for repetition(s) {idxs_failed} of {path_output}, see the [OBS] output above')
 
     #### plots for checking
     # some statistics
@@ -84,6 +171,15 @@ def get_length_voxel_isotropic(path_cylinder_list, path_simulation_info,
 
     cylinder_list, scale_cylinder_list = CylindersListGenerator().load_cylinders_list(path_cylinder_list)
 
+    return get_length_voxel_isotropic_of_cylinders(cylinder_list, buffer_frac)
+
+
+
+def get_length_voxel_isotropic_of_cylinders(cylinder_list, buffer_frac=1.0):
+    """
+    get_length_voxel_isotropic of a cylinder list that is already loaded.
+    """
+
     x_mins = cylinder_list[:, 0] - cylinder_list[:, -1]
     x_maxs = cylinder_list[:, 0] + cylinder_list[:, -1]
     y_mins = cylinder_list[:, 1] - cylinder_list[:, -1]
@@ -100,16 +196,20 @@ def get_length_voxel_isotropic(path_cylinder_list, path_simulation_info,
 
 
 
-def get_direction(epsilon, fiber_orientation=np.array([0, 0, 1])):
+def get_direction(epsilon, fiber_orientation=np.array([0, 0, 1]), rng=None):
     """
     phi is the angle from the main fiber direction.
+
+    rng: seed or numpy.random.Generator, see get_rng.
     """
 
-    theta = np.random.uniform(0, 2*np.pi)
+    rng = get_rng(rng)
+
+    theta = rng.uniform(0, 2*np.pi)
 
     z_projection = np.sin((1 - epsilon) * np.pi/2)
 
-    z_sample = np.random.uniform(0+z_projection, 1)
+    z_sample = rng.uniform(0+z_projection, 1)
 
     phi = np.arccos(z_sample)
 
@@ -129,109 +229,201 @@ def get_direction(epsilon, fiber_orientation=np.array([0, 0, 1])):
 
 
 
-def get_axons_list(path_cylinder_list, path_simulation_info,
-                   fibers,
-                   d_pm_frac,
-                   length_voxel_isotropic, epsilon, g_ratio=None,
-                   color_mode='fiber', mode_fiber='sheets'):
+def get_directions(epsilons, fiber_orientations, rng=None):
     """
-    
+    get_direction for many axons at once: one direction per row of epsilons
+    (n,) and fiber_orientations (n, 3), returned as unit vectors (n, 3).
     """
 
-    axons = []
+    rng = get_rng(rng)
 
-    cylinder_list, scale_cylinder_list = CylindersListGenerator().load_cylinders_list(path_cylinder_list)
+    epsilons = np.asarray(epsilons, dtype=np.float64)
+    fiber_orientations = np.asarray(fiber_orientations, dtype=np.float64).reshape((-1, 3))
 
-    n_cylinders = len(cylinder_list)
+    n = len(epsilons)
 
-    #n_fibers = len(fibers.keys())
-    fibers_fracs = np.array([fibers[key]['frac'] for key in fibers.keys()])
+    theta = rng.uniform(0, 2*np.pi, n)
 
-    n_axons_per_fiber = np.round(fibers_fracs * n_cylinders, 0).astype(int) #[int(frac*n_cylinders) if (i<n_cylinders-1) else   for i, frac in enumerate(fibers_fracs)]
+    z_projection = np.sin((1 - epsilons) * np.pi/2)
 
-    # corrections in case np.sum(n_axons_per_fiber) < n_cylinders
-    _i = 0
-    while np.sum(n_axons_per_fiber) < n_cylinders:
-        n_axons_per_fiber[_i] += 1
-        _i +=1
+    z_sample = rng.uniform(0+z_projection, 1)
+
+    phi = np.arccos(z_sample)
+
+    directions = np.stack([np.sin(phi) * np.cos(theta),
+                           np.sin(phi) * np.sin(theta),
+                           np.cos(phi)], axis=-1)
+
+    initial_orientation = np.array([0, 0, 1])
+    fiber_orientations = fiber_orientations / np.linalg.norm(fiber_orientations, axis=-1, keepdims=True)
+    delta = initial_orientation - fiber_orientations
+
+    directions = directions - delta
+
+    return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+
+
+def get_idxs_fibers(cylinder_list, n_axons_per_fiber, mode_fiber='sheets', rng=None):
+    """
+    Index of the fiber of every cylinder. With mode_fiber = 'sheets' the fibers
+    are stacked along x (fiber 0 has the cylinders of smallest x), with 'mixed'
+    they are assigned at random.
+    """
+
+    n_cylinders = len(cylinder_list)
+
+    idxs_fibers_sorted = np.repeat(np.arange(len(n_axons_per_fiber)), n_axons_per_fiber)[:n_cylinders]
 
-    # make list of fiber indicies
     if mode_fiber == 'sheets':
         # fibers will be divided along x
+        idxs_fibers = np.empty(n_cylinders, dtype=np.int64)
+        idxs_fibers[np.argsort(cylinder_list[:, 0], kind='stable')] = idxs_fibers_sorted
+    elif mode_fiber == 'mixed':
+        idxs_fibers = get_rng(rng).permutation(idxs_fibers_sorted)
+    else:
+        raise ValueError(f"mode_fiber must be 'sheets' or 'mixed', not {mode_fiber!r}")
+
+    return idxs_fibers
+
 
-        pos_x = cylinder_list[:, 0]
 
-        idxs_sorted_pos_x = np.argsort(pos_x)
+def to_hex_colors(colors):
+    """
+    mc.to_hex for an (n, 3|4) array of RGB(A) colours in [0, 1].
+    """
 
-        idxs_fibers = np.ones(np.sum(n_axons_per_fiber)).astype(int)
+    hexs = np.array([f'{i:02x}' for i in range(256)])
+    rgb = hexs[np.round(np.asarray(colors)[:, :3] * 255).astype(np.int64)]
 
-        for idx in range(len(n_axons_per_fiber)):
+    return np.char.add(np.char.add(np.char.add('#', rgb[:, 0]), rgb[:, 1]), rgb[:, 2])
 
-            if idx == 0:
-                # first fiber
-                idxs_oi = idxs_sorted_pos_x[:n_axons_per_fiber[idx]]
-                idxs_fibers[idxs_oi] = int(idx)
-            elif idx == len(n_axons_per_fiber) - 1:
-                # last fiber
-                idxs_oi = idxs_sorted_pos_x[-n_axons_per_fiber[idx]:]
-                idxs_fibers[idxs_oi] = int(idx)
-            else:
-                idxs_oi = idxs_sorted_pos_x[n_axons_per_fiber[idx-1]:n_axons_per_fiber[idx-1]+n_axons_per_fiber[idx]]
-                idxs_fibers[idxs_oi] = int(idx)
 
-    elif mode_fiber == 'mixed':
 
-        idxs_fibers = []
-        for i, n in enumerate(n_axons_per_fiber):
-            idxs_fibers += [i,] * int(n)
+def get_axons_table(path_cylinder_list, path_simulation_info,
+                    fibers,
+                    d_pm_frac,
+                    length_voxel_isotropic, epsilon=None, g_ratio=None,
+                    color_mode='fiber', mode_fiber='sheets', rng=None):
+    """
+    The axons seeded on a cylinder list, as columns:
 
-        np.random.shuffle(idxs_fibers)
+        positions       (n_axons, 3)
+        directions      (n_axons, 3)
+        maxDiameters    (n_axons,)
+        colors          (n_axons,)     hex strings
+        gRatios         (n_axons,)
+        idxs_fibers     (n_axons,)
+
+    See axons_table_to_list for the axons of the config. epsilon is unused,
+    every fiber has its own. rng: seed or numpy.random.Generator, see get_rng.
+    """
+
+    cylinder_list, scale_cylinder_list = CylindersListGenerator().load_cylinders_list(path_cylinder_list)
+    voxel_corners = CylindersListGenerator().get_voxel_corners(path_simulation_info)
+
+    return get_axons_table_of_cylinders(cylinder_list, voxel_corners, fibers, d_pm_frac, length_voxel_isotropic,
+                                        epsilon, g_ratio, color_mode, mode_fiber, rng)
+
+
+
+def get_axons_table_of_cylinders(cylinder_list, voxel_corners,
+                                 fibers,
+                                 d_pm_frac,
+                                 length_voxel_isotropic, epsilon=None, g_ratio=None,
+                                 color_mode='fiber', mode_fiber='sheets', rng=None):
+    """
+    get_axons_table of a cylinder list [um] and voxel corners [mm] that are
+    already in memory, e.g. from cylinder_packing.pack_cylinders.
+    """
+
+    rng = get_rng(rng)
+
+    n_cylinders = len(cylinder_list)
+
+    fibers_values = list(fibers.values())
+    fibers_fracs = np.array([fiber['frac'] for fiber in fibers_values])
+
+    n_axons_per_fiber = np.round(fibers_fracs * n_cylinders, 0).astype(int)
+
+    # corrections in case np.sum(n_axons_per_fiber) < n_cylinders
+    _i = 0
+    while np.sum(n_axons_per_fiber) < n_cylinders:
+        n_axons_per_fiber[_i] += 1
+        _i +=1
+
+    idxs_fibers = get_idxs_fibers(cylinder_list, n_axons_per_fiber, mode_fiber, rng)
 
     #### get voxel specs
-    voxel_xmin, _, _, voxel_xmax, _, _ = CylindersListGenerator().get_voxel_corners(path_simulation_info)
+    voxel_xmin, _, _, voxel_xmax, _, _ = voxel_corners
     len_voxel_MCDC = (voxel_xmax - voxel_xmin) * 1e3
 
-    #directions = [get_direction(epsilon, fiber_orientation) for _ in range(len(cylinder_list))]
-
-    directions = [fibers[list(fibers.keys())[idx_fiber]]['orientation'] for idx_fiber in idxs_fibers]
-    directions = [get_direction(fibers[list(fibers.keys())[idx_fiber]]['epsilon'], fibers[list(fibers.keys())[idx_fiber]]['orientation']) for idx_fiber in idxs_fibers]
-    directions = directions / np.linalg.norm(directions, axis=-1)[:, np.newaxis]#np.atleast_2d(np.linalg.norm(directions, axis=-1)).T
-    directions = directions.tolist()
+    #### directions, sampled around the orientation of the fiber of each axon
+    epsilons = np.array([fiber['epsilon'] for fiber in fibers_values], dtype=np.float64)
+    orientations = np.array([fiber['orientation'] for fiber in fibers_values], dtype=np.float64).reshape((-1, 3))
 
-    g_ratios = [g_ratio,] * len(cylinder_list) #### TODO: Should g_ratios have some variance?
+    directions = get_directions(epsilons[idxs_fibers], orientations[idxs_fibers], rng)
 
     if color_mode == 'random':
         # set colors at random
-        colors = plt.cm.gist_ncar(np.linspace(0, 1, len(cylinder_list)))
+        colors = plt.cm.gist_ncar(np.linspace(0, 1, n_cylinders))
     elif color_mode == 'diameter':
         # set color to be propertional to maxDiameter of the axon
         colors = plt.cm.OrRd(cylinder_list[:, -1] / np.max(cylinder_list[:, -1]))
     elif color_mode == 'fiber':
-        # TODO: implement colouring according to assignmet fiber for validation purposes
-        colors = plt.cm.gist_ncar(idxs_fibers / np.max(idxs_fibers))
+        colors = plt.cm.gist_ncar(idxs_fibers / max(np.max(idxs_fibers), 1))
+
+    #### positions
+    # translate to be centered around x=0, y=0, and distribute uniformly along z
+    positions = np.empty((n_cylinders, 3))
+    positions[:, :2] = cylinder_list[:, :2] - len_voxel_MCDC / 2
+    positions[:, 2] = rng.uniform(-length_voxel_isotropic/2, length_voxel_isotropic/2, n_cylinders)
+
+    r = cylinder_list[:, -1]
+
+    return {
+        'positions' : positions,
+        'directions' : directions,
+        'maxDiameters' : r*2 + r*2*d_pm_frac,
+        'colors' : to_hex_colors(colors),
+        'gRatios' : np.full(n_cylinders, g_ratio, dtype=object), #### TODO: Should g_ratios have some variance?
+        'idxs_fibers' : idxs_fibers,
+    }
+
 
-    for cylinder, direction, color, g_ratio in zip(cylinder_list, directions, colors, g_ratios):
 
-        x_0, y_0, z_0, _, _, _, r = cylinder
+def axons_table_to_list(axons_table):
+    """
+    The axons of a config (list of dicts) from the columns of get_axons_table.
+    """
 
-        # translate to be centered around x=0, y=0
-        x_0 = x_0 - len_voxel_MCDC / 2
-        y_0 = y_0 - len_voxel_MCDC / 2
+    return [{'position' : position,
+             'direction' : direction,
+             'maxDiameter' : maxDiameter,
+             'color' : color,
+             'gRatio' : gRatio,
+            } for position, direction, maxDiameter, color, gRatio in zip(
+                axons_table['positions'].tolist(),
+                axons_table['directions'].tolist(),
+                axons_table['maxDiameters'].tolist(),
+                axons_table['colors'].tolist(),
+                axons_table['gRatios'].tolist(),
+            )]
 
-        # distribute uniformly along z
-        z_0 = np.random.uniform(-length_voxel_isotropic/2, length_voxel_isotropic/2)
 
-        axon = {'position' : [x_0, y_0, z_0],
-                'direction' : direction,
-                #'maxDiameter' : r*2,
-                'maxDiameter' : r*2 + r*2*d_pm_frac,
-                'color' : mc.to_hex(color),
-                'gRatio' : g_ratio,
-               }
 
-        axons.append(axon)
+def get_axons_list(path_cylinder_list, path_simulation_info,
+                   fibers,
+                   d_pm_frac,
+                   length_voxel_isotropic, epsilon, g_ratio=None,
+                   color_mode='fiber', mode_fiber='sheets', rng=None):
+    """
+    The axons of get_axons_table as a list of dicts.
+    """
 
-    return axons
+    return axons_table_to_list(get_axons_table(path_cylinder_list, path_simulation_info, fibers, d_pm_frac,
+                                               length_voxel_isotropic, epsilon, g_ratio, color_mode, mode_fiber,
+                                               rng))
 
 
 
@@ -244,6 +436,215 @@ def get_cells_list():
 
 
 
+def generate_config_files_for_substrate(
+        path_substrates,
+        alpha,
+        beta,
+        targetFVF,
+        num_cylinders,
+        N_reps,
+        fibers,
+        mapFromMaxDiameterToEllipsoidSeparation,
+        growSpeed,
+        contractSpeed,
+        minimumDistance,
+        mapFromDiameterToDeformationFactor,
+        mapFromMaxDiameterToMinDiameter,
+        d_pm_frac=0.25,
+        color_mode='diameter',
+        mode_fiber='None',
+        n_jobs=1,
+        seed=None,
+        packer='MCDC',
+        cache=None,
+        scheduler=None,
+    ):
+
+    """
+    Generates the N_reps config-files of a single point of the parameter grid
+    in its own substrate directory. Returns the paths of the config-files.
+
+    seed: int, SeedSequence or Generator. Every repetition seeds its axons,
+        the native packing (child 0) and the randomSeed of its config, which
+        seeds the white-matter-generator (child 1), from its own stream
+        spawned from it (see spawn_seeds). With the MCDC packer the cylinder
+        lists are not reproducible, as MCDC is not seeded; only what is drawn
+        from them is.
+    packer: 'MCDC' to generate the cylinder lists with MCDC, 'native' to pack
+        them in memory with cylinder_packing.pack_cylinders.
+    cache: SubstrateCache or the path of one. Substrates found in it are
+        loaded instead of generated, new ones are added to it. With MCDC,
+        MCDC is only run if any of the N_reps is missing.
+    scheduler: MCDCScheduler the MCDC repetitions are queued in, see
+        generate_cylinder_list.
+    """
+
+    #### generate substrate name
+    name_substrate = f'cylinders-alpha={alpha}-beta={beta}-targetFVF={targetFVF}-num_cylinders={num_cylinders}-mode_fiber={mode_fiber}'
+
+    for key, value in fibers.items():
+        frac = value['frac']
+        orientation = str(value['orientation']).replace(' ', '') # spaces are no-go
+        epsilon = value['epsilon']
+
+        #name_substrate += f'-{key}_frac={frac}_orientation={orientation}_epsilon={epsilon}'
+        name_substrate += f'-{key}-frac={frac}-orientation={orientation}-epsilon={epsilon}'
+
+    print(f'[LOG] Generating {N_reps} substrate(s) under the name: {name_substrate}\n')
+
+    path_output = os.path.join(path_substrates, name_substrate)
+    path_output = path_output.replace('\\', '/')
+
+    #### generate cylinder_lists
+    if packer not in ['MCDC', 'native']:
+        raise ValueError(f"packer = '{packer}' is not supported, use 'MCDC' or 'native'")
+
+    seeds_reps = spawn_seeds(seed, N_reps)
+
+    # (rep_tag, cylinder_list, voxel_corners) of every repetition, None until generated
+    substrates = [None] * N_reps
+
+    if isinstance(cache, str):
+        cache = SubstrateCache(cache)
+
+    if cache != None:
+        keys = [get_key(packer, alpha, beta, targetFVF, num_cylinders, seed_rep) for seed_rep in seeds_reps]
+        for idx, key in enumerate(keys):
+            substrate = cache.get(key)
+            if substrate != None:
+                substrates[idx] = (f'{idx+1:02d}',) + substrate
+        print(f'[LOG] {N_reps - substrates.count(None)} of {N_reps} substrate(s) loaded from {cache.path_cache}')
+
+    is_cached = [substrate != None for substrate in substrates]
+
+    os.makedirs(path_output, exist_ok=True)
+
+    if (packer == 'MCDC') and not all(is_cached):
+
+        generate_cylinder_list(
+            alpha, 
+            beta, 
+            targetFVF, 
+            num_cylinders, 
+            N_reps, 
+            path_output,
+            n_jobs=n_jobs,
+            scheduler=scheduler,
+        )
+
+        # get all substrate paths
+        paths_cylinder_lists = sorted([os.path.join(path_output, name) for name in os.listdir(path_output) if 'cylinder_list' in name])
+        paths_simulation_info = sorted([os.path.join(path_output, name) for name in os.listdir(path_output) if 'info' in name])
+
+        assert len(paths_cylinder_lists) == len(paths_simulation_info), 'len(paths_cylinder_lists) != len(paths_simulation_info)'
+
+        # MCDC generates all N_reps at once, so all of them are replaced. Each
+        # is put at the index of its rep_ file, so that a repetition that
+        # failed leaves a gap rather than shifting the later ones
+        substrates = [None] * N_reps
+        is_cached = [False] * N_reps
+
+        for path_simulation_info, path_cylinder_list in zip(paths_simulation_info, paths_cylinder_lists):
+
+            if 'rep_' in path_cylinder_list:
+                idx_rep = int(path_cylinder_list.split('rep_')[-1].split('_')[0])
+                rep_tag = f'{idx_rep+1:02d}'
+            else:
+                idx_rep = 0
+                rep_tag = '00'
+
+            if idx_rep >= N_reps:
+                continue
+
+            cylinder_list, _ = CylindersListGenerator().load_cylinders_list(path_cylinder_list)
+            voxel_corners = CylindersListGenerator().get_voxel_corners(path_simulation_info)
+
+            substrates[idx_rep] = (rep_tag, cylinder_list, voxel_corners)
+
+        # clean up
+        clean_up(path_output)
+
+    elif packer == 'native':
+
+        # the packing draws from child 0 of the stream of the repetition, so
+        # the axons are seeded as with MCDC
+        for idx, seed_rep in enumerate(seeds_reps):
+            if not is_cached[idx]:
+                cylinder_list, voxel_corners = pack_cylinders(alpha, beta, targetFVF, num_cylinders,
+                                                              seed=get_child_seed(seed_rep, 0))
+                substrates[idx] = (f'{idx+1:02d}', cylinder_list, voxel_corners)
+
+    if cache != None:
+        for substrate, key, cached in zip(substrates, keys, is_cached):
+            if (substrate != None) and not cached:
+                cache.put(key, substrate[1], substrate[2])
+
+    #### generate config-file
+    paths_config_files = []
+
+    # loops of N_reps
+    for substrate, seed_rep in zip(substrates, seeds_reps):
+
+        if substrate == None:
+            continue
+
+        rep_tag, cylinder_list, voxel_corners = substrate
+
+        # size of voxel
+        length_voxel_isotropic = get_length_voxel_isotropic_of_cylinders(
+            cylinder_list,
+            buffer_frac=1.0
+        )
+
+        length_voxel_MCDC = 1e3 * voxel_corners[3]
+        border = (length_voxel_isotropic - length_voxel_MCDC) / 2
+
+        # axons
+        axons_table = get_axons_table_of_cylinders(cylinder_list, voxel_corners,
+                                                   fibers,
+                                                   d_pm_frac,
+                                                   length_voxel_isotropic, epsilon, g_ratio=0.7,
+                                                   color_mode=color_mode,
+                                                   mode_fiber=mode_fiber,
+                                                   rng=seed_rep)
+
+        # cells
+        cells_list = get_cells_list()
+
+        # collect to dict
+        input_dict = {'randomSeed' : get_random_seed_of_config(seed_rep),
+                      'voxelSize' : [length_voxel_isotropic,]*3,
+                      'mapFromMaxDiameterToEllipsoidSeparation' : mapFromMaxDiameterToEllipsoidSeparation,
+                      'growSpeed' : growSpeed,
+                      'contractSpeed' : contractSpeed,
+                      'border' : border,
+                      'minimumDistance' : minimumDistance,
+                      'mapFromDiameterToDeformationFactor' : mapFromDiameterToDeformationFactor,
+                      'mapFromMaxDiameterToMinDiameter' : mapFromMaxDiameterToMinDiameter,
+                      'axons' : axons_table_to_list(axons_table),
+                      'cells' : cells_list,
+                     }
+
+        # save file
+        name_file = f'rep_{rep_tag}-stage=0.json'
+        path_config_file = os.path.join(path_output, name_file)
+        path_config_file = path_config_file.replace('\\','/')
+        paths_config_files.append(path_config_file)
+        with open(path_config_file, 'w') as file:
+            json.dump(input_dict, file, indent=4)
+
+    return paths_config_files
+
+
+
+def _initialize_worker():
+    # the configs are drawn from the seeds passed to each grid point, but forked
+    # workers also inherit the global random state of the parent, so give each
+    # of them fresh entropy in case anything else draws from it
+    np.random.seed()
+
+
+
 def generate_config_files(
         path_substrates, 
         alphas, 
@@ -261,8 +662,30 @@ def generate_config_files(
         d_pm_frac=0.25,
         color_mode='diameter',
         mode_fiber='None',
+        n_jobs=1,
+        n_workers=1,
+        seed=None,
+        packer='MCDC',
+        cache=None,
     ):
 
+    """
+    Generates config-files for every point of the grid alphas x betas x
+    targetFVFs x nums_cylinders.
+
+    n_workers: number of grid points to generate at once, each in its own
+        process and substrate directory (None = one per CPU). 
+    n_jobs: number of MCDC repetitions to run at once per grid point.
+    seed: int, SeedSequence or Generator. Each grid point gets its own stream
+        spawned from it, so the configs are the same for any n_workers
+        (None = drawn from the global np.random state). The configs are only
+        reproducible bit for bit with packer='native', MCDC is not seeded.
+    packer: 'MCDC' or 'native', see generate_config_files_for_substrate.
+    cache: SubstrateCache or the path of one, see substrate_cache.
+
+    The config paths are returned in grid order, regardless of n_workers.
+    """
+
     mapFromMaxDiameterToEllipsoidSeparation = {
         'from': [1.0, 2.0],
         'to': [1.0*ellipsoidDensityScaler, 2.0*ellipsoidDensityScaler],
@@ -279,100 +702,41 @@ def generate_config_files(
             print(f"[OBS] It was therefore corrected to {fibers[key]['orientation']}\n")
 
     #### the purpose
-    paths_config_files = []
+    grid = list(itertools.product(alphas, betas, targetFVFs, nums_cylinders))
+
+    seeds = spawn_seeds(seed, len(grid))
+
+    kwargs = {
+        'N_reps' : N_reps,
+        'fibers' : fibers,
+        'mapFromMaxDiameterToEllipsoidSeparation' : mapFromMaxDiameterToEllipsoidSeparation,
+        'growSpeed' : growSpeed,
+        'contractSpeed' : contractSpeed,
+        'minimumDistance' : minimumDistance,
+        'mapFromDiameterToDeformationFactor' : mapFromDiameterToDeformationFactor,
+        'mapFromMaxDiameterToMinDiameter' : mapFromMaxDiameterToMinDiameter,
+        'd_pm_frac' : d_pm_frac,
+        'color_mode' : color_mode,
+        'mode_fiber' : mode_fiber,
+        'n_jobs' : n_jobs,
+        'packer' : packer,
+        'cache' : cache,
+    }
+
+    if n_workers == 1:
+        paths_config_files_per_point = [
+            generate_config_files_for_substrate(path_substrates, alpha, beta, targetFVF, num_cylinders, seed=seed_point, **kwargs)
+            for (alpha, beta, targetFVF, num_cylinders), seed_point in zip(grid, seeds)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_initialize_worker) as executor:
+            futures = [
+                executor.submit(generate_config_files_for_substrate, path_substrates, alpha, beta, targetFVF, num_cylinders, seed=seed_point, **kwargs)
+                for (alpha, beta, targetFVF, num_cylinders), seed_point in zip(grid, seeds)
+            ]
+            paths_config_files_per_point = [future.result() for future in futures]
 
-    for alpha in alphas:
-        for beta in betas:
-            for targetFVF in targetFVFs:
-                for num_cylinders in nums_cylinders:
-
-                        #### generate substrate name
-                        name_substrate = f'cylinders-alpha={alpha}-beta={beta}-targetFVF={targetFVF}-num_cylinders={num_cylinders}-mode_fiber={mode_fiber}'
-
-                        for key, value in fibers.items():
-                            frac = value['frac']
-                            orientation = str(value['orientation']).replace(' ', '') # spaces are no-go
-                            epsilon = value['epsilon']
-
-                            #name_substrate += f'-{key}_frac={frac}_orientation={orientation}_epsilon={epsilon}'
-                            name_substrate += f'-{key}-frac={frac}-orientation={orientation}-epsilon={epsilon}'
-
-                        print(f'[LOG] Generating {N_reps} substrate(s) under the name: {name_substrate}\n')
-
-                        path_output = os.path.join(path_substrates, name_substrate)
-                        path_output = path_output.replace('\\', '/')
-
-                        #### generate cylinder_lists with MCDC
-                        generate_cylinder_list(
-                            alpha, 
-                            beta, 
-                            targetFVF, 
-                            num_cylinders, 
-                            N_reps, 
-                            path_output
-                        )
-
-                        #### generate config-file
-                        # get all substrate paths
-                        paths_cylinder_lists = [os.path.join(path_output, name) for name in os.listdir(path_output) if 'cylinder_list' in name]
-                        paths_simulation_info = [os.path.join(path_output, name) for name in os.listdir(path_output) if 'info' in name]
-
-                        assert len(paths_cylinder_lists) == len(paths_simulation_info), 'len(paths_cylinder_lists) != len(paths_simulation_info)'
-
-                        # loops of N_reps
-                        for path_simulation_info, path_cylinder_list in zip(paths_simulation_info, paths_cylinder_lists):
-
-                            # size of voxel
-                            length_voxel_isotropic = get_length_voxel_isotropic(
-                                path_cylinder_list,
-                                path_simulation_info,
-                                buffer_frac=1.0
-                            )
-
-                            with open(path_simulation_info, 'r') as file:
-                                line_last = file.readlines()[-1]
-                            length_voxel_MCDC = 1e3 * float(line_last.replace('(', '').replace(')', '').strip().split(' ')[0])
-                            border = (length_voxel_isotropic - length_voxel_MCDC) / 2
-
-                            # axons
-                            axons_list = get_axons_list(path_cylinder_list, path_simulation_info,
-                                                        fibers,
-                                                        d_pm_frac,
-                                                        length_voxel_isotropic, epsilon, g_ratio=0.7,
-                                                        color_mode=color_mode,
-                                                        mode_fiber=mode_fiber)
-
-                            # cells
-                            cells_list = get_cells_list()
-
-                            # collect to dict
-                            input_dict = {'voxelSize' : [length_voxel_isotropic,]*3,
-                                          'mapFromMaxDiameterToEllipsoidSeparation' : mapFromMaxDiameterToEllipsoidSeparation,
-                                          'growSpeed' : growSpeed,
-                                          'contractSpeed' : contractSpeed,
-                                          'border' : border,
-                                          'minimumDistance' : minimumDistance,
-                                          'mapFromDiameterToDeformationFactor' : mapFromDiameterToDeformationFactor,
-                                          'mapFromMaxDiameterToMinDiameter' : mapFromMaxDiameterToMinDiameter,
-                                          'axons' : axons_list,
-                                          'cells' : cells_list,
-                                         }
-
-                            # save file
-                            if 'rep_' in path_cylinder_list:
-                                rep_tag = path_cylinder_list.split('rep_')[-1].split('_')[0]
-                                rep_tag = int(rep_tag) + 1
-                                rep_tag = f'{rep_tag:02d}'
-                            else:
-                                rep_tag = '00'
-                            name_file = f'rep_{rep_tag}-stage=0.json'
-                            path_config_file = os.path.join(path_output, name_file)
-                            path_config_file = path_config_file.replace('\\','/')
-                            paths_config_files.append(path_config_file)
-                            json.dump(input_dict, open(path_config_file, 'w'), indent=4)
-
-                        # clean up
-                        clean_up(path_output)
+    paths_config_files = [path for paths in paths_config_files_per_point for path in paths]
 
     return paths_config_files
 
@@ -405,46 +769,141 @@ def edit_config_file(path_config_file_original, path_config_file_new,
 
 
 
-def load_log(path_log):
+#### LOGS ####
+
+# one row per iteration of the optimisation
+LOG_DTYPE = np.dtype([
+    ('idx', np.int64),          # [int] # iteration index
+    ('AVF', np.float64),        # [fraction] # axon volume fraction
+    ('CVF', np.float64),        # [fraction] # cell volume fraction
+    ('TVF', np.float64),        # [fraction] # total volume fraction
+    ('timestamp', np.float64),  # [s] # UTC time at the end of the iteration, since epoch
+])
+
+# last lines written by the white-matter-generator when it stops
+LOG_MESSAGES_END = [
+    'Target volume fraction reached',
+    'Number of max iterations without improvement reached',
+    'Number of max iterations reached',
+]
+
+_MONTHS = {month: i+1 for i, month in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                                  'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+
+
+def parse_log_line(line):
+
+    """
+    '12 / 100    0.61    0.05    0.66 / 0.7    Sat, 17 Oct 2026 10:00:00 GMT'
+    -> (12, 0.61, 0.05, 0.66, 1792144800.0)
+
+    Returns None for lines that are not iteration rows (header, end messages).
+    """
+
+    tokens = line.split()
+
+    if (len(tokens) != 14) or (tokens[1] != '/'):
+        return None
+
+    try:
+        idx = int(tokens[0])
+        AVF = float(tokens[3])
+        CVF = float(tokens[4])
+        TVF = float(tokens[5])
+
+        # time // tokens[8:] = ['Sat,', '17', 'Oct', '2026', '10:00:00', 'GMT']
+        hours, minutes, seconds = tokens[12].split(':')
+        timestamp = float(calendar.timegm((int(tokens[11]), _MONTHS[tokens[10]], int(tokens[9]),
+                                           int(hours), int(minutes), int(seconds))))
+    except (ValueError, KeyError):
+        return None
+
+    return idx, AVF, CVF, TVF, timestamp
+
+
+
+def iterate_log(path_log, follow=False, poll_interval=1.0, timeout=None):
+
+    """
+    Yields (idx, AVF, CVF, TVF, timestamp) for each iteration in the log.
+
+    With follow = False the file is read once, up to the first line that is not
+    an iteration row. With follow = True the log of a running optimisation is
+    tailed: new rows are yielded as they are written, until the optimisation
+    writes one of LOG_MESSAGES_END or nothing new arrives for timeout seconds
+    (None = wait forever). The file is polled every poll_interval seconds.
+    """
+
+    time_last_data = time.time()
+
+    # wait for the optimisation to create the log
+    while follow and not os.path.exists(path_log):
+        if (timeout != None) and (time.time() - time_last_data > timeout):
+            return
+        time.sleep(poll_interval)
 
     with open(path_log, 'r') as file:
 
-        idxs = [] # [int] # iteration index
-        AVF  = [] # [fraction] # axon volume fraction # TODO: FIGURE OUT IF THIS INCLUDES AXON AND MYELIN (I THINK IT DOES)
-        CVF  = [] # [fraction] # cell volume fraction
-        TVF  = [] # [fraction] # total volume fraction # cells and axons (and myelin?)
-        time = [] # [s] # time spent for executing iteration
+        buffer = ''
+        header = True
 
-        for idx, line in enumerate(file):
+        while True:
 
-            if idx == 0:
+            # the CLI rewrites the whole log every iteration. While it is being
+            # rewritten it can be shorter than what was read so far, in which
+            # case nothing is read until it has caught up again.
+            data = file.read()
+
+            if data == '':
+                if not follow:
+                    return
+                if (timeout != None) and (time.time() - time_last_data > timeout):
+                    return
+                time.sleep(poll_interval)
                 continue
-            if 'Number of max iterations reached' in line:
-                #continue
-                break
-            if 'Number of max iterations without improvement reached' in line:
-                #continue
-                break
-            if '            ' not in line:
-                #continue
-                break
-
-            line = line.split('            ')
-
-            idxs.append(int(line[0].split('/')[0]))
-            AVF.append(float(line[1]))
-            CVF.append(float(line[2]))
-            TVF.append(float(line[3].split('/')[0]))
-
-            # time
-            tmp = line[4].strip().split(',')[-1]
-
-            if idx == 1:
-                time_prev = datetime.strptime(tmp, ' %d %b %Y %H:%M:%S %Z')
-            else:
-                time_current = datetime.strptime(tmp, ' %d %b %Y %H:%M:%S %Z')
-                time.append((time_current - time_prev).total_seconds())
-                time_prev = copy.copy(time_current)
+
+            time_last_data = time.time()
+
+            buffer += data
+            lines = buffer.split('\n')
+            # keep a partially written last line for the next read
+            buffer = lines.pop(-1) if follow else ''
+
+            for line in lines:
+
+                if header:
+                    header = False
+                    continue
+
+                row = parse_log_line(line)
+
+                if row != None:
+                    yield row
+                elif any([message in line for message in LOG_MESSAGES_END]) or (not follow):
+                    return
+
+
+
+def load_log_array(path_log):
+
+    """
+    All iterations of the log as a structured array with dtype LOG_DTYPE.
+    """
+
+    return np.fromiter(iterate_log(path_log), dtype=LOG_DTYPE)
+
+
+
+def load_log(path_log):
+
+    rows = load_log_array(path_log)
+
+    idxs = rows['idx'].tolist() # [int] # iteration index
+    AVF  = rows['AVF'].tolist() # [fraction] # axon volume fraction # TODO: FIGURE OUT IF THIS INCLUDES AXON AND MYELIN (I THINK IT DOES)
+    CVF  = rows['CVF'].tolist() # [fraction] # cell volume fraction
+    TVF  = rows['TVF'].tolist() # [fraction] # total volume fraction # cells and axons (and myelin?)
+    time = np.diff(rows['timestamp']).tolist() # [s] # time spent for executing iteration
 
     return idxs, AVF, CVF, TVF, time
 
@@ -516,6 +975,91 @@ def are_ellipsoids_separated(ellipsoid_a, ellipsoid_b, debug=False):
 
 
 
+def get_ellipsoid_arrays(ellipsoids):
+
+    """
+    Stack a list of ellipsoid dicts into positions (N, 3) and shapes (N, 3, 3).
+    """
+
+    positions = np.array([ellipsoid["position"] for ellipsoid in ellipsoids], dtype=float).reshape((-1, 3))
+    shapes = np.array([ellipsoid["shape"] for ellipsoid in ellipsoids], dtype=float).reshape((-1, 3, 3))
+
+    return positions, shapes
+
+
+
+def get_extremum_points_of_ellipsoids(positions, shapes, rs):
+
+    """
+    Batched get_extremum_point_of_ellipsoid.
+
+    positions (N, 3) and shapes (N, 3, 3) describe N ellipsoids, and rs (N, M, 3)
+    holds M directions per ellipsoid. Returns the (N, M, 3) extremum points.
+    """
+
+    dots = np.einsum('nji,nmj->nmi', shapes, rs)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dots = dots / np.linalg.norm(dots, axis=-1, keepdims=True)
+
+    return positions[:, np.newaxis, :] + np.einsum('nij,nmj->nmi', shapes, dots)
+
+
+
+def are_ellipsoids_separated_batch(positions_a, shapes_a, positions_b, shapes_b):
+
+    """
+    Batched are_ellipsoids_separated: the same minimal test along the line
+    between the centres, for all N x M pairs of the ellipsoids a (N, 3), (N, 3, 3)
+    and b (M, 3), (M, 3, 3) in one pass. Returns an (N, M) boolean mask.
+    """
+
+    rs = positions_b[np.newaxis, :, :] - positions_a[:, np.newaxis, :] # (N, M, 3)
+
+    e_a = get_extremum_points_of_ellipsoids(positions_a, shapes_a, rs)
+    e_b = get_extremum_points_of_ellipsoids(positions_b, shapes_b, -np.swapaxes(rs, 0, 1))
+
+    o = np.sum(rs * (e_a - np.swapaxes(e_b, 0, 1)), axis=-1)
+
+    # coinciding centres give nan, which (as in are_ellipsoids_separated) counts as not separated
+    separated = o < 1
+
+    return separated
+
+
+
+def get_overlapping_ellipsoid_pairs(positions, shapes, size_chunk=1000):
+
+    """
+    Audit a set of ellipsoids for overlap with are_ellipsoids_separated_batch.
+    Returns an (K, 2) array of index pairs (i < j) that are not separated.
+    The pairs are tested in chunks of size_chunk rows to bound the memory use.
+    """
+
+    pairs = []
+
+    for idx_start in range(0, len(positions), size_chunk):
+
+        idx_stop = min(idx_start + size_chunk, len(positions))
+
+        separated = are_ellipsoids_separated_batch(
+            positions[idx_start:idx_stop], shapes[idx_start:idx_stop],
+            positions, shapes
+        )
+
+        idxs_a, idxs_b = np.nonzero(~separated)
+        idxs_a += idx_start
+        mask = idxs_a < idxs_b
+
+        pairs.append(np.stack([idxs_a[mask], idxs_b[mask]], axis=-1))
+
+    if len(pairs) == 0:
+        return np.zeros((0, 2), dtype=int)
+
+    return np.concatenate(pairs)
+
+
+
 def check_if_ellipsoid_extends_the_voxel(ellipsoid, voxel):
 
     """
@@ -580,8 +1124,109 @@ def generate_points_on_ellipsoid_surface(ellipsoid, flatten=True, res_1=50j, res
 
 #### CELLS ####
 
+def get_bounding_box_of_ellipsoid(ellipsoid):
+
+    """
+    Axis-aligned bounding box of the ellipsoid as (box_min, box_max).
+    The half-extent along axis i is the norm of row i of the shape matrix.
+    """
+
+    p = np.array(ellipsoid["position"])
+    S = np.array(ellipsoid["shape"]).reshape((3, 3))
+
+    half_extents = np.linalg.norm(S, axis=1)
+
+    return p - half_extents, p + half_extents
+
+
+
+class EllipsoidGrid():
+
+    """
+    Uniform grid over the bounding boxes of ellipsoids.
+
+    Every ellipsoid is registered in each grid bin its bounding box touches,
+    so a candidate only has to be tested against the ellipsoids sharing a bin
+    with it. Every ellipsoid whose bounding box meets the candidate's is
+    returned, but so can be ellipsoids that only share a bin with it, so the
+    neighbours still have to be tested.
+    """
+
+    def __init__(self, spacing):
+
+        self.spacing = spacing
+        self.bins = {}
+        self.ellipsoids = []
+        self.positions = []
+        self.shapes = []
+
+    def _get_keys(self, box_min, box_max):
+
+        idx_min = np.floor(box_min / self.spacing).astype(int)
+        idx_max = np.floor(box_max / self.spacing).astype(int)
+
+        return itertools.product(*[range(a, b+1) for a, b in zip(idx_min, idx_max)])
+
+    def add(self, ellipsoid):
+
+        idx = len(self.ellipsoids)
+        self.ellipsoids.append(ellipsoid)
+        self.positions.append(np.array(ellipsoid["position"], dtype=float))
+        self.shapes.append(np.array(ellipsoid["shape"], dtype=float).reshape((3, 3)))
+
+        for key in self._get_keys(*get_bounding_box_of_ellipsoid(ellipsoid)):
+            self.bins.setdefault(key, []).append(idx)
+
+        return idx
+
+    def get_neighbour_idxs(self, ellipsoid):
+
+        idxs = set()
+
+        for key in self._get_keys(*get_bounding_box_of_ellipsoid(ellipsoid)):
+            idxs.update(self.bins.get(key, []))
+
+        return sorted(idxs)
+
+    def get_neighbours(self, ellipsoid):
+
+        return [self.ellipsoids[idx] for idx in self.get_neighbour_idxs(ellipsoid)]
+
+    def get_neighbour_arrays(self, ellipsoid):
+
+        """
+        Positions (K, 3) and shapes (K, 3, 3) of the neighbours, ready for
+        are_ellipsoids_separated_batch.
+        """
+
+        idxs = self.get_neighbour_idxs(ellipsoid)
+
+        positions = np.array([self.positions[idx] for idx in idxs]).reshape((-1, 3))
+        shapes = np.array([self.shapes[idx] for idx in idxs]).reshape((-1, 3, 3))
+
+        return positions, shapes
+
+
+
 def add_cells_to_config(path_config, CVF_des, l1_mean, l1_std, l2_mean, l2_std,
-                        rotation_lim, l3_mean=None, l3_std=None, keep_existing=False):
+                        rotation_lim, l3_mean=None, l3_std=None, keep_existing=False,
+                        grid_spacing=None, max_attempts=None,
+                        max_consecutive_rejections=None, checkpoint_interval=None, rng=None):
+
+    """
+    Cells are placed at random until the desired cell volume fraction is reached.
+
+    grid_spacing: side length of the bins of the EllipsoidGrid used to find
+        neighbouring cells. Defaults to the largest mean cell diameter.
+    max_attempts: stop after this many candidate cells in total (None = no limit).
+    max_consecutive_rejections: stop after this many rejected candidates in a row
+        (None = no limit), i.e. when the desired CVF is out of reach.
+    checkpoint_interval: also write the config every checkpoint_interval placed
+        cells (None = only write it once, when packing is done).
+    rng: seed or numpy.random.Generator the cells are drawn from, see get_rng.
+    """
+
+    rng = get_rng(rng)
 
     # load config
     with open(path_config, "rb") as f:
@@ -609,13 +1254,36 @@ def add_cells_to_config(path_config, CVF_des, l1_mean, l1_std, l2_mean, l2_std,
     elif keep_existing == True:
         pass
 
+    if grid_spacing == None:
+        grid_spacing = 2 * max(l1_mean, l2_mean, l3_mean if l3_mean != None else 0)
+
+    grid = EllipsoidGrid(grid_spacing)
+
+    path_config_with_cells = path_config.replace('.json', '-with_cells.json')
+
+    for cell in config["cells"]:
+        grid.add(cell)
+
+    n_attempts = 0
+    n_rejections = 0
+
     while CV_current <= CV_des:
 
+        #### CHECK BUDGET
+        if (max_attempts != None) and (n_attempts >= max_attempts):
+            print(f'[OBS] Stopped after max_attempts = {max_attempts}. CVF reached: {np.round(CV_current/voxel_volume, 3)}')
+            break
+        if (max_consecutive_rejections != None) and (n_rejections >= max_consecutive_rejections):
+            print(f'[OBS] Stopped after {n_rejections} consecutive rejections. CVF reached: {np.round(CV_current/voxel_volume, 3)}')
+            break
+
+        n_attempts += 1
+
         #### GENERATE CELL SHAPE
-        l1 = np.random.normal(l1_mean, l1_std, 1)
-        l2 = np.random.normal(l2_mean, l2_std, 1)
+        l1 = rng.normal(l1_mean, l1_std)
+        l2 = rng.normal(l2_mean, l2_std)
         if l3_mean != None:
-            l3 = np.random.normal(l3_mean, l3_std, 1)
+            l3 = rng.normal(l3_mean, l3_std)
         else:
             l3 = l2
 
@@ -632,16 +1300,16 @@ def add_cells_to_config(path_config, CVF_des, l1_mean, l1_std, l2_mean, l2_std,
 
         r = Rotation.from_rotvec([
             np.deg2rad(0),
-            np.deg2rad(np.random.uniform(-rotation_lim, rotation_lim)),
-            np.deg2rad(np.random.uniform(0, 360))
+            np.deg2rad(rng.uniform(-rotation_lim, rotation_lim)),
+            np.deg2rad(rng.uniform(0, 360))
         ])
 
         shape = np.dot(np.dot(r.as_matrix().T, shape), r.as_matrix())
 
         #### GENERATE CELL POSITION
-        position_x = np.random.uniform(voxel_xmin, voxel_xmax)
-        position_y = np.random.uniform(voxel_ymin, voxel_ymax)
-        position_z = np.random.uniform(voxel_zmin, voxel_zmax)
+        position_x = rng.uniform(voxel_xmin, voxel_xmax)
+        position_y = rng.uniform(voxel_ymin, voxel_ymax)
+        position_z = rng.uniform(voxel_zmin, voxel_zmax)
 
         #### CREATE CELL DICT
         cell_new = {"position": [position_x,
@@ -653,30 +1321,34 @@ def add_cells_to_config(path_config, CVF_des, l1_mean, l1_std, l2_mean, l2_std,
         #### CHECK IF CELL EXTEND THE VOXEL
         inside = check_if_ellipsoid_extends_the_voxel(cell_new, voxel)
         if not inside:
+            n_rejections += 1
             continue
 
-        #### CHECK FOR OVERLAP WITH PREVIOUSLY PLACED CELLS
-        separated = [True] # add one True for it to work for the first cell
+        #### CHECK FOR OVERLAP WITH NEIGHBOURING CELLS
+        positions_neighbours, shapes_neighbours = grid.get_neighbour_arrays(cell_new)
 
-        for cell in config["cells"]:
-            separated.append(are_ellipsoids_separated(cell_new, cell))
+        separated = np.all(are_ellipsoids_separated_batch(
+            np.array([cell_new["position"]]), shape[np.newaxis],
+            positions_neighbours, shapes_neighbours
+        ))
 
-            # exit if just one pair of cells turns out to not be separated
-            if not separated[-1]:
-                continue
-
-        if all(separated):
+        if separated:
             # UPDATE VOLUME
             CV_current += 4/3 * np.pi * l1 * l2 * l3
             #print(CV_current, CV_current/voxel_volume)
             # ADD TO CONFIG
             config["cells"].append(cell_new)
+            grid.add(cell_new)
+            n_rejections = 0
+            # CHECKPOINT
+            if (checkpoint_interval != None) and (len(config["cells"]) % checkpoint_interval == 0):
+                with open(path_config_with_cells, 'w') as file:
+                    json.dump(config, file, indent=4)
         else:
             # try another one
-            pass
+            n_rejections += 1
 
-        path_config_with_cells = path_config.replace('.json', '-with_cells.json')
-
-        json.dump(config, open(path_config_with_cells, 'w'), indent=4)
+    with open(path_config_with_cells, 'w') as file:
+        json.dump(config, file, indent=4)
 
     return path_config_with_cells
@@ -0,0 +1,190 @@
+"""
+Packs parallel cylinders with gamma-distributed radii, like the
+cylinder_gamma_packing obstacle of MC-DC, but in memory:
+
+    cylinder_list, voxel_corners = pack_cylinders(alpha, beta, targetFVF, num_cylinders, seed=0)
+
+cylinder_list has the columns of the cylinder lists MC-DC writes,
+x0 y0 z0 x1 y1 z1 r [um], i.e. the two end points and the radius of every
+cylinder. voxel_corners are (xmin, ymin, zmin, xmax, ymax, zmax) [mm], as
+returned by CylindersListGenerator.get_voxel_corners.
+
+The radii are drawn from gamma(alpha, scale=beta) [um]. The side length of
+the voxel is chosen so that the cylinders fill targetFVF of its cross
+section. The cylinders are placed at random in it and pushed apart until no
+two overlap. Overlapping pairs are found with the grid of src.broad_phase.
+If that fails, the voxel is enlarged a little, so the fibre volume fraction
+reached may be slightly below targetFVF.
+"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.append('../')
+from src.broad_phase import UniformGrid
+
+
+
+def get_candidate_pairs(positions, radii, min_distance, skin):
+
+    """
+    Pairs of cross sections that are closer than skin (plus min_distance),
+    from the grid of src.broad_phase. They stay a superset of the overlapping
+    pairs until some cylinder has moved by more than skin / 2 along an axis.
+    """
+
+    half_extents = radii[:, None] + (min_distance + skin) / 2
+
+    lo = np.zeros((len(positions), 3))
+    hi = np.zeros((len(positions), 3))
+    lo[:, :2] = positions - half_extents
+    hi[:, :2] = positions + half_extents
+
+    grid = UniformGrid(cell_size=2 * np.median(half_extents))
+
+    return grid.build(lo, hi, np.arange(len(positions)))
+
+
+
+def get_overlaps(positions, radii, min_distance, idxs_i, idxs_j):
+
+    """
+    The candidate pairs (idxs_i, idxs_j) that overlap (including min_distance),
+    with the vector from i to j, its length and the overlap.
+    """
+
+    d = positions[idxs_j] - positions[idxs_i]
+    dists = np.linalg.norm(d, axis=-1)
+    overlaps = radii[idxs_i] + radii[idxs_j] + min_distance - dists
+
+    mask = overlaps > 0
+
+    return idxs_i[mask], idxs_j[mask], d[mask], dists[mask], overlaps[mask]
+
+
+
+def relax(positions, radii, length, min_distance=0.0, max_iterations=1000, margin=0.01, rng=None):
+
+    """
+    Pushes overlapping cross sections apart, all pairs at once, each pair in
+    inverse proportion to the areas of its two cylinders. Pairs are pushed
+    margin * (r_i + r_j) further than needed, or they would keep nudging each
+    other back into overlap. The centres are kept inside [0, length]. Works
+    on positions in place.
+
+    Returns True if no overlaps are left.
+    """
+
+    rng = np.random.default_rng(rng)
+
+    skin = np.median(radii)
+    idxs_i_candidates, idxs_j_candidates = get_candidate_pairs(positions, radii, min_distance, skin)
+    positions_candidates = positions.copy()
+
+    for _ in range(max_iterations):
+
+        # the candidates are only searched again once something moved far enough
+        if np.max(np.abs(positions - positions_candidates), initial=0) > skin / 4:
+            idxs_i_candidates, idxs_j_candidates = get_candidate_pairs(positions, radii, min_distance, skin)
+            positions_candidates = positions.copy()
+
+        idxs_i, idxs_j, d, dists, overlaps = get_overlaps(positions, radii, min_distance, idxs_i_candidates, idxs_j_candidates)
+
+        if len(idxs_i) == 0:
+            return True
+
+        # coinciding centres are pushed apart in a random direction
+        coincide = dists < 1e-12
+        d[coincide] = rng.normal(size=(np.sum(coincide), 2))
+        dists[coincide] = np.linalg.norm(d[coincide], axis=-1)
+        directions = d / dists[:, None]
+
+        areas_i, areas_j = radii[idxs_i]**2, radii[idxs_j]**2
+        amounts = overlaps + margin * (radii[idxs_i] + radii[idxs_j])
+
+        moves = np.zeros_like(positions)
+        np.add.at(moves, idxs_i, -directions * (amounts * areas_j / (areas_i + areas_j))[:, None])
+        np.add.at(moves, idxs_j, directions * (amounts * areas_i / (areas_i + areas_j))[:, None])
+
+        positions += moves
+        np.clip(positions, 0, length, out=positions)
+
+    idxs_i_candidates, idxs_j_candidates = get_candidate_pairs(positions, radii, min_distance, skin)
+
+    return len(get_overlaps(positions, radii, min_distance, idxs_i_candidates, idxs_j_candidates)[0]) == 0
+
+
+
+def pack_cylinders(alpha, beta, targetFVF, num_cylinders, seed=None, min_distance=0.0,
+                   max_iterations=1000, growth=0.01, max_growths=50):
+
+    """
+    Returns cylinder_list [um] and voxel_corners [mm] (see above) of
+    num_cylinders non-overlapping cylinders. When the cylinders can not be
+    separated within max_iterations, the voxel and the positions are scaled up
+    by 1 + growth, at most max_growths times.
+
+    seed: int, SeedSequence or Generator.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    radii = rng.gamma(alpha, beta, num_cylinders)
+    length = np.sqrt(np.sum(np.pi * radii**2) / targetFVF)
+
+    positions = rng.uniform(0, length, (num_cylinders, 2))
+
+    for _ in range(max_growths + 1):
+
+        if relax(positions, radii, length, min_distance, max_iterations, rng=rng):
+            break
+
+        positions *= 1 + growth
+        length *= 1 + growth
+
+    else:
+        raise RuntimeError(f'Could not separate {num_cylinders} cylinders at targetFVF = {targetFVF}')
+
+    FVF = np.sum(np.pi * radii**2) / length**2
+    if FVF < targetFVF - 0.005:
+        print(f'[OBS] targetFVF = {targetFVF} not reached, packed cylinders at FVF = {FVF:.3f}')
+
+    cylinder_list = np.zeros((num_cylinders, 7))
+    cylinder_list[:, 0:2] = positions
+    cylinder_list[:, 3:5] = positions
+    cylinder_list[:, 5] = length
+    cylinder_list[:, 6] = radii
+
+    voxel_corners = (0.0, 0.0, 0.0, length * 1e-3, length * 1e-3, length * 1e-3)
+
+    return cylinder_list, voxel_corners
+
+
+
+def write_substrate(path_output, idx_rep, cylinder_list, voxel_corners, scale=1e-3):
+
+    """
+    Writes rep_{idx_rep}_gamma_distributed_cylinder_list.txt and
+    rep_{idx_rep}_simulation_info.txt as MC-DC does, e.g. for the plots of
+    CylindersListGenerator. Returns their paths.
+    """
+
+    os.makedirs(path_output, exist_ok=True)
+
+    path_cylinder_list = os.path.join(path_output, f'rep_{idx_rep:02d}_gamma_distributed_cylinder_list.txt').replace('\\', '/')
+    path_simulation_info = os.path.join(path_output, f'rep_{idx_rep:02d}_simulation_info.txt').replace('\\', '/')
+
+    with open(path_cylinder_list, 'w') as file:
+        file.write(f'{scale}\n')
+        np.savetxt(file, cylinder_list, fmt='%.9g', delimiter=' ')
+
+    # the voxel corners [mm] are the last two lines
+    voxel_xmin, voxel_ymin, voxel_zmin, voxel_xmax, voxel_ymax, voxel_zmax = voxel_corners
+
+    with open(path_simulation_info, 'w') as file:
+        file.write('Voxel limits\n')
+        file.write(f'( {voxel_xmin:.9g} {voxel_ymin:.9g} {voxel_zmin:.9g} )\n')
+        file.write(f'( {voxel_xmax:.9g} {voxel_ymax:.9g} {voxel_zmax:.9g} )\n')
+
+    return path_cylinder_list, path_simulation_info
@@ -0,0 +1,291 @@
+"""
+Stops the stages of the optimisation schedule once they have converged, rather
+than at maxIterations or maxIterationsWithoutImprovement.
+
+The total volume fraction (TVF) the CLI prints each iteration is fitted with
+
+    TVF(i) = TVF_inf - A exp(-i / tau)
+
+and a stage is stopped as soon as the gain this predicts for its remaining
+iterations falls below threshold. The next stage then continues from the last
+config_output_{i}.json of the stopped one:
+
+    markers = run_chain(path_config, parameters, threshold=0.005)
+    markers = run_pipeline(paths_config_files, parameters, max_concurrent=32)
+
+The stages are run with src.wmg_runner, the configs and markers are those of
+src.pipeline_utils, so a chain can be resumed by either of the two.
+"""
+
+import os
+import json
+import asyncio
+import warnings
+import numpy as np
+from scipy.optimize import curve_fit, OptimizeWarning
+
+from src import pipeline_utils
+from src.wmg_runner import WMGRunner
+
+
+
+def saturating_exponential(i, TVF_inf, A, tau):
+
+    return TVF_inf - A * np.exp(-i / tau)
+
+
+
+class EarlyStopping():
+
+    """
+    Convergence test on the series of volume fractions of one stage.
+
+    The CLI prints the TVF rounded to resolution (toFixed(2)), so near a
+    plateau the last few dozen iterations are a staircase of one or two steps,
+    from which no trend can be told. The trend is therefore fitted to the last
+    window iterations or, if the TVF changed by less than n_steps print steps
+    over them, to as many more as it takes. Until the whole series changed by
+    that much, the stage is never stopped.
+    """
+
+    def __init__(self, n_iterations, threshold=0.005, window=50, min_iterations=None, resolution=0.01, n_steps=5):
+        """
+        n_iterations is the maxIterations of the stage. Nothing is stopped
+        before there are window iterations (or min_iterations, if that is
+        more). threshold is the projected gain of TVF below which the stage is
+        stopped.
+        """
+
+        self.n_iterations = n_iterations
+        self.threshold = threshold
+        self.window = window
+        self.min_iterations = window if min_iterations == None else max(min_iterations, window)
+        self.resolution = resolution
+        self.n_steps = n_steps
+
+        self.idxs = []
+        self.TVFs = []
+
+    def add(self, idx, TVF):
+
+        self.idxs.append(idx)
+        self.TVFs.append(TVF)
+
+    def get_window(self):
+        """
+        The (idxs, TVFs) the trend is fitted to, or None if the series does
+        not yet span n_steps print steps.
+        """
+
+        TVFs_reversed = np.array(self.TVFs[::-1], dtype=np.float64)
+        spans = np.maximum.accumulate(TVFs_reversed) - np.minimum.accumulate(TVFs_reversed)
+
+        ks = np.nonzero(spans[self.window-1:] > self.n_steps * self.resolution - 1e-9)[0]
+
+        if (len(self.idxs) < self.window) or (len(ks) == 0):
+            return None
+
+        k = self.window + ks[0]
+
+        return np.array(self.idxs[-k:], dtype=np.float64), np.array(self.TVFs[-k:], dtype=np.float64)
+
+    def fit(self, x, y):
+        """
+        Parameters (TVF_inf, A, tau) of the trend of x, y, or None if it could
+        not be fitted. A is the distance to TVF_inf at x[0], i.e. the fit is of
+        TVF(x - x[0]).
+        """
+
+        x = x - x[0]
+
+        span = max(x[-1], 1.0)
+        p0 = [y[-1] + self.resolution, max(y[-1] + self.resolution - y[0], self.resolution), span / 2]
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', OptimizeWarning)
+                params, _ = curve_fit(saturating_exponential, x, y, p0=p0,
+                                      bounds=([-np.inf, 0, 1e-3], [np.inf, np.inf, np.inf]), maxfev=2000)
+        except (RuntimeError, ValueError):
+            return None
+
+        return params
+
+    def get_projected_gain(self):
+        """
+        Gain of TVF predicted for the iterations left in the stage. Without a
+        fit it is the linear trend of the window. It is infinite while the
+        trend is unknown (see get_window).
+        """
+
+        window = self.get_window()
+
+        if window == None:
+            return np.inf
+
+        x, y = window
+        params = self.fit(x, y)
+
+        if params is not None:
+            gain = saturating_exponential(self.n_iterations - x[0], *params) - saturating_exponential(x[-1] - x[0], *params)
+        else:
+            gain = np.polyfit(x, y, 1)[0] * (self.n_iterations - x[-1])
+
+        return max(float(gain), 0.0)
+
+    def should_stop(self):
+
+        if len(self.idxs) < self.min_iterations:
+            return False
+
+        return self.get_projected_gain() < self.threshold
+
+
+
+def get_path_config_output_of_iteration(path_output, idx):
+
+    return os.path.join(path_output, f'config_output_{idx}.json').replace('\\', '/')
+
+
+
+async def run_stage(path_config, stage, parameters, targetFVF, threshold=0.005, window=50, min_iterations=None,
+                    timeout=None, executable='white-matter-generator'):
+
+    """
+    Runs one stage and stops it once EarlyStopping says so. Returns the marker
+    of pipeline_utils.run_stage, plus the number of iterations run and whether
+    the stage was stopped early.
+
+    The CLI only writes config_output_{i}.json every outputInterval iterations,
+    and only after it printed iteration i. So a converged stage is terminated
+    at the first iteration j before which such a config was completed, i.e.
+    once (j - 1) // outputInterval >= 1, and continues from that config.
+    """
+
+    path_output = pipeline_utils.get_path_output(path_config)
+    pipeline_utils.clear_output(path_output)
+    interval = stage['outputInterval']
+
+    runner = WMGRunner.from_stage(path_config, stage, parameters, targetFVF,
+                                  timeout=timeout, executable=executable)
+    early_stopping = EarlyStopping(stage['maxIterations'], threshold, window, min_iterations)
+
+    converged = False
+    idx_config = None
+
+    async for idx, AVF, CVF, TVF, timestamp in runner.iterate():
+
+        if idx_config != None:
+            continue
+
+        early_stopping.add(idx, TVF)
+        converged = converged or early_stopping.should_stop()
+
+        if converged and ((idx - 1) // interval >= 1):
+            idx_config = ((idx - 1) // interval) * interval
+            runner.cancel()
+
+    result = await runner.run()
+
+    marker = {
+        'path_config' : path_config,
+        'hash_config' : pipeline_utils.get_hash_of_file(path_config),
+        'path_config_output' : None,
+        'returncode' : result['returncode'],
+        'time' : result['time'],
+        'iterations' : int(runner.iteration),
+        'stopped_early' : idx_config != None,
+    }
+
+    if idx_config != None:
+        marker['returncode'] = 0
+        marker['path_config_output'] = get_path_config_output_of_iteration(path_output, idx_config)
+    elif result['status'] != 'done':
+        marker['stderr'] = result.get('stderr', '')
+        return marker
+    else:
+        marker['path_config_output'] = pipeline_utils.get_path_config_output(path_output)
+
+    with open(pipeline_utils.get_path_marker(path_output), 'w') as file:
+        json.dump(marker, file, indent=4)
+
+    return marker
+
+
+
+async def run_chain_async(path_config, parameters, threshold=0.005, window=50, min_iterations=None,
+                          resume=True, timeout=None, executable='white-matter-generator'):
+
+    """
+    pipeline_utils.run_chain with early stopping of every stage.
+    """
+
+    targetFVF = float(path_config.split('targetFVF=')[-1].split('-')[0])
+
+    markers = []
+
+    # once a stage is run, the later ones have to be run again too
+    resume_stage = resume
+
+    for counter, stage in enumerate(pipeline_utils.get_stages(parameters)):
+
+        path_config_stage = pipeline_utils.get_path_config_of_stage(path_config, counter)
+        path_output = pipeline_utils.get_path_output(path_config_stage)
+
+        marker = pipeline_utils.load_marker(path_output, path_config_stage) if resume_stage else None
+
+        if marker == None:
+
+            resume_stage = False
+
+            if counter > 0:
+                pipeline_utils.prepare_config_of_stage(markers[-1]['path_config_output'], path_config_stage, stage)
+
+            marker = await run_stage(path_config_stage, stage, parameters, targetFVF, threshold, window,
+                                     min_iterations, timeout, executable)
+
+            print(f'[LOG] {path_config_stage}: {marker.get("iterations")} / {stage["maxIterations"]} iterations'
+                  + (' (stopped early)' if marker.get('stopped_early') else '')
+                  + ', time consumption: %.2f s' %marker['time'])
+
+        else:
+            print(f'[LOG] {path_config_stage}: already done, skipping...')
+
+        markers.append(marker)
+
+        if (marker['returncode'] != 0) or (marker['path_config_output'] == None):
+            print(f'[OBS] {path_config_stage} failed with return code {marker["returncode"]}:')
+            print(marker.get('stderr', 'no config_output written'))
+            break
+
+    return markers
+
+
+
+def run_chain(path_config, parameters, **kwargs):
+
+    return asyncio.run(run_chain_async(path_config, parameters, **kwargs))
+
+
+
+async def run_pipeline_async(paths_config_files, parameters, max_concurrent=None, **kwargs):
+
+    """
+    The chains of many configs at once, at most max_concurrent at a time
+    (None = one per CPU), in one event loop. Returns the markers of every
+    chain, in the order of paths_config_files.
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrent if max_concurrent != None else os.cpu_count())
+
+    async def run(path_config):
+        async with semaphore:
+            return await run_chain_async(path_config, parameters, **kwargs)
+
+    return await asyncio.gather(*[run(path_config) for path_config in paths_config_files])
+
+
+
+def run_pipeline(paths_config_files, parameters, max_concurrent=None, **kwargs):
+
+    return asyncio.run(run_pipeline_async(paths_config_files, parameters, max_concurrent, **kwargs))
@@ -0,0 +1,312 @@
+"""
+Runs many MC-DC simulations on the local machine within a budget of cores, e.g.
+
+    scheduler = MCDCScheduler('../simulations/queue', n_cores=32)
+    scheduler.add(paths_config_files)
+    scheduler.run()
+
+Every config takes as many cores as its num_process asks for, so a job with
+num_process = 8 waits until 8 cores are free. Jobs are started in the order
+they were added; smaller jobs further down the queue fill up cores that a
+bigger job cannot use yet.
+
+The queue is kept in {path_queue}/queue.json and the stdout/stderr of each job
+in {path_queue}/logs/. The json is rewritten whenever a job starts or ends, so
+that an interrupted queue can be picked up again by running it once more:
+finished jobs are skipped and interrupted ones are started again.
+
+The MCDC repetitions that generate cylinder lists can be queued in the same
+scheduler, so that they share its budget with the simulations:
+
+    config_utils.generate_cylinder_list(..., scheduler=scheduler)
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import subprocess
+
+sys.path.append('../')
+from src import GenerateMCDCConfigFile
+
+
+
+NAME_QUEUE = 'queue.json'
+
+
+
+def get_num_process(path_config, n_cores):
+
+    """
+    Number of cores a config asks for. num_process = -n means all cores but n.
+    Never less than 1 or more than n_cores.
+    """
+
+    num_process = 1
+
+    with open(path_config, 'r') as file:
+        for line in file:
+            words = line.split()
+            if (len(words) == 2) and (words[0] == 'num_process'):
+                num_process = int(words[1])
+                break
+
+    if num_process <= 0:
+        num_process = os.cpu_count() + num_process
+
+    return min(max(num_process, 1), n_cores)
+
+
+
+def get_command(path_config, executable='MC-DC_Simulator'):
+
+    if platform.system() == 'Windows':
+        return ['wsl', executable, path_config]
+
+    return [executable, path_config]
+
+
+
+class MCDCScheduler():
+
+    def __init__(self, path_queue, n_cores=None, executable='MC-DC_Simulator'):
+        """
+        path_queue is the directory holding the queue and the logs. n_cores is
+        the number of cores all running jobs may use together (None = all).
+        """
+
+        self.path_queue = path_queue
+        self.path_logs = os.path.join(path_queue, 'logs')
+        self.n_cores = n_cores if n_cores != None else os.cpu_count()
+        self.executable = executable
+
+        os.makedirs(self.path_logs, exist_ok=True)
+
+        self._lock = threading.Condition()
+        self._processes = {}
+        self._stopping = False
+
+        self.jobs = self._load()
+
+    #### Queue
+
+    def _load(self):
+
+        path = os.path.join(self.path_queue, NAME_QUEUE)
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, 'r') as file:
+            jobs = json.load(file)
+
+        for job in jobs.values():
+            # jobs that were running when the queue stopped have to run again
+            if job['status'] == 'running':
+                job['status'] = 'pending'
+            # the budget may be smaller than when the job was queued
+            job['n_cores'] = min(job['n_cores'], self.n_cores)
+
+        return jobs
+
+    def _save(self):
+
+        path = os.path.join(self.path_queue, NAME_QUEUE)
+
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.jobs, file, indent=4)
+
+        os.replace(path + '.tmp', path)
+
+    def add(self, paths_config):
+        """
+        Appends configs to the queue. Configs that are already queued (done or
+        not) are not added again.
+        """
+
+        with self._lock:
+
+            for path_config in paths_config:
+
+                key = os.path.abspath(path_config)
+
+                if key in self.jobs:
+                    continue
+
+                name = f'{len(self.jobs):05d}_' + os.path.basename(path_config).replace('.conf', '')
+
+                self.jobs[key] = {
+                    'path_config' : key,
+                    'n_cores' : get_num_process(path_config, self.n_cores),
+                    'status' : 'pending',
+                    'returncode' : None,
+                    'time_start' : None,
+                    'time' : None,
+                    'path_stdout' : os.path.join(self.path_logs, name + '.out'),
+                    'path_stderr' : os.path.join(self.path_logs, name + '.err'),
+                }
+
+            self._save()
+
+    def reset(self, paths_config):
+        """
+        Sets queued configs back to pending, e.g. done jobs whose output has
+        been removed since.
+        """
+
+        with self._lock:
+
+            for path_config in paths_config:
+                job = self.jobs[os.path.abspath(path_config)]
+                job['status'] = 'pending'
+                job['returncode'] = None
+
+            self._save()
+
+    def get_counts(self):
+
+        counts = {'pending' : 0, 'running' : 0, 'done' : 0, 'failed' : 0}
+
+        for job in self.jobs.values():
+            counts[job['status']] += 1
+
+        return counts
+
+    #### Running
+
+    def _run_job(self, key):
+
+        job = self.jobs[key]
+
+        with open(job['path_stdout'], 'w') as stdout, open(job['path_stderr'], 'w') as stderr:
+
+            time0 = time.time()
+
+            try:
+                process = subprocess.Popen(get_command(job['path_config'], self.executable),
+                                           stdout=stdout, stderr=stderr, text=True)
+            except OSError as e:
+                stderr.write(f'{e}\n')
+                process = None
+
+            if process != None:
+                with self._lock:
+                    self._processes[key] = process
+                returncode = process.wait()
+            else:
+                returncode = -1
+
+        with self._lock:
+
+            self._processes.pop(key, None)
+
+            if self._stopping:
+                job['status'] = 'pending'
+            else:
+                job['status'] = 'done' if returncode == 0 else 'failed'
+                job['returncode'] = returncode
+                job['time'] = time.time() - time0
+
+                if returncode != 0:
+                    print(f'[OBS] {job["path_config"]} failed with return code {returncode}, see {job["path_stderr"]}')
+
+            self._save()
+            self._lock.notify_all()
+
+    def run(self, retry_failed=False):
+        """
+        Runs all pending jobs and blocks until they have finished. With
+        retry_failed = True, jobs that failed in an earlier run are run again.
+
+        On KeyboardInterrupt the running simulations are terminated and left
+        pending in the queue.
+
+        Returns the counts of jobs per status.
+        """
+
+        with self._lock:
+
+            if retry_failed:
+                for job in self.jobs.values():
+                    if job['status'] == 'failed':
+                        job['status'] = 'pending'
+
+            self._stopping = False
+            threads = []
+
+            print(f'[LOG] {self.get_counts()["pending"]} job(s) to run on {self.n_cores} core(s)')
+
+            try:
+                while True:
+
+                    n_cores_free = self.n_cores - sum([job['n_cores'] for job in self.jobs.values() if job['status'] == 'running'])
+
+                    pending = [key for key, job in self.jobs.items() if job['status'] == 'pending']
+                    running = [key for key, job in self.jobs.items() if job['status'] == 'running']
+
+                    if (len(pending) == 0) and (len(running) == 0):
+                        break
+
+                    for key in pending:
+                        job = self.jobs[key]
+                        if job['n_cores'] <= n_cores_free:
+                            job['status'] = 'running'
+                            job['time_start'] = time.time()
+                            n_cores_free -= job['n_cores']
+                            thread = threading.Thread(target=self._run_job, args=(key,), daemon=True)
+                            thread.start()
+                            threads.append(thread)
+
+                    self._save()
+                    self._lock.wait()
+
+            except KeyboardInterrupt:
+                self._stopping = True
+                for process in self._processes.values():
+                    process.terminate()
+                print('[OBS] Interrupted, the running jobs are left pending')
+
+        for thread in threads:
+            thread.join()
+
+        with self._lock:
+            for job in self.jobs.values():
+                if job['status'] == 'running':
+                    job['status'] = 'pending'
+            self._save()
+
+        counts = self.get_counts()
+        print(f'[LOG] {counts["done"]} done, {counts["failed"]} failed, {counts["pending"]} pending')
+
+        return counts
+
+
+
+def simulate_meshes(path_meshes, path_pattern_out, path_queue, density_particles, T,
+                    duration, diffusivity, num_process, path_scheme_file,
+                    buffer_sampling_area, scale=1e-3, voxel_lims=None, n_cores=None,
+                    executable='MC-DC_Simulator'):
+
+    """
+    Writes the MC-DC configs of every mesh in path_meshes (see
+    GenerateMCDCConfigFile.write_config_files_of_directory), queues them in
+    path_queue and runs the queue within n_cores cores.
+    """
+
+    GenerateMCDCConfigFile.write_config_files_of_directory(
+        path_meshes, path_pattern_out, density_particles, T, duration, diffusivity,
+        num_process, path_scheme_file, buffer_sampling_area, scale=scale, voxel_lims=voxel_lims)
+
+    paths_config = []
+    for path_mesh in sorted(os.listdir(path_meshes)):
+        path_config = GenerateMCDCConfigFile.get_path_config_file(os.path.join(path_meshes, path_mesh).replace('\\', '/'), path_pattern_out)
+        if path_mesh.endswith('.ply') and os.path.exists(path_config):
+            paths_config.append(path_config)
+
+    scheduler = MCDCScheduler(path_queue, n_cores=n_cores, executable=executable)
+    scheduler.add(paths_config)
+
+    return scheduler.run()
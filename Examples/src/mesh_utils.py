@@ -0,0 +1,235 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm.auto import tqdm
+from pygel3d import hmesh
+
+from src import ply_utils
+
+
+
+#### LOAD/SAVE ####
+
+def load_mesh(path_mesh, close_holes=True):
+
+    """
+    Loads a WMG .ply-mesh. With close_holes = True, the holes at each end of
+    the axon/myelin are closed and the patches are triangulated.
+    """
+
+    m = hmesh.ply_load(path_mesh)
+
+    if close_holes:
+        # close holes at each end
+        hmesh.close_holes(m)
+        # triangulate the patches that were added to close the holes
+        hmesh.triangulate(m)
+
+    return m
+
+
+
+def get_faces(m):
+
+    """
+    Vertex indices of each (triangular) face as an (n_faces, 3) array.
+    """
+
+    return np.array([list(m.circulate_face(f, mode='v')) for f in m.faces()], dtype=np.int64).reshape((-1, 3))
+
+
+
+def save_ply(path_mesh, m, comments=[]):
+
+    """
+    pygel3d cannot write .ply, which is what MC-DC reads, so the mesh is written
+    as an ASCII .ply here.
+    """
+
+    m.cleanup()
+
+    positions = m.positions()
+    faces = get_faces(m)
+
+    header = ['ply', 'format ascii 1.0']
+    header += [f'comment {comment}' for comment in comments]
+    header += [f'element vertex {len(positions)}',
+               'property float x', 'property float y', 'property float z',
+               f'element face {len(faces)}',
+               'property list uchar int vertex_indices',
+               'end_header']
+
+    with open(path_mesh, 'w') as file:
+        file.write('\n'.join(header) + '\n')
+        np.savetxt(file, positions, fmt='%.9g')
+        np.savetxt(file, np.hstack([np.full((len(faces), 1), 3), faces]), fmt='%d')
+
+
+
+def get_comments_of_ply(path_mesh):
+
+    """
+    The comment lines of a .ply-header (e.g. voxel_xmin=...), without the payload.
+    """
+
+    return ply_utils.read_header(path_mesh)['comments']
+
+
+
+#### SIMPLIFICATION ####
+
+def get_max_deviation(m_simplified, m_original):
+
+    D = hmesh.MeshDistance(m_simplified)
+
+    dist_values = D.signed_distance(m_original.positions())
+
+    return np.max(np.abs(dist_values)), dist_values
+
+
+
+def simplify_mesh(m_original, tolerance, resolution=0.01):
+
+    """
+    Constrained Garland-Heckbert-simplification: finds the smallest keep_fraction
+    (on a grid of step resolution) for which the simplified mesh deviates no
+    more than tolerance from the original mesh.
+
+    The deviation grows (close to) monotonically as keep_fraction shrinks, so
+    the grid is bisected: about log2(1/resolution) simplifications instead of
+    one per step. keep_fraction = 1 is taken to always be within tolerance.
+
+    Returns the simplified mesh, keep_fraction, the max deviation and the
+    signed distance of every original vertex to the simplified mesh.
+    """
+
+    n_steps = int(round(1 / resolution))
+
+    results = {}
+
+    def simplify(step):
+        if step not in results:
+            m_simplified = hmesh.Manifold(m_original)
+            hmesh.quadric_simplify(m_simplified, step * resolution)
+            dist_abs_max, dist_values = get_max_deviation(m_simplified, m_original)
+            results[step] = (m_simplified, dist_abs_max, dist_values)
+        return results[step]
+
+    # smallest step (in [1, n_steps]) within tolerance
+    step_lo, step_hi = 0, n_steps
+    while step_hi - step_lo > 1:
+        step = (step_lo + step_hi) // 2
+        if simplify(step)[1] <= tolerance:
+            step_hi = step
+        else:
+            step_lo = step
+
+    if step_hi == n_steps:
+        # keep everything
+        m_simplified = hmesh.Manifold(m_original)
+        dist_abs_max, dist_values = get_max_deviation(m_simplified, m_original)
+    else:
+        m_simplified, dist_abs_max, dist_values = results[step_hi]
+
+    return m_simplified, step_hi * resolution, dist_abs_max, dist_values
+
+
+
+def get_tolerance(minimumDistance, delta=0.0005):
+
+    """
+    The simplified mesh must not deviate more than minDistance/2-delta from the
+    original mesh, to prevent inducing overlaps between meshes in the phantom.
+    """
+
+    return minimumDistance / 2 - delta
+
+
+
+def simplify_mesh_file(path_mesh, path_mesh_out, tolerance, resolution=0.01, close_holes=True):
+
+    """
+    Loads, closes, simplifies and saves a single mesh. The comments of the
+    original header (the voxel_* limits) are kept.
+
+    Returns a dict with the vertex counts, keep_fraction and max deviation.
+    """
+
+    m_original = load_mesh(path_mesh, close_holes=close_holes)
+
+    m_simplified, keep_fraction, dist_abs_max, _ = simplify_mesh(m_original, tolerance, resolution)
+
+    n_vertices_original = len(m_original.vertices())
+    n_vertices_simplified = len(m_simplified.vertices())
+
+    save_ply(path_mesh_out, m_simplified, comments=get_comments_of_ply(path_mesh))
+
+    return {
+        'path_mesh' : path_mesh,
+        'path_mesh_out' : path_mesh_out,
+        'n_vertices_original' : n_vertices_original,
+        'n_vertices_simplified' : n_vertices_simplified,
+        'keep_fraction' : keep_fraction,
+        'dist_abs_max' : float(dist_abs_max),
+    }
+
+
+
+def simplify_mesh_files(jobs, resolution=0.01, close_holes=True, n_workers=None):
+
+    """
+    Runs simplify_mesh_file for every (path_mesh, path_mesh_out, tolerance) in
+    jobs on a pool of n_workers processes (None = one per CPU).
+
+    Returns the result of simplify_mesh_file for each job, in the order of
+    jobs, or None for the meshes that failed.
+    """
+
+    results = [None] * len(jobs)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+        futures = {executor.submit(simplify_mesh_file, path_mesh, path_mesh_out, tolerance, resolution, close_holes): idx
+                   for idx, (path_mesh, path_mesh_out, tolerance) in enumerate(jobs)}
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+
+            idx = futures[future]
+
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                print(f'[OBS] Failed to simplify {jobs[idx][0]}: {e}')
+
+    n_failed = sum([result == None for result in results])
+
+    if n_failed > 0:
+        print(f'[OBS] {n_failed} of {len(jobs)} mesh(es) failed')
+
+    return results
+
+
+
+def simplify_meshes_in_folder(path_meshes, minimumDistance, path_output=None,
+                              tags=('axon', 'myelin'), resolution=0.01, n_workers=None):
+
+    """
+    Simplifies every .ply in path_meshes whose name contains one of tags with
+    simplify_mesh_files. The simplified meshes are written to path_output
+    (default: path_meshes + '_simplified') under the same names.
+
+    Returns the result of simplify_mesh_file for each mesh, in sorted order
+    (None for the meshes that failed).
+    """
+
+    if path_output == None:
+        path_output = os.path.normpath(path_meshes) + '_simplified'
+    os.makedirs(path_output, exist_ok=True)
+
+    tolerance = get_tolerance(minimumDistance)
+
+    names = np.sort([n for n in os.listdir(path_meshes) if n.endswith('.ply') and any([tag in n for tag in tags])])
+
+    jobs = [(os.path.join(path_meshes, name), os.path.join(path_output, name), tolerance) for name in names]
+
+    return simplify_mesh_files(jobs, resolution=resolution, n_workers=n_workers)
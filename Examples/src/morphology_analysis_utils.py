@@ -1,14 +1,16 @@
 import numpy as np
 import os
-import json
-from sklearn.decomposition import PCA
-import math
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import scipy.stats as stats
 from scipy.stats import gamma
 from scipy.optimize import curve_fit
 from sklearn.metrics import r2_score
 
+sys.path.append('../')
+from src import config_arrays_utils
+
 
 
 def get_colors_without_cells():
@@ -38,175 +40,376 @@ def get_sinousity_from_centreline(centreline):
 
 def get_max_deviation_from_centreline(centreline):
     
-    position_a = np.array(centreline[0])
-    position_b = np.array(centreline[-1])
-
-    distance_max = -np.inf
-        
-    for position_c in centreline:
+    centreline = np.asarray(centreline)
 
-        distance = np.linalg.norm(np.cross(position_b-position_a, position_a-position_c))/np.linalg.norm(position_b-position_a)
+    position_a = centreline[0]
+    position_b = centreline[-1]
 
-        if distance > distance_max:
-            distance_max = distance
+    distances = np.linalg.norm(np.cross(position_b-position_a, position_a-centreline), axis=-1)/np.linalg.norm(position_b-position_a)
     
-    return distance_max
+    return np.max(distances)
+
+
+
+#### RAGGED (ALL AXONS AT ONCE) ####
+# The points of all axons are stacked into one (N, 3) array, and the points of
+# axon i are positions[offsets[i]:offsets[i+1]] (see config_arrays_utils).
+# All axons are assumed to have at least one point.
+
+def get_means_and_stds(values, offsets):
+
+    """
+    Mean and (population) std of values for each axon.
+    """
+
+    counts = np.diff(offsets)
+
+    means = np.add.reduceat(values, offsets[:-1]) / counts
+    deviations = values - np.repeat(means, counts)
+    stds = np.sqrt(np.add.reduceat(deviations**2, offsets[:-1]) / counts)
+
+    return means, stds
+
+
+
+def resample_centrelines(positions, offsets, dist_sampling):
+
+    """
+    Keeps the first point of every axon and then, along each axon, the next
+    point that is more than dist_sampling away from the last kept point.
+
+    The next kept point is found for all points at once by stepping further
+    along the axons, and the chains of kept points of all axons are then
+    followed simultaneously.
+
+    Returns the indices of the kept points and their offsets.
+    """
+
+    n_points = len(positions)
+    ends = np.repeat(offsets[1:], np.diff(offsets))
+
+    # idxs_next[i]: first point j > i on the same axon with |p_j - p_i| > dist_sampling (or the end of the axon)
+    idxs_next = ends.copy()
+    unresolved = np.arange(n_points)
+
+    step = 1
+    while len(unresolved) > 0:
+
+        candidates = unresolved + step
+
+        on_axon = candidates < ends[unresolved]
+        unresolved, candidates = unresolved[on_axon], candidates[on_axon]
+
+        far = np.linalg.norm(positions[candidates] - positions[unresolved], axis=-1) > dist_sampling
+        idxs_next[unresolved[far]] = candidates[far]
+
+        unresolved = unresolved[~far]
+        step += 1
+
+    # follow the chains of all axons at once
+    idxs_kept = []
+    current, current_ends = offsets[:-1], offsets[1:]
+
+    while True:
+        on_axon = current < current_ends
+        current, current_ends = current[on_axon], current_ends[on_axon]
+        if len(current) == 0:
+            break
+        idxs_kept.append(current)
+        current = idxs_next[current]
+
+    idxs_kept = np.sort(np.concatenate(idxs_kept)) if len(idxs_kept) > 0 else np.zeros(0, dtype=int)
+
+    offsets_kept = np.searchsorted(idxs_kept, offsets)
+
+    return idxs_kept, offsets_kept
+
+
+
+def get_sinousities(positions, offsets):
+
+    starts, lasts = offsets[:-1], offsets[1:] - 1
+
+    lengths_segments = np.linalg.norm(np.diff(positions, axis=0, prepend=positions[:1]), axis=-1)
+    lengths_segments[starts] = 0.0 # no segment leading into the first point of an axon
+
+    lengths_along_traj = np.add.reduceat(lengths_segments, starts)
+    lengths_straight = np.linalg.norm(positions[lasts] - positions[starts], axis=-1)
+
+    return lengths_along_traj / lengths_straight
+
+
+
+def get_max_deviations(positions, offsets):
+
+    counts = np.diff(offsets)
+
+    position_a = np.repeat(positions[offsets[:-1]], counts, axis=0)
+    position_b = np.repeat(positions[offsets[1:] - 1], counts, axis=0)
+
+    distances = np.linalg.norm(np.cross(position_b-position_a, position_a-positions), axis=-1)/np.linalg.norm(position_b-position_a, axis=-1)
+
+    return np.maximum.reduceat(distances, offsets[:-1])
+
+
+
+def get_equivalent_diameters(shapes):
+
+    """
+    The diameter of a circle which has an area equal to that of the ellipse
+    cross-section (in the xy-plane) of each ellipsoid.
+    """
+
+    return 2 * np.sqrt(shapes[:, 0, 0] * shapes[:, 1, 1])
+
+
+
+def get_eccentricities(shapes):
+
+    a = np.maximum(shapes[:, 0, 0], shapes[:, 1, 1])
+    b = np.minimum(shapes[:, 0, 0], shapes[:, 1, 1])
+
+    return np.sqrt(1 - b**2/a**2)
+
+
+
+def get_PCAs(positions, offsets):
+
+    """
+    Same as fitting sklearn's PCA(n_components=3) to each axon: returns the
+    explained variances (n_axons, 3) and components (n_axons, 3, 3). Like
+    sklearn, the components are the right singular vectors of the centred
+    points, with svd_flip's sign convention (largest absolute entry of a
+    component is positive). Axons with the same number of points are
+    decomposed in one batched np.linalg.svd.
+    """
+
+    counts = np.diff(offsets)
+
+    means = np.add.reduceat(positions, offsets[:-1], axis=0) / counts[:, np.newaxis]
+    centred = positions - np.repeat(means, counts, axis=0)
+
+    eigvals = np.zeros((len(counts), 3))
+    eigvecs = np.zeros((len(counts), 3, 3))
+
+    for count in np.unique(counts):
+
+        idxs_axon = np.flatnonzero(counts == count)
+        points = centred[offsets[idxs_axon][:, np.newaxis] + np.arange(count)]
+
+        # zero rows do not change the decomposition but give all 3 components
+        if count < 3:
+            points = np.concatenate([points, np.zeros((len(idxs_axon), 3 - count, 3))], axis=1)
+
+        _, singular_values, Vt = np.linalg.svd(points, full_matrices=False)
+
+        eigvals[idxs_axon] = singular_values**2 / max(count - 1, 1)
+        eigvecs[idxs_axon] = Vt
+
+    eigvals = np.maximum(eigvals, 0)
+
+    idxs_max = np.argmax(np.abs(eigvecs), axis=-1)
+    signs = np.sign(np.take_along_axis(eigvecs, idxs_max[:, :, np.newaxis], axis=-1))
+    eigvecs = eigvecs * signs
+
+    return eigvals, eigvecs
+
+
+
+#### XNH CENTRELINES ####
+
+def load_centreline_file(path_axon):
+
+    """
+    Same result as np.loadtxt(path_axon, delimiter=','), but parsed in one go.
+    """
+
+    with open(path_axon, 'r') as file:
+        lines = file.read().strip().splitlines()
+
+    n_columns = lines[0].count(',') + 1
+
+    values = np.array(','.join(lines).split(','), dtype=np.float64)
+
+    return values.reshape((-1, n_columns))
+
+
+
+def get_path_centrelines_cache(path_centrelines):
+
+    """
+    The cache lives next to (not in) the directory, since every file in the
+    directory is read as a centreline.
+    """
+
+    return os.path.normpath(path_centrelines) + '.npz'
+
+
+
+def load_centrelines(path_centrelines, cache=True, n_workers=None):
+
+    """
+    Loads every centreline file in path_centrelines (in sorted order).
+
+    Returns the names of the files, all their rows stacked into one array and the
+    offsets of each file's rows in that array (i.e. the rows of file i are
+    quantified[offsets[i]:offsets[i+1]]).
+
+    The files are parsed on a pool of n_workers processes (None = one per CPU).
+    With cache = True, the parsed rows are stored in a binary cache keyed by the
+    name, mtime and size of each file, and only new or modified files are parsed
+    again.
+    """
+
+    names = np.sort(os.listdir(path_centrelines))
+    paths = [os.path.join(path_centrelines, name) for name in names]
+
+    stats_files = [os.stat(path) for path in paths]
+    mtimes = np.array([stat.st_mtime_ns for stat in stats_files], dtype=np.int64)
+    sizes = np.array([stat.st_size for stat in stats_files], dtype=np.int64)
+
+    #### reuse the cached rows of unchanged files
+    quantified_per_file = [None] * len(names)
+
+    path_cache = get_path_centrelines_cache(path_centrelines)
+
+    if cache and os.path.exists(path_cache):
+
+        with np.load(path_cache) as npz:
+            keys_cached = {(name, mtime, size): i for i, (name, mtime, size) in enumerate(zip(npz['names'], npz['mtimes'], npz['sizes']))}
+            offsets_cached = npz['offsets']
+            quantified_cached = npz['quantified']
+
+        for i, key in enumerate(zip(names, mtimes, sizes)):
+            if key in keys_cached:
+                j = keys_cached[key]
+                quantified_per_file[i] = quantified_cached[offsets_cached[j]:offsets_cached[j+1]]
+
+    #### parse the rest
+    idxs_to_parse = [i for i, quantified in enumerate(quantified_per_file) if quantified is None]
+
+    if len(idxs_to_parse) > 0:
+
+        if n_workers == 1:
+            parsed = [load_centreline_file(paths[i]) for i in idxs_to_parse]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                parsed = list(executor.map(load_centreline_file, [paths[i] for i in idxs_to_parse]))
+
+        for i, quantified in zip(idxs_to_parse, parsed):
+            quantified_per_file[i] = quantified
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(quantified) for quantified in quantified_per_file])
+    quantified = np.concatenate(quantified_per_file) if len(names) > 0 else np.zeros((0, 8))
+
+    if cache and (len(idxs_to_parse) > 0 or not os.path.exists(path_cache)):
+        with open(path_cache + '.tmp', 'wb') as file:
+            np.savez(file, names=names, mtimes=mtimes, sizes=sizes, offsets=offsets, quantified=quantified)
+        os.replace(path_cache + '.tmp', path_cache)
+
+    return names, quantified, offsets
 
 
 
 # def get_synchrotron_dict(path_centrelines):
-def get_morphological_metrics_from_centrelines(path_centrelines):
+def get_morphological_metrics_from_centrelines(path_centrelines, cache=True, n_workers=None):
     
+    """
+    See load_centrelines for cache and n_workers.
+    """
+
+    names, quantified, offsets = load_centrelines(path_centrelines, cache=cache, n_workers=n_workers)
+
+    # x [voxel-coords], y [voxel-coords], z [voxel-coords], tx, ty, tz, diameter [mm], eccentricity
+    axonCentrelines = quantified[:, :3] * 0.5 #
+    axonDiameters = quantified[:, 6] * 1e3
+    axonEccentricities = quantified[:, -1]
+
+    axonDiameters_mean, axonDiameters_std = get_means_and_stds(axonDiameters, offsets)
+    axonEccentricities_mean, axonEccentricities_std = get_means_and_stds(axonEccentricities, offsets)
+
+    def split(values):
+        return np.split(values, offsets[1:-1])
+
     metrics = {
-        'axonCentrelines': [],
-        'axonSinousity': [],
-        'axonMaxDeviation': [],
-        'axonDiameters': [],
-        'axonDiameters_mean': [],
-        'axonDiameters_std': [],
-        'axonEccentricities': [],
-        'axonEccentricities_mean': [],
-        'axonEccentricities_std': [],
+        'axonCentrelines': split(axonCentrelines),
+        'axonSinousity': get_sinousities(axonCentrelines, offsets).tolist(),
+        'axonMaxDeviation': get_max_deviations(axonCentrelines, offsets).tolist(),
+        'axonDiameters': split(axonDiameters),
+        'axonDiameters_mean': axonDiameters_mean.tolist(),
+        'axonDiameters_std': axonDiameters_std.tolist(),
+        'axonEccentricities': split(axonEccentricities),
+        'axonEccentricities_mean': axonEccentricities_mean.tolist(),
+        'axonEccentricities_std': axonEccentricities_std.tolist(),
     }
 
-    for name_axon in np.sort(os.listdir(path_centrelines)):
-
-        path_axon = os.path.join(path_centrelines, name_axon)
-
-        quantified = np.loadtxt(path_axon, delimiter=',') # x [voxel-coords], y [voxel-coords], z [voxel-coords], tx, ty, tz, diameter [mm], eccentricity
-
-        axonCentreline = quantified[:, :3] * 0.5 #
-        axonSinousity = get_sinousity_from_centreline(axonCentreline)
-        axonMaxDeviation = get_max_deviation_from_centreline(axonCentreline)
-        axonDiameter = quantified[:, 6] * 1e3
-        axonDiameter_mean = np.mean(axonDiameter)
-        axonDiameter_std = np.std(axonDiameter)
-        axonEccentricity = quantified[:, -1]
-        axonEccentricity_mean = np.mean(axonEccentricity)
-        axonEccentricity_std = np.std(axonEccentricity)
-
-        metrics['axonCentrelines'].append(axonCentreline)
-        metrics['axonSinousity'].append(axonSinousity)
-        metrics['axonMaxDeviation'].append(axonMaxDeviation)
-        metrics['axonDiameters'].append(axonDiameter)
-        metrics['axonDiameters_mean'].append(axonDiameter_mean)
-        metrics['axonDiameters_std'].append(axonDiameter_std)
-        metrics['axonEccentricities'].append(axonEccentricity)
-        metrics['axonEccentricities_mean'].append(axonEccentricity_mean)
-        metrics['axonEccentricities_std'].append(axonEccentricity_std)
-        
     return metrics
 
 
 
-def get_morphological_metrics_from_WMG_config(path_config, dist_sampling=0.5):
+def get_morphological_metrics_from_WMG_config(path_config, dist_sampling=0.5, cache=False):
 
     """
     dist_sampling = 0.5 [um] is set to match the sampling distance with that applied to the 
     centrelines extracted from the XNH-images.
+
+    All axons are processed at once on the columnar arrays of the config (see
+    config_arrays_utils). With cache = True those arrays are kept as an .npz
+    next to the config, so that repeated analyses skip parsing the JSON.
     """
 
     alpha = float(path_config.split('alpha=')[-1].split('-')[0])
     beta = float(path_config.split('beta=')[-1].split('-')[0])
     
+    arrays = config_arrays_utils.load_WMG_config_arrays(path_config, cache=cache, mmap=False)
+
+    #### resample the centrelines
+    idxs, offsets = resample_centrelines(arrays['ellipsoid_positions'], arrays['axon_offsets'], dist_sampling)
+
+    axonCentrelines = arrays['ellipsoid_positions'][idxs]
+    axonDiameters = arrays['ellipsoid_axonDiameters'][idxs]
+    myelinDiameters = arrays['ellipsoid_myelinDiameters'][idxs] # 2 * np.sqrt(S[0, 0] * S[1, 1]), or 2 * np.sqrt(np.linalg.det(S) / S[2, 2])
+    shapes = arrays['ellipsoid_shapes'][idxs]
+    myelinEquivalentDiameters = get_equivalent_diameters(shapes)
+    axonEccentricities = get_eccentricities(shapes)
+
+    #### compute stuff
+    axonSinousity = get_sinousities(axonCentrelines, offsets)
+    axonMaxDeviation = get_max_deviations(axonCentrelines, offsets)
+    axonDiameters_mean, axonDiameters_std = get_means_and_stds(axonDiameters, offsets)
+    myelinDiameters_mean, myelinDiameters_std = get_means_and_stds(myelinDiameters, offsets)
+    myelinEquivalentDiameters_mean, myelinEquivalentDiameters_std = get_means_and_stds(myelinEquivalentDiameters, offsets)
+    axonEccentricities_mean, axonEccentricities_std = get_means_and_stds(axonEccentricities, offsets)
+    nEllipsoids = np.diff(offsets)
+    eigvals, eigvecs = get_PCAs(axonCentrelines, offsets)
+
+    #### split into one entry per axon
+    def split(values):
+        return np.split(values, offsets[1:-1])
+
     metrics = {
-        'axonCentrelines': [],
-        'axonSinousity': [],
-        'axonMaxDeviation': [],
-        'axonDiameters': [],
-        'axonDiameters_mean': [],
-        'axonDiameters_std': [],
-        'myelinDiameters': [],
-        'myelinDiameters_mean': [],
-        'myelinDiameters_std': [],
-        'myelinEquivalentDiameters': [],
-        'myelinEquivalentDiameters_mean': [],
-        'myelinEquivalentDiameters_std': [],
-        'maxDiameter': [],
-        'nEllipsoids': [],
-        'axonEccentricities': [],
-        'axonEccentricities_mean': [],
-        'axonEccentricities_std': [],
+        'axonCentrelines': split(axonCentrelines),
+        'axonSinousity': axonSinousity.tolist(),
+        'axonMaxDeviation': axonMaxDeviation.tolist(),
+        'axonDiameters': split(axonDiameters),
+        'axonDiameters_mean': axonDiameters_mean.tolist(),
+        'axonDiameters_std': axonDiameters_std.tolist(),
+        'myelinDiameters': split(myelinDiameters),
+        'myelinDiameters_mean': myelinDiameters_mean.tolist(),
+        'myelinDiameters_std': myelinDiameters_std.tolist(),
+        'myelinEquivalentDiameters': split(myelinEquivalentDiameters),
+        'myelinEquivalentDiameters_mean': myelinEquivalentDiameters_mean.tolist(),
+        'myelinEquivalentDiameters_std': myelinEquivalentDiameters_std.tolist(),
+        'maxDiameter': arrays['axon_maxDiameters'].tolist(),
+        'nEllipsoids': nEllipsoids.tolist(),
+        'axonEccentricities': split(axonEccentricities),
+        'axonEccentricities_mean': axonEccentricities_mean.tolist(),
+        'axonEccentricities_std': axonEccentricities_std.tolist(),
         'alpha_desired': alpha,
         'beta_desired': beta,
-        'axonPCAs': [],
+        'axonPCAs': [[eigval, eigvec] for eigval, eigvec in zip(eigvals, eigvecs)],
     }
-    
-    with open(path_config, 'r') as file:
-        config = json.load(file)
-    
-    for axon in config['axons']:
-        
-        ##### PER AXON
-        axonCentreline = []
-        axonDiameter = []
-        myelinDiameter = []
-        myelinEquivalentDiameter = []
-        axonEccentricities = []
-
-        for ellipsoid in axon['ellipsoids']:
-            
-            if len(axonCentreline) > 0:
-                
-                pass
-            
-            if (len(axonCentreline) == 0) or (math.dist(axonCentreline[-1], ellipsoid['position']) > dist_sampling):
-            
-                axonCentreline.append(ellipsoid['position'])
-
-                axonDiameter.append(ellipsoid['axonDiameter']) 
-
-                myelinDiameter.append(ellipsoid['myelinDiameter']) # 2 * np.sqrt(S[0, 0] * S[1, 1]), or 2 * np.sqrt(np.linalg.det(S) / S[2, 2])
-
-                # equivalent diameter: the diameter of a circle which has an area equal to that of the ellipse
-                S = np.reshape(ellipsoid['shape'], (3, 3))
-                area_ellipse = np.pi * S[0, 0] * S[1, 1]
-                d_equivalent_circle = 2 * np.sqrt(area_ellipse / np.pi)
-                myelinEquivalentDiameter.append(d_equivalent_circle)
-
-                a, b = max(S[0, 0], S[1, 1]), min(S[0, 0], S[1, 1])
-                eccentricity = np.sqrt(1-b**2/a**2)
-                axonEccentricities.append(eccentricity)
-                
-            else:
-                pass
-
-        # compute stuff
-        axonSinousity = get_sinousity_from_centreline(axonCentreline)
-        axonMaxDeviation = get_max_deviation_from_centreline(axonCentreline)
-        axonDiameter_mean = np.mean(axonDiameter)
-        axonDiameter_std = np.std(axonDiameter)
-        myelinDiameter_mean = np.mean(myelinDiameter)
-        myelinDiameter_std = np.std(myelinDiameter)
-        myelinEquivalentDiameter_mean = np.mean(myelinEquivalentDiameter)
-        myelinEquivalentDiameter_std = np.std(myelinEquivalentDiameter)
-        nEllipsoids = len(axonCentreline)
-        axonEccentricities_mean = np.mean(axonEccentricities)
-        axonEccentricities_std = np.std(axonEccentricities)
-        
-        pca = PCA(n_components=3)
-        pca.fit(axonCentreline)
-        eigvals, eigvecs = pca.explained_variance_, pca.components_
-        
-        # add to dict
-        metrics['axonCentrelines'].append(axonCentreline)
-        metrics['axonSinousity'].append(axonSinousity)
-        metrics['axonMaxDeviation'].append(axonMaxDeviation)
-        metrics['axonDiameters'].append(axonDiameter)
-        metrics['axonDiameters_mean'].append(axonDiameter_mean)
-        metrics['axonDiameters_std'].append(axonDiameter_std)
-        metrics['myelinDiameters'].append(myelinDiameter)
-        metrics['myelinDiameters_mean'].append(myelinDiameter_mean)
-        metrics['myelinDiameters_std'].append(myelinDiameter_std)
-        metrics['myelinEquivalentDiameters'].append(myelinEquivalentDiameter)
-        metrics['myelinEquivalentDiameters_mean'].append(myelinEquivalentDiameter_mean)
-        metrics['myelinEquivalentDiameters_std'].append(myelinEquivalentDiameter_std)
-        metrics['maxDiameter'].append(axon['maxDiameter'])
-        metrics['nEllipsoids'].append(nEllipsoids)
-        metrics['axonEccentricities'].append(axonEccentricities)
-        metrics['axonEccentricities_mean'].append(axonEccentricities_mean)
-        metrics['axonEccentricities_std'].append(axonEccentricities_std)
-        metrics['axonPCAs'].append([eigvals, eigvecs])
 
     return metrics
 
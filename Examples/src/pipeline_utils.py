@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from src import config_utils
+
+
+
+#### STAGES ####
+
+def get_stages(parameters):
+
+    """
+    The stage schedule of the optimisation as a list of dicts, one per stage,
+    from the per-stage lists of the parameter config.
+    """
+
+    stages = []
+
+    for eDS, mI, gS, oI in zip(
+        parameters["ellipsoidDensityScalers"],
+        parameters["maxIterations"],
+        parameters["growSpeeds"],
+        parameters["outputIntervals"],
+    ):
+        stages.append({
+            'ellipsoidDensityScaler' : eDS,
+            'maxIterations' : mI,
+            'growSpeed' : gS,
+            'outputInterval' : oI,
+        })
+
+    return stages
+
+
+
+def get_path_config_of_stage(path_config, counter):
+
+    """
+    rep_01-stage=0.json -> rep_01-stage={counter}.json (only the name of the
+    file is changed, not the folders it is in)
+    """
+
+    path_folder, name = os.path.split(path_config)
+
+    return os.path.join(path_folder, name.replace('stage=0', f'stage={counter}')).replace('\\', '/')
+
+
+
+def get_path_output(path_config):
+
+    return path_config.replace('.json', '_output')
+
+
+
+def get_path_config_output(path_output):
+
+    """
+    The last config written by the white-matter-generator in path_output,
+    i.e. config_output_{i}.json with the highest iteration i.
+    """
+
+    names = [n for n in os.listdir(path_output) if n.startswith('config_output_') and n.endswith('.json')]
+
+    if len(names) == 0:
+        return None
+
+    name = max(names, key=lambda n: int(n.replace('config_output_', '').replace('.json', '')))
+
+    return os.path.join(path_output, name).replace('\\', '/')
+
+
+
+def get_path_marker(path_output):
+
+    return os.path.join(path_output, 'stage_done.json')
+
+
+
+def get_paths_logs(path_output):
+
+    """
+    Files the stdout (one row per iteration) and stderr of the CLI are
+    written to while a stage runs.
+    """
+
+    return os.path.join(path_output, 'stdout.txt').replace('\\', '/'), os.path.join(path_output, 'stderr.txt').replace('\\', '/')
+
+
+
+def get_hash_of_file(path_file):
+
+    hash_ = hashlib.sha256()
+
+    with open(path_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**20), b''):
+            hash_.update(chunk)
+
+    return hash_.hexdigest()
+
+
+
+def load_marker(path_output, path_config=None):
+
+    """
+    The marker written when a stage finished, or None if it never did. With
+    path_config, it is also None if the stage was run on another version of
+    that config (e.g. a regenerated stage=0 config).
+    """
+
+    path_marker = get_path_marker(path_output)
+
+    if not os.path.exists(path_marker):
+        return None
+
+    with open(path_marker, 'r') as file:
+        marker = json.load(file)
+
+    if path_config != None:
+        if (not os.path.exists(path_config)) or (marker.get('hash_config') != get_hash_of_file(path_config)):
+            return None
+
+    return marker
+
+
+
+def clear_output(path_output):
+
+    """
+    Empties the output folder of a stage before it is (re)run, so that no
+    config_output_{i}.json of an earlier, unfinished run is mistaken for its
+    output.
+    """
+
+    if os.path.exists(path_output):
+        shutil.rmtree(path_output)
+
+    os.makedirs(path_output)
+
+
+
+def prepare_config_of_stage(path_config_output_prev, path_config_new, stage):
+
+    """
+    Continue from the output of the previous stage with the settings of this stage.
+    """
+
+    eDS = stage['ellipsoidDensityScaler']
+    mapFromMaxDiameterToEllipsoidSeparation = {'from': [1.0, 2.0],
+                                               'to': [1.0*eDS, 2.0*eDS],}
+
+    config_utils.edit_config_file(path_config_output_prev, path_config_new, 'mapFromMaxDiameterToEllipsoidSeparation', mapFromMaxDiameterToEllipsoidSeparation)
+    config_utils.edit_config_file(path_config_new, path_config_new, 'growSpeed', stage['growSpeed'])
+
+
+
+def get_command(path_config, path_output, stage, parameters, targetFVF,
+                executable='white-matter-generator'):
+
+    return [
+        executable,
+        '-f', path_config,
+        '-i', str(stage['maxIterations']),
+        '-o', str(stage['outputInterval']),
+        '-v', str(targetFVF),
+        '-d', path_output,
+        '-r', str(parameters['outputResolution']),
+        '-b', str(parameters['outputBinary']),
+        '-s', str(parameters['outputSimpleMesh']),
+        '-x', str(parameters['extendAxons']),
+        '-e', str(parameters['exportAs']),
+        '-w', str(parameters['maxIterationsWithoutImprovement']),
+    ]
+
+
+
+#### RUNNING ####
+
+def run_stage(path_config, stage, parameters, targetFVF,
+              executable='white-matter-generator'):
+
+    """
+    Runs one stage and returns its marker: the config and its hash, the exact
+    path of the config it output, the return code, the time consumption and
+    the files holding the stdout and stderr of the CLI (see get_paths_logs,
+    the progress can be followed there while the stage runs).
+    The marker is only written to disk if the stage succeeded. Anything in the
+    output folder from before is removed first.
+    """
+
+    path_output = get_path_output(path_config)
+    clear_output(path_output)
+
+    time0 = time.time()
+
+    command = get_command(path_config, path_output, stage, parameters, targetFVF, executable)
+    path_stdout, path_stderr = get_paths_logs(path_output)
+
+    # written to files rather than kept in memory, a stage can print for hours
+    with open(path_stdout, 'w') as stdout, open(path_stderr, 'w') as stderr:
+        try:
+            returncode = subprocess.run(command, stdout=stdout, stderr=stderr, text=True).returncode
+        except OSError as e:
+            # e.g. the executable is not on the PATH
+            stderr.write(f'{e}\n')
+            returncode = -1
+
+    marker = {
+        'path_config' : path_config,
+        'hash_config' : get_hash_of_file(path_config),
+        'path_config_output' : None,
+        'returncode' : returncode,
+        'time' : time.time() - time0,
+        'path_stdout' : path_stdout,
+        'path_stderr' : path_stderr,
+    }
+
+    if returncode != 0:
+        with open(path_stderr, 'r') as file:
+            marker['stderr'] = file.read().strip()
+        return marker
+
+    marker['path_config_output'] = get_path_config_output(path_output)
+
+    with open(get_path_marker(path_output), 'w') as file:
+        json.dump(marker, file, indent=4)
+
+    return marker
+
+
+
+def run_chain(path_config, parameters, resume=True,
+              executable='white-matter-generator'):
+
+    """
+    Runs all stages of the schedule for a single stage=0 config, each stage
+    continuing from the exact output of the previous one.
+
+    With resume = True, stages that finished in an earlier run (i.e. that have
+    a stage_done.json in their output folder) are not run again, unless their
+    config changed since or an earlier stage had to be run again.
+
+    Returns the marker of each stage that was reached.
+    """
+
+    targetFVF = float(path_config.split('targetFVF=')[-1].split('-')[0])
+
+    markers = []
+
+    # once a stage is run, the later ones have to be run again too
+    resume_stage = resume
+
+    for counter, stage in enumerate(get_stages(parameters)):
+
+        path_config_stage = get_path_config_of_stage(path_config, counter)
+        path_output = get_path_output(path_config_stage)
+
+        marker = load_marker(path_output, path_config_stage) if resume_stage else None
+
+        if marker == None:
+
+            resume_stage = False
+
+            if counter > 0:
+                prepare_config_of_stage(markers[-1]['path_config_output'], path_config_stage, stage)
+
+            marker = run_stage(path_config_stage, stage, parameters, targetFVF, executable)
+
+            print(f'[LOG] {path_config_stage}: time consumption: %.2f s' %marker['time'])
+
+        else:
+            print(f'[LOG] {path_config_stage}: already done, skipping...')
+
+        markers.append(marker)
+
+        if (marker['returncode'] != 0) or (marker['path_config_output'] == None):
+            print(f'[OBS] {path_config_stage} failed with return code {marker["returncode"]}:')
+            print(marker.get('stderr', 'no config_output written'))
+            break
+
+    return markers
+
+
+
+def run_pipeline(paths_config_files, parameters, n_workers=1, resume=True,
+                 executable='white-matter-generator'):
+
+    """
+    Runs the stage chains of many configs at once, n_workers chains at a time
+    (None = one per CPU). The stages of each chain run in order; every stage is
+    its own white-matter-generator process.
+
+    Returns the markers of every chain, in the order of paths_config_files.
+    """
+
+    if n_workers == None:
+        n_workers = os.cpu_count()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(run_chain, path_config, parameters, resume, executable)
+                   for path_config in paths_config_files]
+        markers = [future.result() for future in futures]
+
+    return markers
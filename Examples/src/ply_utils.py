@@ -0,0 +1,453 @@
+"""
+Reading of the .ply-meshes written by the white-matter-generator (ascii or
+binary, big or little endian) and by src.mesh_utils.
+
+Only the header is parsed line by line; it is read until end_header, so the
+(possibly binary) payload is never scanned for header values.
+
+Binary meshes can also be memory-mapped (map_ply, memmap_ply), so that the
+vertices and faces are views into the file that are only read where used, and
+ascii meshes (outputBinary=false) converted to binary row chunk by row chunk
+(convert_ascii_to_binary).
+"""
+
+import re
+import itertools
+import numpy as np
+from numpy.lib import recfunctions
+
+
+
+PLY_DTYPES = {
+    'char' : 'i1', 'int8' : 'i1',
+    'uchar' : 'u1', 'uint8' : 'u1',
+    'short' : 'i2', 'int16' : 'i2',
+    'ushort' : 'u2', 'uint16' : 'u2',
+    'int' : 'i4', 'int32' : 'i4',
+    'uint' : 'u4', 'uint32' : 'u4',
+    'float' : 'f4', 'float32' : 'f4',
+    'double' : 'f8', 'float64' : 'f8',
+}
+
+NAMES_VOXEL_LIMS = ['voxel_xmin', 'voxel_xmax', 'voxel_ymin', 'voxel_ymax', 'voxel_zmin', 'voxel_zmax']
+
+
+
+#### HEADER ####
+
+def read_header(path_ply):
+
+    """
+    The header of a .ply as a dict:
+
+        format      'ascii', 'binary_little_endian' or 'binary_big_endian'
+        comments    the comment lines, without 'comment '
+        elements    [{'name', 'count', 'properties'}], where properties is a
+                    list of (name, type) and type is e.g. 'float' or
+                    ('list', 'uchar', 'int')
+        size        number of bytes up to and including end_header
+    """
+
+    header = {'format' : None, 'comments' : [], 'elements' : [], 'size' : 0}
+
+    with open(path_ply, 'rb') as file:
+
+        line = file.readline()
+        if line.strip() != b'ply':
+            raise ValueError(f'{path_ply} is not a .ply-file')
+
+        while True:
+            line = file.readline()
+
+            if line == b'':
+                raise ValueError(f'{path_ply} has no end_header')
+
+            words = line.decode('ascii', errors='replace').split()
+
+            if len(words) == 0:
+                continue
+            elif words[0] == 'end_header':
+                break
+            elif words[0] == 'format':
+                header['format'] = words[1]
+            elif words[0] in ['comment', 'obj_info']:
+                header['comments'].append(line.decode('ascii', errors='replace').strip()[len(words[0])+1:])
+            elif words[0] == 'element':
+                header['elements'].append({'name' : words[1], 'count' : int(words[2]), 'properties' : []})
+            elif words[0] == 'property':
+                if words[1] == 'list':
+                    header['elements'][-1]['properties'].append((words[4], ('list', words[2], words[3])))
+                else:
+                    header['elements'][-1]['properties'].append((words[2], words[1]))
+
+        header['size'] = file.tell()
+
+    return header
+
+
+
+def get_element(header, name):
+
+    for element in header['elements']:
+        if element['name'] == name:
+            return element
+
+    return None
+
+
+
+def get_voxel_lims(header):
+
+    """
+    [xmin, xmax, ymin, ymax, zmin, zmax] from the voxel_*=... comments of the
+    header, or None if (some of) them are missing.
+    """
+
+    values = {}
+
+    for comment in header['comments']:
+        for name, value in re.findall(r'(voxel_[xyz]m(?:in|ax))\s*=\s*([-+0-9.eE]+)', comment):
+            values[name] = float(value)
+
+    if any([name not in values for name in NAMES_VOXEL_LIMS]):
+        return None
+
+    return [values[name] for name in NAMES_VOXEL_LIMS]
+
+
+
+#### PAYLOAD ####
+
+def _get_endianness(header):
+
+    return '<' if header['format'] == 'binary_little_endian' else '>'
+
+
+
+def _get_dtype_of_element(element, endianness, n_list=3):
+
+    """
+    Structured dtype of one row of element. List properties are taken to hold
+    n_list items each (i.e. triangles for faces).
+    """
+
+    fields = []
+
+    for name, type_ in element['properties']:
+        if type(type_) == tuple:
+            fields.append((name + '_count', endianness + PLY_DTYPES[type_[1]]))
+            fields.append((name, endianness + PLY_DTYPES[type_[2]], (n_list,)))
+        else:
+            fields.append((name, endianness + PLY_DTYPES[type_]))
+
+    return np.dtype(fields)
+
+
+
+def _get_name_of_face_list(element):
+
+    for name, type_ in element['properties']:
+        if type(type_) == tuple:
+            return name
+
+    raise ValueError('the face element has no list property')
+
+
+
+def load_ply(path_ply, header=None):
+
+    """
+    Vertex positions (n_vertices, 3) and triangles (n_faces, 3) of a triangular
+    .ply-mesh.
+    """
+
+    if header == None:
+        header = read_header(path_ply)
+
+    element_vertex = get_element(header, 'vertex')
+    element_face = get_element(header, 'face')
+
+    n_vertices = element_vertex['count'] if element_vertex != None else 0
+    n_faces = element_face['count'] if element_face != None else 0
+
+    if header['format'] == 'ascii':
+
+        names_vertex = [name for name, _ in element_vertex['properties']]
+        idxs_xyz = [names_vertex.index(name) for name in ['x', 'y', 'z']]
+
+        with open(path_ply, 'rb') as file:
+            file.seek(header['size'])
+            lines = file.read().decode('ascii').splitlines()
+
+        lines = [line for line in lines if line.strip() != '']
+
+        vertices = np.loadtxt(lines[:n_vertices], usecols=idxs_xyz, ndmin=2).reshape((-1, 3))
+        faces = np.loadtxt(lines[n_vertices:n_vertices+n_faces], dtype=np.int64, ndmin=2).reshape((n_faces, -1))
+
+        if (n_faces > 0) and ((faces.shape[1] != 4) or np.any(faces[:, 0] != 3)):
+            raise ValueError(f'{path_ply} is not a triangular mesh')
+
+        return vertices, faces[:, 1:]
+
+    endianness = _get_endianness(header)
+
+    offset = header['size']
+    vertices, faces = np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+    for element in header['elements']:
+
+        dtype = _get_dtype_of_element(element, endianness)
+        data = np.fromfile(path_ply, dtype=dtype, count=element['count'], offset=offset)
+
+        if element['name'] == 'vertex':
+            vertices = np.stack([data['x'], data['y'], data['z']], axis=-1).astype(np.float64)
+        elif element['name'] == 'face':
+            name = _get_name_of_face_list(element)
+            if np.any(data[name + '_count'] != 3):
+                raise ValueError(f'{path_ply} is not a triangular mesh')
+            faces = data[name].astype(np.int64)
+
+        offset += element['count'] * dtype.itemsize
+
+    return vertices, faces
+
+
+
+#### MEMORY MAPPING ####
+
+def _get_idx_list(element):
+
+    """
+    Index of the list property of element (None if it has none). Elements with
+    more than one list property are not supported.
+    """
+
+    idxs = [idx for idx, (_, type_) in enumerate(element['properties']) if type(type_) == tuple]
+
+    if len(idxs) > 1:
+        raise ValueError(f"element '{element['name']}' has more than one list property")
+
+    return idxs[0] if len(idxs) == 1 else None
+
+
+
+def _get_n_list(path_ply, element, endianness, offset):
+
+    """
+    Number of items in the lists of a binary element, from the count of its
+    first row (the properties before the list are of fixed size).
+    """
+
+    idx_list = _get_idx_list(element)
+
+    if (idx_list == None) or (element['count'] == 0):
+        return 3
+
+    size_before = _get_dtype_of_element({'properties' : element['properties'][:idx_list]}, endianness).itemsize
+    type_count = element['properties'][idx_list][1][1]
+
+    return int(np.fromfile(path_ply, dtype=endianness + PLY_DTYPES[type_count], count=1, offset=offset + size_before)[0])
+
+
+
+def memmap_ply(path_ply, header=None, mode='r', check_lists=True):
+
+    """
+    The elements of a binary .ply as structured np.memmaps, {name: array}, so
+    nothing is read until it is used. All lists of an element must be of the
+    same length (e.g. only triangles), which is checked with check_lists (this
+    reads the counts of the lists).
+
+    ascii .ply can not be mapped, see convert_ascii_to_binary.
+    """
+
+    if header == None:
+        header = read_header(path_ply)
+
+    if header['format'] == 'ascii':
+        raise ValueError(f'{path_ply} is ascii, convert it with convert_ascii_to_binary to map it')
+
+    endianness = _get_endianness(header)
+
+    offset = header['size']
+    elements = {}
+
+    for element in header['elements']:
+
+        n_list = _get_n_list(path_ply, element, endianness, offset)
+        dtype = _get_dtype_of_element(element, endianness, n_list)
+
+        if element['count'] > 0:
+            data = np.memmap(path_ply, dtype=dtype, mode=mode, offset=offset, shape=(element['count'],))
+        else:
+            data = np.zeros(0, dtype=dtype)
+
+        idx_list = _get_idx_list(element)
+
+        if check_lists and (idx_list != None):
+            name = element['properties'][idx_list][0]
+            if np.any(data[name + '_count'] != n_list):
+                raise ValueError(f"the lists '{name}' of {path_ply} are not all of length {n_list}")
+
+        elements[element['name']] = data
+        offset += element['count'] * dtype.itemsize
+
+    return elements
+
+
+
+def map_ply(path_ply, header=None, check_lists=True):
+
+    """
+    load_ply of a binary .ply without reading it: the vertex positions
+    (n_vertices, 3) and triangles (n_faces, 3) are read-only views into the
+    mapped file, in the types of the file (e.g. float32 and int32). x, y and z
+    have to be consecutive properties of the same type.
+    """
+
+    if header == None:
+        header = read_header(path_ply)
+
+    elements = memmap_ply(path_ply, header=header, check_lists=check_lists)
+
+    vertices = recfunctions.structured_to_unstructured(elements['vertex'][['x', 'y', 'z']], copy=False)
+
+    element_face = get_element(header, 'face')
+
+    if element_face == None:
+        return vertices, np.zeros((0, 3), dtype=np.int32)
+
+    faces = elements['face'][_get_name_of_face_list(element_face)]
+
+    if (len(faces) > 0) and (faces.shape[1] != 3):
+        raise ValueError(f'{path_ply} is not a triangular mesh')
+
+    return vertices, faces
+
+
+
+#### WRITING ####
+
+def _get_header_bytes(format_, comments, elements):
+
+    lines = ['ply', f'format {format_} 1.0']
+    lines += [f'comment {comment}' for comment in comments]
+
+    for element in elements:
+        lines.append(f"element {element['name']} {element['count']}")
+        for name, type_ in element['properties']:
+            if type(type_) == tuple:
+                lines.append(f'property list {type_[1]} {type_[2]} {name}')
+            else:
+                lines.append(f'property {type_} {name}')
+
+    lines.append('end_header')
+
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+
+def write_ply(path_ply, vertices, faces, comments=[], binary=True):
+
+    """
+    Writes a triangular .ply-mesh as the white-matter-generator does: float
+    x y z and uchar int vertex_indices, binary little endian (or ascii).
+    comments are e.g. the voxel_*=... lines of read_header.
+    """
+
+    vertices = np.asarray(vertices, dtype='<f4').reshape((-1, 3))
+    faces = np.asarray(faces, dtype='<i4').reshape((-1, 3))
+
+    elements = [
+        {'name' : 'vertex', 'count' : len(vertices), 'properties' : [('x', 'float'), ('y', 'float'), ('z', 'float')]},
+        {'name' : 'face', 'count' : len(faces), 'properties' : [('vertex_indices', ('list', 'uchar', 'int'))]},
+    ]
+
+    with open(path_ply, 'wb') as file:
+
+        file.write(_get_header_bytes('binary_little_endian' if binary else 'ascii', comments, elements))
+
+        if binary:
+            vertices.tofile(file)
+            data = np.zeros(len(faces), dtype=_get_dtype_of_element(elements[1], '<'))
+            data['vertex_indices_count'] = 3
+            data['vertex_indices'] = faces
+            data.tofile(file)
+        else:
+            np.savetxt(file, vertices, fmt='%.9g')
+            np.savetxt(file, np.hstack([np.full((len(faces), 1), 3), faces]), fmt='%d')
+
+
+
+def _parse_rows(lines, element, dtype):
+
+    """
+    ascii rows of element as a structured array of dtype.
+    """
+
+    values = np.array(b' '.join(lines).split(), dtype=np.float64)
+    sizes = [int(np.prod(dtype[name].shape)) for name in dtype.names]
+
+    if len(values) != len(lines) * sum(sizes):
+        raise ValueError(f"the rows of element '{element['name']}' are not all of the same length")
+
+    values = values.reshape((len(lines), sum(sizes)))
+    data = np.zeros(len(lines), dtype=dtype)
+
+    column = 0
+    for name, size in zip(dtype.names, sizes):
+        data[name] = values[:, column:column+size].reshape(data[name].shape)
+        column += size
+
+    return data
+
+
+
+def convert_ascii_to_binary(path_ascii, path_binary, size_chunk=2**16):
+
+    """
+    Converts an ascii .ply (e.g. written with outputBinary=false) to binary
+    little endian, with the same elements, properties and comments. The rows
+    are streamed size_chunk at a time, so the mesh never has to fit in memory.
+    All lists of an element must be of the same length.
+    """
+
+    header = read_header(path_ascii)
+
+    if header['format'] != 'ascii':
+        raise ValueError(f'{path_ascii} is not ascii')
+
+    with open(path_ascii, 'rb') as file_in, open(path_binary, 'wb') as file_out:
+
+        file_in.seek(header['size'])
+        rows = (line for line in file_in if line.strip() != b'')
+
+        file_out.write(_get_header_bytes('binary_little_endian', header['comments'], header['elements']))
+
+        for element in header['elements']:
+
+            idx_list = _get_idx_list(element)
+            dtype = None
+            n_left = element['count']
+
+            while n_left > 0:
+
+                lines = list(itertools.islice(rows, min(size_chunk, n_left)))
+
+                if len(lines) == 0:
+                    raise ValueError(f"{path_ascii} has fewer rows of element '{element['name']}' than its header says")
+
+                # the length of the lists is that of the first row
+                if dtype == None:
+                    n_list = int(lines[0].split()[idx_list]) if idx_list != None else 3
+                    dtype = _get_dtype_of_element(element, '<', n_list)
+
+                data = _parse_rows(lines, element, dtype)
+
+                if (idx_list != None) and np.any(data[element['properties'][idx_list][0] + '_count'] != n_list):
+                    raise ValueError(f"the lists of element '{element['name']}' of {path_ascii} are not all of length {n_list}")
+
+                data.tofile(file_out)
+                n_left -= len(lines)
+
+    return path_binary
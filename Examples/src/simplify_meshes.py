@@ -0,0 +1,186 @@
+"""
+Closes, triangulates and simplifies every mesh of every ply_* output directory
+of the white-matter-generator below a folder, e.g.
+
+    python -m src.simplify_meshes ../output --n_workers 16
+
+The meshes of .../ply_{i}/ are written to .../ply_{i}_simplified/ together with
+a manifest.json holding the vertex counts, keep_fraction and max deviation of
+each mesh. Meshes whose simplified version is newer than the original are
+skipped, so the pipeline can be rerun after adding phantoms or after a crash.
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+
+sys.path.append('../')
+from src import mesh_utils
+
+
+
+NAME_MANIFEST = 'manifest.json'
+
+
+
+def get_paths_ply_directories(path_root):
+
+    """
+    All ply_{i} directories written by the white-matter-generator below path_root.
+    """
+
+    paths = []
+
+    for path, names_dirs, _ in os.walk(path_root):
+        for name in names_dirs:
+            if re.fullmatch(r'ply_\d+', name):
+                paths.append(os.path.join(path, name))
+
+    return sorted(paths)
+
+
+
+def get_path_output(path_ply_directory):
+
+    return os.path.normpath(path_ply_directory) + '_simplified'
+
+
+
+def get_minimum_distance(path_ply_directory):
+
+    """
+    minimumDistance of the config_output_{i}.json that belongs to ply_{i}.
+    The CLI writes it near the top of the file, so only the start of it is read.
+    """
+
+    idx = os.path.basename(os.path.normpath(path_ply_directory)).split('_')[-1]
+    path_config = os.path.join(os.path.dirname(os.path.normpath(path_ply_directory)), f'config_output_{idx}.json')
+
+    with open(path_config, 'r') as file:
+        match = re.search(r'"minimumDistance":\s*([-+0-9.eE]+)', file.read(4096))
+
+    if match:
+        return float(match.group(1))
+
+    with open(path_config, 'r') as file:
+        return json.load(file)['minimumDistance']
+
+
+
+def is_up_to_date(path_mesh, path_mesh_out):
+
+    return os.path.exists(path_mesh_out) and (os.path.getmtime(path_mesh_out) >= os.path.getmtime(path_mesh))
+
+
+
+def load_manifest(path_output):
+
+    path_manifest = os.path.join(path_output, NAME_MANIFEST)
+
+    if not os.path.exists(path_manifest):
+        return {}
+
+    with open(path_manifest, 'r') as file:
+        return json.load(file)
+
+
+
+def save_manifest(path_output, manifest):
+
+    path_manifest = os.path.join(path_output, NAME_MANIFEST)
+
+    with open(path_manifest + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+
+    os.replace(path_manifest + '.tmp', path_manifest)
+
+
+
+def get_jobs(path_root, minimumDistance=None, tags=('axon', 'myelin'), force=False):
+
+    """
+    (path_mesh, path_mesh_out, tolerance) for every mesh that has to be
+    (re)simplified, and the manifests of the output directories.
+    """
+
+    jobs = []
+    manifests = {}
+
+    for path_ply_directory in get_paths_ply_directories(path_root):
+
+        path_output = get_path_output(path_ply_directory)
+        os.makedirs(path_output, exist_ok=True)
+        manifests[path_output] = load_manifest(path_output)
+
+        names = sorted([n for n in os.listdir(path_ply_directory) if n.endswith('.ply') and any([tag in n for tag in tags])])
+
+        if len(names) == 0:
+            continue
+
+        tolerance = mesh_utils.get_tolerance(minimumDistance if minimumDistance != None else get_minimum_distance(path_ply_directory))
+
+        for name in names:
+            path_mesh = os.path.join(path_ply_directory, name)
+            path_mesh_out = os.path.join(path_output, name)
+
+            if (not force) and is_up_to_date(path_mesh, path_mesh_out) and (name in manifests[path_output]):
+                continue
+
+            jobs.append((path_mesh, path_mesh_out, tolerance))
+
+    return jobs, manifests
+
+
+
+def simplify_meshes(path_root, minimumDistance=None, tags=('axon', 'myelin'),
+                    resolution=0.01, close_holes=True, n_workers=None, force=False):
+
+    jobs, manifests = get_jobs(path_root, minimumDistance, tags, force)
+
+    print(f'[LOG] {len(jobs)} mesh(es) to simplify in {len(manifests)} ply-directories')
+
+    results = mesh_utils.simplify_mesh_files(jobs, resolution=resolution, close_holes=close_holes, n_workers=n_workers)
+
+    for result in results:
+        if result != None:
+            path_output = os.path.dirname(result['path_mesh_out'])
+            manifests[path_output][os.path.basename(result['path_mesh'])] = result
+
+    for path_output, manifest in manifests.items():
+        save_manifest(path_output, manifest)
+
+    return manifests
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path_root', help='folder to search for ply_* directories')
+    parser.add_argument('--minimum_distance', type=float, default=None,
+                        help='minimumDistance of the phantoms (default: read from config_output_{i}.json)')
+    parser.add_argument('--tags', nargs='+', default=['axon', 'myelin'],
+                        help='only simplify meshes whose name contains one of these')
+    parser.add_argument('--resolution', type=float, default=0.01, help='step of keep_fraction')
+    parser.add_argument('--keep_holes', action='store_true', help='do not close the holes at the ends of the meshes')
+    parser.add_argument('--n_workers', type=int, default=None, help='number of processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='also simplify meshes that are up to date')
+
+    args = parser.parse_args(argv)
+
+    simplify_meshes(
+        args.path_root,
+        minimumDistance=args.minimum_distance,
+        tags=tuple(args.tags),
+        resolution=args.resolution,
+        close_holes=not args.keep_holes,
+        n_workers=args.n_workers,
+        force=args.force,
+    )
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+On-disk cache of the cylinder lists that generate_config_files packs, so that
+a substrate that was already generated (same packer, alpha, beta, targetFVF,
+num_cylinders and seed) is loaded instead:
+
+    paths_config_files = generate_config_files(..., seed=0, cache='substrate_cache')
+
+Every substrate is one .npz file with its cylinder list [um] and voxel corners
+[mm], named by the hash of what it was generated from. The least recently used
+files are removed once the cache grows beyond max_size bytes.
+
+Only seeded runs can hit the cache: with seed=None the streams are drawn from
+the global np.random state and differ from run to run.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+
+# bump when the packing changes, so that old substrates are not reused
+CACHE_VERSION = 1
+
+
+
+def get_key(packer, alpha, beta, targetFVF, num_cylinders, seed):
+
+    """
+    The hash identifying a substrate. seed is the numpy.random.SeedSequence of
+    its repetition.
+    """
+
+    entropy = seed.entropy if isinstance(seed.entropy, int) else list(seed.entropy)
+
+    description = {
+        'version' : CACHE_VERSION,
+        'packer' : packer,
+        'alpha' : float(alpha),
+        'beta' : float(beta),
+        'targetFVF' : float(targetFVF),
+        'num_cylinders' : int(num_cylinders),
+        'entropy' : entropy,
+        'spawn_key' : list(seed.spawn_key),
+    }
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+
+class SubstrateCache():
+
+    def __init__(self, path_cache, max_size=2**30):
+        """
+        path_cache is the folder of the cache, max_size its size [bytes].
+        """
+
+        self.path_cache = path_cache.replace('\\', '/')
+        self.max_size = max_size
+
+        os.makedirs(self.path_cache, exist_ok=True)
+
+    def get_path(self, key):
+
+        return os.path.join(self.path_cache, f'{key}.npz').replace('\\', '/')
+
+    def get(self, key):
+        """
+        (cylinder_list, voxel_corners) of key, or None if it is not cached.
+        """
+
+        path = self.get_path(key)
+
+        try:
+            with np.load(path) as data:
+                cylinder_list = data['cylinder_list']
+                voxel_corners = tuple(data['voxel_corners'].tolist())
+        except (OSError, KeyError, ValueError):
+            # missing, evicted meanwhile or half written
+            return None
+
+        # the modification time is the time of the last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return cylinder_list, voxel_corners
+
+    def put(self, key, cylinder_list, voxel_corners):
+        """
+        Stores a substrate and evicts the least recently used ones if needed.
+        """
+
+        # written next to its final path and moved there, so that concurrent
+        # workers never read a partial file
+        file, path_tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path_cache)
+
+        try:
+            with os.fdopen(file, 'wb') as f:
+                np.savez(f, cylinder_list=np.asarray(cylinder_list, dtype=np.float64),
+                         voxel_corners=np.asarray(voxel_corners, dtype=np.float64))
+            os.replace(path_tmp, self.get_path(key))
+        except BaseException:
+            if os.path.exists(path_tmp):
+                os.remove(path_tmp)
+            raise
+
+        self.evict()
+
+    def get_entries(self):
+        """
+        (path, size, time of last use) of every substrate, least recently used first.
+        """
+
+        entries = []
+
+        for name in os.listdir(self.path_cache):
+
+            if not name.endswith('.npz'):
+                continue
+
+            path = os.path.join(self.path_cache, name).replace('\\', '/')
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def get_size(self):
+
+        return sum([size for _, size, _ in self.get_entries()])
+
+    def evict(self):
+        """
+        Removes the least recently used substrates until the cache fits in max_size.
+        """
+
+        entries = self.get_entries()
+        size = sum([size for _, size, _ in entries])
+
+        for path, size_entry, _ in entries:
+
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            size -= size_entry
+
+    def clear(self):
+
+        for path, _, _ in self.get_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,282 @@
+"""
+Runs the white-matter-generator CLI as managed subprocesses.
+
+The CLI prints one row per iteration to stdout (the same rows as its log
+file). WMGRunner reads them as they come, so the progress and the volume
+fractions of a running optimisation are known without reading files:
+
+    runner = WMGRunner.from_stage(path_config, stage, parameters, targetFVF, timeout=3600)
+    result = runner.run_sync()
+
+Many runners can be driven concurrently from one process with asyncio:
+
+    results = run_runners(runners, max_concurrent=32)
+
+or, inside a coroutine,
+
+    async for idx, AVF, CVF, TVF, timestamp in runner.iterate():
+        if TVF > 0.6:
+            runner.cancel()
+"""
+
+import time
+import asyncio
+import numpy as np
+
+from src import config_utils
+from src import pipeline_utils
+
+
+
+class WMGRunner():
+
+    def __init__(self, command, cwd=None, timeout=None, on_row=None):
+        """
+        command is the argument list of the CLI (e.g. from
+        pipeline_utils.get_command). timeout [s] is the wall time after which
+        the process is terminated (None = never). on_row(runner, row) is
+        called for every iteration row.
+        """
+
+        self.command = [str(c) for c in command]
+        self.cwd = cwd
+        self.timeout = timeout
+        self.on_row = on_row
+
+        self.process = None
+        self.rows = []
+        self.n_iterations = None
+        self.message = None
+        self.status = 'pending'
+        self._cancelled = False
+
+    @classmethod
+    def from_stage(cls, path_config, stage, parameters, targetFVF,
+                   executable='white-matter-generator', **kwargs):
+        """
+        Runner of one stage of the optimisation schedule, see pipeline_utils.
+        """
+
+        path_output = pipeline_utils.get_path_output(path_config)
+        command = pipeline_utils.get_command(path_config, path_output, stage, parameters, targetFVF, executable)
+
+        runner = cls(command, **kwargs)
+        runner.path_config = path_config
+        runner.path_output = path_output
+
+        return runner
+
+    #### Progress
+
+    @property
+    def iteration(self):
+
+        return self.rows[-1][0] if len(self.rows) > 0 else 0
+
+    @property
+    def progress(self):
+        """
+        Fraction of the max number of iterations done.
+        """
+
+        if not self.n_iterations:
+            return 0.0
+
+        return self.iteration / self.n_iterations
+
+    def get_rows(self):
+        """
+        The iterations read so far as a structured array with dtype
+        config_utils.LOG_DTYPE.
+        """
+
+        return np.array(self.rows, dtype=config_utils.LOG_DTYPE)
+
+    def _parse_line(self, line):
+
+        row = config_utils.parse_log_line(line)
+
+        if row != None:
+            self.n_iterations = int(line.split()[2])
+            self.rows.append(row)
+            if self.on_row != None:
+                self.on_row(self, row)
+            return row
+
+        for message in config_utils.LOG_MESSAGES_END:
+            if message in line:
+                self.message = message
+
+        return None
+
+    #### Running
+
+    async def _start(self):
+
+        self.status = 'running'
+        self.time_start = time.time()
+
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command,
+                cwd=self.cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            # e.g. a wrong executable; a failed result, not an exception, so
+            # that the other runners of run_runners are not lost
+            self.status = 'failed'
+            self.stderr = str(e)
+            self.time = time.time() - self.time_start
+            return
+
+        # stderr is drained alongside, so a chatty process can not block on it
+        self._stderr = asyncio.ensure_future(self.process.stderr.read())
+
+    async def _terminate(self, grace_period=5.0):
+
+        if (self.process == None) or (self.process.returncode != None):
+            return
+
+        try:
+            self.process.terminate()
+            await asyncio.wait_for(self.process.wait(), grace_period)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    async def iterate(self):
+        """
+        Starts the process and yields (idx, AVF, CVF, TVF, timestamp) for every
+        iteration as soon as the CLI prints it. The process is terminated when
+        the timeout is exceeded, when cancel is called, or when the iteration
+        is stopped or the task cancelled.
+        """
+
+        if self._cancelled:
+            return
+
+        if self.process == None:
+            await self._start()
+
+        if self.process == None:
+            return
+
+        deadline = None if self.timeout == None else self.time_start + self.timeout
+
+        try:
+            while True:
+
+                if self._cancelled:
+                    await self._terminate()
+                    break
+
+                remaining = None if deadline == None else deadline - time.time()
+
+                try:
+                    if (remaining != None) and (remaining <= 0):
+                        raise asyncio.TimeoutError
+                    line = await asyncio.wait_for(self.process.stdout.readline(), remaining)
+                except asyncio.TimeoutError:
+                    self.status = 'timeout'
+                    await self._terminate()
+                    break
+
+                if line == b'':
+                    break
+
+                row = self._parse_line(line.decode(errors='replace'))
+
+                if row != None:
+                    yield row
+
+        finally:
+            if self.process.returncode == None:
+                await self._terminate()
+
+    async def run(self):
+        """
+        Runs the process to the end and returns a dict with its status
+        ('done', 'failed', 'timeout' or 'cancelled'), return code, end message,
+        iterations and time consumption (and stderr if it failed).
+        """
+
+        try:
+            async for _ in self.iterate():
+                pass
+        except asyncio.CancelledError:
+            self._cancelled = True
+            raise
+        finally:
+            if self.process != None:
+                await self.process.wait()
+                self.stderr = (await self._stderr).decode(errors='replace').strip()
+                self.time = time.time() - self.time_start
+            if self._cancelled:
+                self.status = 'cancelled'
+            elif self.status == 'running':
+                self.status = 'done' if (self.process != None) and (self.process.returncode == 0) else 'failed'
+
+        return self.get_result()
+
+    def cancel(self):
+        """
+        Terminates the process, or keeps it from being started.
+        """
+
+        self._cancelled = True
+
+        if (self.process != None) and (self.process.returncode == None):
+            try:
+                self.process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def get_result(self):
+
+        result = {
+            'command' : self.command,
+            'status' : self.status,
+            'returncode' : None if self.process == None else self.process.returncode,
+            'message' : self.message,
+            'rows' : self.get_rows(),
+            'time' : getattr(self, 'time', None),
+        }
+
+        if self.status != 'done':
+            result['stderr'] = getattr(self, 'stderr', '')
+
+        return result
+
+    def run_sync(self):
+
+        return asyncio.run(self.run())
+
+
+
+async def run_runners_async(runners, max_concurrent=None):
+
+    """
+    Runs the runners, at most max_concurrent at a time (None = all at once).
+    Returns their results in the order of runners.
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrent if max_concurrent != None else max(len(runners), 1))
+
+    async def run(runner):
+        async with semaphore:
+            if runner._cancelled:
+                runner.status = 'cancelled'
+                return runner.get_result()
+            return await runner.run()
+
+    return await asyncio.gather(*[run(runner) for runner in runners])
+
+
+
+def run_runners(runners, max_concurrent=None):
+
+    return asyncio.run(run_runners_async(runners, max_concurrent))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported as src.<name>, as from the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
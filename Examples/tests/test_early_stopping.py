@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from src.early_stopping import EarlyStopping
+
+
+
+def run(f, n_iterations=2000, **kwargs):
+    """
+    Feeds f(i), rounded as the CLI prints it, until the stage is stopped.
+    Returns the iteration it was stopped at and the gain of TVF left, or
+    (n_iterations, None) if it was never stopped.
+    """
+
+    early_stopping = EarlyStopping(n_iterations, **kwargs)
+
+    for idx in range(1, n_iterations + 1):
+        early_stopping.add(idx, round(f(idx), 2))
+        if early_stopping.should_stop():
+            return idx, f(n_iterations) - f(idx)
+
+    return n_iterations, None
+
+
+
+def test_nothing_is_stopped_before_window():
+
+    early_stopping = EarlyStopping(1000, window=50, min_iterations=10)
+
+    assert early_stopping.min_iterations == 50
+
+
+
+def test_flat_quantised_start_is_not_converged():
+
+    # +0.0004 per iteration is flat after rounding for the first dozen rows
+    idx, gain_left = run(lambda i: 0.2 + 0.0004 * i)
+
+    assert (gain_left == None) or (idx > 1900)
+
+
+
+def test_constant_series_is_never_stopped():
+
+    assert run(lambda i: 0.6) == (2000, None)
+
+
+
+@pytest.mark.parametrize('tau', [30, 100, 400])
+def test_plateau_is_stopped_near_threshold(tau):
+
+    threshold = 0.005
+    idx, gain_left = run(lambda i: 0.7 - 0.5 * np.exp(-i / tau), threshold=threshold)
+
+    # stopped well before the end of the stage, with little gain left
+    assert gain_left != None
+    assert idx < 0.9 * 2000
+    assert gain_left < 2 * threshold
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import stat
+import pytest
+
+from src.mcdc_scheduler import MCDCScheduler
+from src.CylindersListGenerator import CylindersListGenerator
+
+
+
+# Stands in for MC-DC_Simulator: logs its start and end, fails if its config
+# asks for it and writes a cylinder list to out_traj_file_index.
+STUB = '''#!{python}
+import os, sys, time
+
+path_config = sys.argv[1]
+parameters = dict([line.split(None, 1) for line in open(path_config) if len(line.split()) >= 2])
+num_process = int(parameters.get('num_process', '1'))
+
+with open({path_log!r}, 'a') as file:
+    file.write(f'start {{time.time()}} {{num_process}} {{path_config}}\\n')
+
+time.sleep(float(parameters.get('sleep', '0.2')))
+
+with open({path_log!r}, 'a') as file:
+    file.write(f'end {{time.time()}} {{num_process}} {{path_config}}\\n')
+
+if os.path.exists(path_config + '.fail'):
+    sys.exit(3)
+
+path_out = parameters.get('out_traj_file_index', '').strip()
+if path_out:
+    with open(path_out + 'gamma_distributed_cylinder_list.txt', 'w') as file:
+        file.write('1\\n0 0 0 0 0 1 0.5\\n')
+'''
+
+
+
+def make_stub(tmp_path):
+
+    path_log = str(tmp_path / 'calls.txt')
+    path_stub = tmp_path / 'MC-DC_Simulator'
+    path_stub.write_text(STUB.format(python=sys.executable, path_log=path_log))
+    path_stub.chmod(path_stub.stat().st_mode | stat.S_IEXEC)
+
+    return str(path_stub), path_log
+
+
+
+def make_config(path, num_process, sleep=0.2, fail=False):
+
+    with open(path, 'w') as file:
+        file.write(f'num_process {num_process}\nsleep {sleep}\n')
+
+    if fail:
+        open(str(path) + '.fail', 'w').close()
+
+    return str(path)
+
+
+
+def read_calls(path_log):
+
+    if not os.path.exists(path_log):
+        return []
+
+    with open(path_log, 'r') as file:
+        return [line.split() for line in file]
+
+
+
+def get_max_cores_in_use(path_log):
+
+    events = sorted([(float(t), 1 if kind == 'start' else -1, int(n)) for kind, t, n, _ in read_calls(path_log)],
+                    key=lambda event: (event[0], event[1]))
+
+    n_cores, n_cores_max = 0, 0
+
+    for _, sign, num_process in events:
+        n_cores += sign * num_process
+        n_cores_max = max(n_cores_max, n_cores)
+
+    return n_cores_max
+
+
+
+def test_core_budget_is_respected(tmp_path):
+
+    executable, path_log = make_stub(tmp_path)
+
+    paths_config = [make_config(tmp_path / f'sim_{i}.conf', num_process) for i, num_process in enumerate([2, 3, 1, 2, 2, 1])]
+
+    scheduler = MCDCScheduler(str(tmp_path / 'queue'), n_cores=4, executable=executable)
+    scheduler.add(paths_config)
+    counts = scheduler.run()
+
+    assert counts == {'pending' : 0, 'running' : 0, 'done' : 6, 'failed' : 0}
+    assert 1 < get_max_cores_in_use(path_log) <= 4
+
+    for job in scheduler.jobs.values():
+        assert os.path.exists(job['path_stdout']) and os.path.exists(job['path_stderr'])
+        assert job['time'] > 0
+
+
+
+def test_num_process_is_clamped_to_the_budget(tmp_path):
+
+    executable, _ = make_stub(tmp_path)
+
+    path_config = make_config(tmp_path / 'big.conf', 16, sleep=0)
+
+    scheduler = MCDCScheduler(str(tmp_path / 'queue'), n_cores=2, executable=executable)
+    scheduler.add([path_config])
+
+    assert scheduler.jobs[os.path.abspath(path_config)]['n_cores'] == 2
+    assert scheduler.run()['done'] == 1
+
+
+
+def test_resume_and_retry_failed(tmp_path):
+
+    executable, path_log = make_stub(tmp_path)
+    path_queue = str(tmp_path / 'queue')
+
+    paths_config = [make_config(tmp_path / f'sim_{i}.conf', 1, sleep=0, fail=(i == 1)) for i in range(3)]
+
+    scheduler = MCDCScheduler(path_queue, n_cores=2, executable=executable)
+    scheduler.add(paths_config)
+    assert scheduler.run() == {'pending' : 0, 'running' : 0, 'done' : 2, 'failed' : 1}
+    assert scheduler.jobs[os.path.abspath(paths_config[1])]['returncode'] == 3
+    assert len([call for call in read_calls(path_log) if call[0] == 'start']) == 3
+
+    # a job that was running when the queue stopped is run again
+    with open(os.path.join(path_queue, 'queue.json'), 'r') as file:
+        jobs = json.load(file)
+    jobs[os.path.abspath(paths_config[2])]['status'] = 'running'
+    with open(os.path.join(path_queue, 'queue.json'), 'w') as file:
+        json.dump(jobs, file)
+
+    # adding the configs again does not queue them twice
+    scheduler = MCDCScheduler(path_queue, n_cores=2, executable=executable)
+    scheduler.add(paths_config)
+    assert len(scheduler.jobs) == 3
+    assert scheduler.run() == {'pending' : 0, 'running' : 0, 'done' : 2, 'failed' : 1}
+
+    starts = [call[3] for call in read_calls(path_log) if call[0] == 'start']
+    assert starts[3:] == [paths_config[2]]
+
+    # only the failed job is run again
+    os.remove(paths_config[1] + '.fail')
+    scheduler = MCDCScheduler(path_queue, n_cores=2, executable=executable)
+    assert scheduler.run(retry_failed=True)['done'] == 3
+
+    starts = [call[3] for call in read_calls(path_log) if call[0] == 'start']
+    assert starts[4:] == [paths_config[1]]
+
+
+
+def test_cylinders_lists_are_queued_in_the_scheduler(tmp_path):
+
+    executable, path_log = make_stub(tmp_path)
+
+    path_substrates = str(tmp_path / 'substrate')
+    os.makedirs(path_substrates)
+
+    path_config_file = os.path.join(path_substrates, 'MCDC.conf')
+    with open(path_config_file, 'w') as file:
+        file.write(f'num_process 2\nsleep 0.1\nout_traj_file_index {path_substrates}/\n')
+
+    CLG = CylindersListGenerator(path_substrates=path_substrates, path_config_file=path_config_file)
+
+    scheduler = MCDCScheduler(str(tmp_path / 'queue'), n_cores=4, executable=executable)
+    returncodes = CLG.generate_cylinders_lists(4, scheduler=scheduler)
+
+    assert returncodes == [0, 0, 0, 0]
+    assert get_max_cores_in_use(path_log) <= 4
+    assert sorted([name for name in os.listdir(path_substrates) if 'cylinder_list' in name]) == \
+        [f'rep_{idx:02d}_gamma_distributed_cylinder_list.txt' for idx in range(4)]
+    assert not any([name.startswith('repetition_') for name in os.listdir(path_substrates)])
+
+    # the queue is resumed: finished repetitions are not run again
+    returncodes = CLG.generate_cylinders_lists(4, scheduler=MCDCScheduler(str(tmp_path / 'queue'), n_cores=4, executable=executable))
+
+    assert returncodes == [0, 0, 0, 0]
+    assert len([call for call in read_calls(path_log) if call[0] == 'start']) == 4
+
+    # unless their cylinder lists were removed since, as clean_up does
+    for name in os.listdir(path_substrates):
+        if name.startswith('rep_01') or name.startswith('rep_03'):
+            os.remove(os.path.join(path_substrates, name))
+
+    returncodes = CLG.generate_cylinders_lists(4, scheduler=scheduler)
+
+    assert returncodes == [0, 0, 0, 0]
+    assert len([call for call in read_calls(path_log) if call[0] == 'start']) == 6
+    assert sorted([name for name in os.listdir(path_substrates) if 'cylinder_list' in name]) == \
+        [f'rep_{idx:02d}_gamma_distributed_cylinder_list.txt' for idx in range(4)]
+
+
+
+def test_done_repetition_without_cylinders_list_raises(tmp_path):
+
+    executable, _ = make_stub(tmp_path)
+
+    path_substrates = str(tmp_path / 'substrate')
+    os.makedirs(path_substrates)
+
+    # no out_traj_file_index, so the stub writes no cylinder list
+    path_config_file = make_config(os.path.join(path_substrates, 'MCDC.conf'), 1, sleep=0)
+
+    CLG = CylindersListGenerator(path_substrates=path_substrates, path_config_file=path_config_file)
+
+    with pytest.raises(RuntimeError, match='no cylinder list'):
+        CLG.generate_cylinders_lists(1, scheduler=MCDCScheduler(str(tmp_path / 'queue'), n_cores=1, executable=executable))
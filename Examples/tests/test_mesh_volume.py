@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from src.GenerateMCDCConfigFile import get_volume_of_mesh, get_volume_of_mesh_in_voxel
+
+
+
+def get_tube(centres, radius, n_sides=64):
+    """
+    Open tube (no caps) of circular cross-section in the xy-plane through
+    the centres (n, 3), as the white-matter-generator leaves its axons.
+    """
+
+    angles = np.linspace(0, 2*np.pi, n_sides, endpoint=False)
+    rings = centres[:, np.newaxis, :] + radius * np.stack([np.cos(angles), np.sin(angles), np.zeros(n_sides)], axis=-1)
+    vertices = rings.reshape((-1, 3))
+
+    faces = []
+    for i in range(len(centres) - 1):
+        for j in range(n_sides):
+            a, b = i*n_sides + j, i*n_sides + (j+1) % n_sides
+            c, d = a + n_sides, b + n_sides
+            faces += [[a, b, d], [a, d, c]]
+
+    return vertices, np.array(faces)
+
+
+
+def get_volume_in_voxel_sampled(centres, radius, voxel_lims, n_samples=400000, seed=0):
+    """
+    Monte Carlo volume of the tube above inside the voxel, from its
+    cross-sections (the centres are sampled densely along z).
+    """
+
+    rng = np.random.default_rng(seed)
+    lims = np.array(voxel_lims).reshape((3, 2))
+    points = rng.uniform(lims[:, 0], lims[:, 1], size=(n_samples, 3))
+
+    z_min, z_max = centres[0, 2], centres[-1, 2]
+    idxs = np.clip(np.searchsorted(centres[:, 2], points[:, 2]), 1, len(centres) - 1)
+    t = (points[:, 2] - centres[idxs-1, 2]) / (centres[idxs, 2] - centres[idxs-1, 2])
+    axis = centres[idxs-1] + t[:, np.newaxis] * (centres[idxs] - centres[idxs-1])
+
+    inside = (np.linalg.norm(points[:, :2] - axis[:, :2], axis=-1) <= radius) & (points[:, 2] >= z_min) & (points[:, 2] <= z_max)
+
+    return np.mean(inside) * np.prod(lims[:, 1] - lims[:, 0])
+
+
+
+def test_straight_tube_inside_the_voxel():
+
+    z = np.linspace(-1, 1, 11)
+    centres = np.stack([np.zeros_like(z), np.zeros_like(z), z], axis=-1)
+    vertices, faces = get_tube(centres, 0.5)
+
+    volume = get_volume_of_mesh(vertices, faces)
+
+    assert get_volume_of_mesh_in_voxel(vertices, faces, [-2, 2, -2, 2, -2, 2]) == pytest.approx(volume)
+    assert get_volume_of_mesh_in_voxel(vertices, faces, [-2, 2, -2, 2, 0, 0.5]) == pytest.approx(volume / 4)
+    assert get_volume_of_mesh_in_voxel(vertices, faces, [3, 4, -2, 2, -2, 2]) == 0.0
+
+
+
+@pytest.mark.parametrize('shape', ['tilted', 'wavy'])
+def test_tube_leaving_the_voxel(shape):
+
+    z = np.linspace(-2, 2, 401)
+
+    if shape == 'tilted':
+        x = 0.4 * z
+    else:
+        x = 0.5 * np.sin(2 * z)
+
+    centres = np.stack([x, 0.1 * z, z], axis=-1)
+    radius = 0.3
+    voxel_lims = [-0.6, 0.7, -0.5, 0.5, -1.0, 1.2]
+
+    vertices, faces = get_tube(centres, radius)
+
+    volume = get_volume_of_mesh_in_voxel(vertices, faces, voxel_lims)
+
+    assert volume == pytest.approx(get_volume_in_voxel_sampled(centres, radius, voxel_lims), rel=0.02)
+    assert volume < get_volume_of_mesh(vertices, faces)
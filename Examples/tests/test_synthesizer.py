@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import numpy as np
+import pytest
+
+from src.Synthesizer import Synthesizer
+
+
+
+# config_output_1-randomSeed=*.json are written by the core of the CLI
+# (white-matter-generator/core/src) after one iteration on config.json, run
+# with the randomSeed in their name
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'synthesizer')
+
+
+
+def load(name):
+
+    with open(os.path.join(PATH_DATA, name), 'r') as file:
+        return json.load(file)
+
+
+
+def get_distance(config_a, config_b):
+
+    """
+    Largest difference between the ellipsoids of two SynthesizerJSONs with the
+    same axons.
+    """
+
+    distance = 0.0
+
+    for axon_a, axon_b in zip(config_a['axons'], config_b['axons']):
+
+        assert len(axon_a['ellipsoids']) == len(axon_b['ellipsoids'])
+
+        for key in ['position', 'shape', 'axonDiameter', 'myelinDiameter']:
+            values_a = np.array([e[key] for e in axon_a['ellipsoids']])
+            values_b = np.array([e[key] for e in axon_b['ellipsoids']])
+            distance = max(distance, np.max(np.abs(values_a - values_b)))
+
+    return distance
+
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_update_matches_the_cli(seed):
+    """
+    The order in which the collisions are resolved is random and shifts the
+    ellipsoids by up to 0.06 here. The references are the CLI-runs of the
+    four orders that 40 randomSeeds gave, and one update has to match one of
+    them, whatever the order of the port.
+    """
+
+    config = load('config.json')
+    references = [load(name) for name in sorted(os.listdir(PATH_DATA)) if name.startswith('config_output_1-')]
+
+    synthesizer = Synthesizer(config, seed=seed)
+    synthesizer.update(config['growSpeed'], config['contractSpeed'], config['minimumDistance'], 0.0001, config['border'])
+    output = synthesizer.get_config()
+
+    for reference in references:
+
+        assert set(output.keys()) == set(reference.keys())
+        assert [set(axon.keys()) for axon in output['axons']] == [set(axon.keys()) for axon in reference['axons']]
+
+        for key in ['growSpeed', 'contractSpeed', 'minimumDistance', 'border', 'voxelSize', 'cells',
+                    'mapFromDiameterToDeformationFactor', 'mapFromMaxDiameterToMinDiameter', 'mapFromMaxDiameterToEllipsoidSeparation']:
+            assert output[key] == reference[key]
+
+        for axon, axon_reference in zip(output['axons'], reference['axons']):
+            assert axon['color'] == axon_reference['color']
+            for key in ['position', 'direction', 'maxDiameter', 'gRatio']:
+                assert axon[key] == pytest.approx(axon_reference[key])
+
+    distances = [get_distance(output, reference) for reference in references]
+    reference = references[int(np.argmin(distances))]
+
+    assert min(distances) < 0.002
+    assert Synthesizer(output).volume_fraction(20, 0) == Synthesizer(reference).volume_fraction(20, 0)
+
+
+
+def get_crossing_config(n_axons=20, voxel_size=7.0, seed=0):
+
+    """
+    Axons along z and x through random points of the voxel, with dense chains
+    of ellipsoids (about 500) that collide a lot once they grow.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    positions = rng.uniform(-voxel_size / 2, voxel_size / 2, (n_axons, 3))
+    directions = np.where((np.arange(n_axons) % 2 == 0)[:, None], [0.0, 0.0, 1.0], [1.0, 0.0, 0.0])
+    max_diameters = rng.uniform(1.0, 2.0, n_axons)
+
+    return {
+        'voxelSize' : [voxel_size] * 3,
+        'mapFromDiameterToDeformationFactor' : {'from' : [0.1, 1.0], 'to' : [0.66, 0.66]},
+        'mapFromMaxDiameterToMinDiameter' : {'from' : [1.25, 2.25], 'to' : [0.5, 1.0]},
+        'mapFromMaxDiameterToEllipsoidSeparation' : {'from' : [1.0, 2.0], 'to' : [0.2, 0.4]},
+        'axons' : [{
+            'position' : position,
+            'direction' : direction,
+            'maxDiameter' : max_diameter,
+            'gRatio' : 0.7,
+        } for position, direction, max_diameter in zip(positions.tolist(), directions.tolist(), max_diameters.tolist())],
+    }
+
+
+
+def test_time_of_one_update():
+    """
+    One update takes about 3 s here. Searching the axes of all pairs of a
+    round again, in every round of every collision pass, took over 9 s.
+    """
+
+    synthesizer = Synthesizer(get_crossing_config(), seed=0)
+
+    time0 = time.perf_counter()
+    avf, _ = synthesizer.update(0.3, 1, 0.07, 0.0001)
+    duration = time.perf_counter() - time0
+
+    assert duration < 6.0
+    assert avf > 0.35
+    assert synthesizer.get_overlap(0.07, 0.0001 * 0.999) < 0.0001